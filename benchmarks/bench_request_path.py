@@ -0,0 +1,256 @@
+"""Micro-benchmarks of the per-request CPU work.
+
+Covers the pieces of a request that run between the upstream calls:
+
+- render.*: parsing the tenant document and filling its pod/pv/pvc/match_pvc
+  template, as create_body does for every request
+- expand_vols.*: turning vols into volumes and volumeMounts, pod-service and
+  launcher-service, for 1 and 10 vols
+- serialize.*: to_dict() and json.dumps(indent=1, sort_keys=True,
+  default=datetime_convertor) of a V1Pod and a V1PersistentVolume, as the
+  read routes answer
+- decorator.*: the create_body/get_params/get_launch_params decorators
+  around a view that returns at once, with the tenant lookup answered from
+  the fixture
+
+Nothing outside the process is needed. Results are written as json:
+
+    python benchmarks/bench_request_path.py --output request_path.json
+    python benchmarks/bench_request_path.py --compare request_path.json
+
+With --compare, exits with status 1 when a benchmark got slower than
+--max-regression (a fraction of the baseline median).
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(BENCH_DIR, 'fixtures')
+
+sys.path.insert(0, BENCH_DIR)
+from bench_startup import COMMON_ENV, ROOT, SERVICES
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+def load_service(service):
+    os.environ.update(COMMON_ENV)
+    os.environ.update(SERVICES[service]['env'])
+
+    module_spec = importlib.util.spec_from_file_location(
+        service.replace('-', '_'),
+        os.path.join(ROOT, SERVICES[service]['path'])
+    )
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    return module, module.create_app()
+
+
+class TenantResponse(object):
+    """Stands in for the tenant service response, parsed anew like a real one"""
+    status_code = 200
+
+    def __init__(self, raw):
+        self.text = raw
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def vols(count):
+    return [{'pvc': 'pvc-exam-{}'.format(i), 'mount': '/mnt/exam-{}'.format(i)} for i in range(count)]
+
+
+def deserialize(raw, model):
+    import kubernetes.client
+
+    # the public deserialize() takes a different response argument across client versions
+    return kubernetes.client.ApiClient()._ApiClient__deserialize(json.loads(raw), model)
+
+
+def cases():
+    """Returns [(name, fn, request context or None)], with the setup done up front"""
+    tenant_raw = read_fixture('tenant.json')
+    tenant = json.loads(tenant_raw)
+    tenant_id = tenant['id']
+    namespace = tenant['namespace']
+
+    pod_module, pod_app = load_service('pod-service')
+    volume_module, volume_app = load_service('volume-service')
+    launcher_module, launcher_app = load_service('launcher-service')
+
+    pod_module.fetch_tenant = volume_module.fetch_tenant = lambda tenant_id: TenantResponse(tenant_raw)
+
+    def templates():
+        return json.loads(tenant_raw)['resources']['templates']
+
+    benchmarks = [
+        ('render.tenant_parse', lambda: json.loads(tenant_raw)),
+        ('render.pod', lambda: pod_module.render_pod(templates()['pod'], tenant_id, 'cp -r /src/* /dest/', vols(2))),
+        ('render.pv', lambda: volume_module.render_pv(
+            templates()['pv'], tenant_id, 'voyager', 'default', namespace, '192.168.0.31', '/nfs/', 'moop/voyager'
+        )),
+        ('render.pvc', lambda: volume_module.render_pvc(templates()['pvc'], tenant_id, 'voyager', 'default', namespace)),
+        ('render.match_pvc', lambda: volume_module.render_match_pvc(
+            templates()['match_pvc'], tenant_id, 'voyager', 'default', namespace
+        )),
+    ]
+
+    for count in (1, 10):
+        requested = vols(count)
+        benchmarks.extend([
+            ('expand_vols.pod.{}'.format(count), lambda requested=requested: pod_module.expand_vols(requested)),
+            ('expand_vols.launcher.{}'.format(count), lambda requested=requested: launcher_module.expand_vols(requested)),
+        ])
+
+    for name, fixture, model, module in (
+        ('pod', 'pod.json', 'V1Pod', pod_module),
+        ('pv', 'pv.json', 'V1PersistentVolume', volume_module),
+    ):
+        obj = deserialize(read_fixture(fixture), model)
+        as_dict = obj.to_dict()
+        convertor = module.datetime_convertor
+
+        benchmarks.extend([
+            ('serialize.{}.to_dict'.format(name), obj.to_dict),
+            ('serialize.{}.dumps'.format(name), lambda as_dict=as_dict, convertor=convertor: json.dumps(
+                as_dict, indent=1, sort_keys=True, default=convertor
+            )),
+            ('serialize.{}'.format(name), lambda obj=obj, convertor=convertor: json.dumps(
+                obj.to_dict(), indent=1, sort_keys=True, default=convertor
+            )),
+        ])
+
+    def view(*args, **kwargs):
+        return args
+
+    contexts = [
+        (
+            'decorator.pod.create_body',
+            pod_app,
+            pod_module.create_body(view),
+            dict(path='/service/v1/pods', method='POST', json={'tenant': tenant_id, 'cmd': 'ls', 'vols': vols(2)}),
+        ),
+        (
+            'decorator.pod.get_params',
+            pod_app,
+            pod_module.get_params(view),
+            dict(path='/service/v1/pods', query_string={'tenant': tenant_id, 'name': 'pod-1'}),
+        ),
+        (
+            'decorator.volume.create_body',
+            volume_app,
+            volume_module.create_body(view),
+            dict(path='/service/v1/volumes/pvcs', method='POST', json={'tenant': tenant_id, 'username': 'voyager'}),
+        ),
+        (
+            'decorator.launcher.get_launch_params',
+            launcher_app,
+            launcher_module.get_launch_params(view),
+            dict(path='/services/launcher/containers', method='POST', json={'image': 'busybox', 'username': 'voyager', 'vols': vols(2)}),
+        ),
+    ]
+    benchmarks = [(name, fn, None) for name, fn in benchmarks]
+    for name, app, decorated, request_kwargs in contexts:
+        benchmarks.append((name, decorated, app.test_request_context(**request_kwargs)))
+
+    return benchmarks
+
+
+def measure(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+
+    number, elapsed = timer.autorange()
+    number = max(int(number * min_time / max(elapsed, 1e-9)), 1)
+    timings = [t / number for t in timer.repeat(repeat=repeat, number=number)]
+
+    return {
+        'number': number,
+        'repeat': repeat,
+        'median_ns': statistics.median(timings) * 1e9,
+        'min_ns': min(timings) * 1e9,
+    }
+
+
+def run(args):
+    results = []
+    for name, fn, request_context in cases():
+        if args.filter and not any(pattern in name for pattern in args.filter):
+            continue
+
+        if request_context is None:
+            result = measure(fn, args.repeat, args.min_time)
+        else:
+            # decorators run inside one pushed request context
+            with request_context:
+                result = measure(fn, args.repeat, args.min_time)
+
+        result['name'] = name
+        results.append(result)
+
+    return {
+        'benchmark': 'request_path',
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(report, baseline, max_regression):
+    before = {result['name']: result for result in baseline['results']}
+
+    changes = []
+    for result in report['results']:
+        if result['name'] not in before:
+            continue
+
+        ratio = result['median_ns'] / before[result['name']]['median_ns']
+        changes.append({
+            'name': result['name'],
+            'baseline_median_ns': before[result['name']]['median_ns'],
+            'median_ns': result['median_ns'],
+            'ratio': ratio,
+            'regression': ratio > 1 + max_regression,
+        })
+
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--filter', action='append', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per repeat')
+    parser.add_argument('--output', help='write the json report to this file as well')
+    parser.add_argument('--compare', help='baseline json report to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='allowed slowdown of a median, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.compare:
+        with open(args.compare) as f:
+            report['comparison'] = compare(report, json.load(f), args.max_regression)
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if any(change['regression'] for change in report.get('comparison', [])):
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""Startup time budget for the services.
+
+Every run starts a fresh interpreter per service and measures:
+
+- import_seconds: importing the service module
+- create_app_seconds: running create_app()
+- first_request_seconds: answering the first request through the test client
+
+The first request is one the service answers without any upstream (a
+missing parameter), so nothing outside the process is needed.
+
+    python benchmarks/bench_startup.py --runs 5 --output startup.json
+
+Exits with status 1 when the median of any service is over budget.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# the required envs of each service, with values that need no upstream
+COMMON_ENV = {
+    'LOG_LEVEL': '40',
+    'TENANT_SERVICE_URL': 'http://127.0.0.1:9/service/v1/tenants',
+}
+
+SERVICES = {
+    'launcher-service': {
+        'path': 'launcher-service/launcher-service.py',
+        'env': {
+            'STATUS_CHECK_INTERVAL': '10',
+            'STATUS_CHECK_COUNT': '12',
+            'JUPYTERHUB_SERVICE_PREFIX': '/services/launcher/',
+            'JUPYTERHUB_URL': 'http://127.0.0.1:9',
+            'JUPYTERHUB_API_PREFIX': '/hub/api',
+            'JUPYTERHUB_API_TOKEN': 'bench',
+            'USER_TOKEN_LIFETIME': '1800',
+        },
+        'request': '/services/launcher/containers',
+    },
+    'pod-service': {
+        'path': 'pod-service/pod-service.py',
+        'env': {},
+        'request': '/service/v1/pods',
+    },
+    'volume-service': {
+        'path': 'volume-service/volume-service.py',
+        'env': {
+            'NFS_SERVER': '127.0.0.1',
+            'NFS_PREFIX': '/nfs/',
+        },
+        'request': '/service/v1/volumes/pvs',
+    },
+}
+
+
+def measure(service):
+    """Runs in the child interpreter"""
+    spec = SERVICES[service]
+
+    start = time.perf_counter()
+    module_spec = importlib.util.spec_from_file_location(service, os.path.join(ROOT, spec['path']))
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    imported = time.perf_counter()
+
+    app = module.create_app()
+    created = time.perf_counter()
+
+    resp = app.test_client().get(spec['request'])
+    answered = time.perf_counter()
+
+    return {
+        'import_seconds': imported - start,
+        'create_app_seconds': created - imported,
+        'first_request_seconds': answered - created,
+        'status': resp.status_code,
+    }
+
+
+def run_child(service):
+    env = dict(os.environ)
+    env.update(COMMON_ENV)
+    env.update(SERVICES[service]['env'])
+
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', service],
+        env=env
+    )
+
+    # the service may log to stdout, the measurement is the last line
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def summarize(samples, key):
+    values = [sample[key] for sample in samples]
+
+    return {
+        'median': statistics.median(values),
+        'min': min(values),
+        'max': max(values),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--service', action='append', choices=sorted(SERVICES))
+    parser.add_argument('--import-budget', type=float, default=1.0, help='seconds, median import time')
+    parser.add_argument('--first-request-budget', type=float, default=0.5, help='seconds, median create_app + first request')
+    parser.add_argument('--output', help='write the json report to this file as well')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+
+    results = []
+    for service in args.service or sorted(SERVICES):
+        samples = [run_child(service) for i in range(args.runs)]
+
+        import_time = summarize(samples, 'import_seconds')
+        create_app_time = summarize(samples, 'create_app_seconds')
+        first_request_time = summarize(samples, 'first_request_seconds')
+        to_first_request = create_app_time['median'] + first_request_time['median']
+
+        results.append({
+            'service': service,
+            'runs': args.runs,
+            'import_seconds': import_time,
+            'create_app_seconds': create_app_time,
+            'first_request_seconds': first_request_time,
+            'within_budget': (
+                import_time['median'] <= args.import_budget and
+                to_first_request <= args.first_request_budget
+            ),
+        })
+
+    report = {
+        'benchmark': 'startup',
+        'python': platform.python_version(),
+        'budget': {
+            'import_seconds': args.import_budget,
+            'first_request_seconds': args.first_request_budget,
+        },
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    return 0 if all(result['within_budget'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
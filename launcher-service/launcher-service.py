@@ -1,92 +1,659 @@
+import calendar
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import fcntl
 from functools import wraps
-import traceback
+import hashlib
 import json
+import math
 import os
 import time
 import logging
 import logging.handlers
 import sys
+import tempfile
+import threading
 import uuid
 
 import requests
-from flask import Flask, redirect, request, Response
+from flask import Flask, Blueprint, redirect, request, Response, g, current_app
 
-# configs from envs
-LAUNCH_STATUS_INTERVAL = int(os.getenv('STATUS_CHECK_INTERVAL', ''))
-LAUNCH_STATUS_CHECK_COUNT = int(os.getenv('STATUS_CHECK_COUNT', ''))
-LOG_LEVEL = int(os.getenv('LOG_LEVEL', ''))
-
-service_prefix = os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '/').strip()
-hub_url = os.getenv('JUPYTERHUB_URL', '').strip()
-hub_api_prefix = os.getenv('JUPYTERHUB_API_PREFIX', '').strip()
-hub_api_token = os.getenv('JUPYTERHUB_API_TOKEN', '').strip()
-
-user_token_lifetime = int(os.getenv('USER_TOKEN_LIFETIME').strip())
-
-hub_api_url = '{}{}'.format(hub_url, hub_api_prefix)
+# shared helpers live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from moop_common import idempotency, kube, metrics, profiling, recorder, resilience, tracing
+from moop_common.hashring import HashRing
+from moop_common.instrument import instrument_app
+from moop_common.logs import setup_logging
+from moop_common.resilience import (
+    CircuitOpenError, DeadlineExceeded, DEADLINE_HEADER,
+    configure_breakers, start_deadline, clear_deadline, parse_deadline_header,
+    upstream, is_request_failure
+)
 
 # consts
 REQUEST_TIMEOUT = 120
+HUB_UPSTREAM = 'jupyterhub'
+# launch mints the tokens it answers with under this note
+LAUNCH_TOKEN_NOTE = 'launcher_token'
 LOG_NAME = 'Launcher-Service'
 LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(name)s:%(funcName)s - [%(levelname)s] %(message)s'
 
-def setup_logger(level):
-    handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(LOG_FORMAT)
-    handler.setFormatter(formatter)
+logger = logging.getLogger(LOG_NAME)
+
+# launch metrics
+LAUNCH_READY_SECONDS = metrics.Histogram(
+    'launcher_time_to_ready_seconds',
+    'Time from the spawn request until the server is ready, by image.',
+    ['image'],
+    buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600)
+)
+LAUNCH_POLLS = metrics.Histogram(
+    'launcher_ready_polls',
+    'Status checks made before the server was ready.',
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55)
+)
+TOKEN_MINT_SECONDS = metrics.Histogram(
+    'launcher_token_mint_seconds',
+    'Time spent minting user tokens.'
+)
+CULLED_SERVERS = metrics.Counter(
+    'launcher_culled_servers_total',
+    'Servers selected by cull requests, by outcome.',
+    ['outcome']
+)
+
+# hub metrics
+HUB_SERVERS = metrics.Gauge(
+    'launcher_hub_servers',
+    'Servers on each hub at the last load poll, by state.',
+    ['hub', 'state']
+)
+HUB_PLACEMENTS = metrics.Counter(
+    'launcher_hub_placements_total',
+    'New users placed on each hub.',
+    ['hub']
+)
+
+# volume pre-flight metrics
+VOLUME_CHECKS = metrics.Counter(
+    'launcher_volume_checks_total',
+    'Claims checked before a spawn, by status, cached for claims found bound a moment ago.',
+    ['status']
+)
+VOLUME_CHECK_SECONDS = metrics.Histogram(
+    'launcher_volume_check_seconds',
+    'Time of the volume pre-flight of a launch.'
+)
+
+# pre-pull metrics
+PREPULL_IMAGES = metrics.Gauge(
+    'launcher_prepull_images',
+    'Images kept pulled on the nodes at the last reconcile.'
+)
+PREPULL_NODES = metrics.Gauge(
+    'launcher_prepull_nodes',
+    'Pre-pull pods at the last reconcile, by pull state.',
+    ['state']
+)
+PREPULL_RETIRED = metrics.Counter(
+    'launcher_prepull_retired_total',
+    'Images no longer pre-pulled, by reason.',
+    ['reason']
+)
+
+# pre-spawn metrics
+PRESPAWN_SERVERS = metrics.Counter(
+    'launcher_prespawn_servers_total',
+    'Students of scheduled sessions handled by the pre-spawn ramp, by outcome.',
+    ['outcome']
+)
+PRESPAWN_CLAIMS = metrics.Counter(
+    'launcher_prespawn_claims_total',
+    'Launches that found a pre-spawned server, by its state, replaced ones were started for another image.',
+    ['outcome']
+)
+PRESPAWN_CULLED = metrics.Counter(
+    'launcher_prespawn_culled_total',
+    'Pre-spawned servers no launch claimed, stopped after the grace period, by outcome.',
+    ['outcome']
+)
+
+def setup_logger(config):
+    # records are written by a background thread, see moop_common.logs
+    return setup_logging(
+        logger,
+        config['LOG_LEVEL'],
+        LOG_FORMAT,
+        style=config['LOG_STYLE'],
+        queue_size=config['LOG_QUEUE_SIZE'],
+        rate=config['LOG_RATE_LIMIT'],
+        burst=config['LOG_RATE_BURST'],
+        sample_every=config['LOG_SAMPLE_EVERY']
+    )
+
+# configs from envs, read by create_app
+def load_settings():
+    settings = {
+        'STATUS_CHECK_INTERVAL': int(os.getenv('STATUS_CHECK_INTERVAL', '')),
+        'STATUS_CHECK_COUNT': int(os.getenv('STATUS_CHECK_COUNT', '')),
+        'LOG_LEVEL': int(os.getenv('LOG_LEVEL', '')),
+        'LOG_STYLE': os.getenv('LOG_STYLE', 'json').strip(),
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        'LOG_RATE_LIMIT': float(os.getenv('LOG_RATE_LIMIT', '5')),
+        'LOG_RATE_BURST': int(os.getenv('LOG_RATE_BURST', '20')),
+        'LOG_SAMPLE_EVERY': int(os.getenv('LOG_SAMPLE_EVERY', '100')),
+        'JUPYTERHUB_SERVICE_PREFIX': os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '/').strip(),
+        'JUPYTERHUB_URL': os.getenv('JUPYTERHUB_URL', '').strip(),
+        'JUPYTERHUB_API_PREFIX': os.getenv('JUPYTERHUB_API_PREFIX', '').strip(),
+        'JUPYTERHUB_API_TOKEN': os.getenv('JUPYTERHUB_API_TOKEN', '').strip(),
+        'USER_TOKEN_LIFETIME': int(os.getenv('USER_TOKEN_LIFETIME').strip()),
+        'JUPYTERHUB_HUBS': os.getenv('JUPYTERHUB_HUBS', '').strip(),
+        'JUPYTERHUB_HUB_TOKENS': os.getenv('JUPYTERHUB_HUB_TOKENS', '').strip(),
+        'HUB_PLACEMENT': os.getenv('HUB_PLACEMENT', 'hash').strip(),
+        'HUB_RING_REPLICAS': int(os.getenv('HUB_RING_REPLICAS', '64')),
+        'HUB_LOAD_INTERVAL': float(os.getenv('HUB_LOAD_INTERVAL', '10')),
+        'HUB_POOL_SIZE': int(os.getenv('HUB_POOL_SIZE', '32')),
+        'BREAKER_FAILURE_THRESHOLD': int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5')),
+        'BREAKER_RECOVERY_TIMEOUT': float(os.getenv('BREAKER_RECOVERY_TIMEOUT', '30')),
+        'TRACE_EXPORTER': os.getenv('TRACE_EXPORTER', 'none').strip(),
+        'TRACE_FILE': os.getenv('TRACE_FILE', '').strip(),
+        'TRACE_SAMPLE_RATIO': float(os.getenv('TRACE_SAMPLE_RATIO', '1')),
+        'PROFILING_TOKEN': os.getenv('PROFILING_TOKEN', '').strip(),
+        'PROFILING_DIR': os.getenv('PROFILING_DIR', '').strip(),
+        'PROFILING_MAX_SECONDS': float(os.getenv('PROFILING_MAX_SECONDS', '60')),
+        'RECORD_DIR': os.getenv('RECORD_DIR', '').strip(),
+        'RECORD_SAMPLE_RATIO': float(os.getenv('RECORD_SAMPLE_RATIO', '1')),
+        'RECORD_SALT': os.getenv('RECORD_SALT', '').strip(),
+        'CULL_MAX_PARALLELISM': int(os.getenv('CULL_MAX_PARALLELISM', '10')),
+        'PREPULL_NAMESPACE': os.getenv('PREPULL_NAMESPACE', '').strip(),
+        'PREPULL_INTERVAL': float(os.getenv('PREPULL_INTERVAL', '30')),
+        'PREPULL_COLD_AFTER': float(os.getenv('PREPULL_COLD_AFTER', '21600')),
+        'PREPULL_MAX_IMAGES': int(os.getenv('PREPULL_MAX_IMAGES', '20')),
+        'PREPULL_PAUSE_IMAGE': os.getenv('PREPULL_PAUSE_IMAGE', 'registry.k8s.io/pause:3.9').strip(),
+        'PREPULL_HELPER_IMAGE': os.getenv('PREPULL_HELPER_IMAGE', 'busybox:1.36').strip(),
+        'PREPULL_NODE_SELECTOR': dict(
+            item.strip().split('=', 1) for item in os.getenv('PREPULL_NODE_SELECTOR', '').split(',') if item.strip()
+        ),
+        'PRESPAWN_TIMETABLE': os.getenv('PRESPAWN_TIMETABLE', '').strip(),
+        'PRESPAWN_LEAD': float(os.getenv('PRESPAWN_LEAD', '900')),
+        'PRESPAWN_RATE': float(os.getenv('PRESPAWN_RATE', '1')),
+        'PRESPAWN_GRACE': float(os.getenv('PRESPAWN_GRACE', '900')),
+        'PRESPAWN_INTERVAL': float(os.getenv('PRESPAWN_INTERVAL', '10')),
+        'PRESPAWN_LOCK_FILE': os.getenv('PRESPAWN_LOCK_FILE', '').strip(),
+        'VOLUME_CHECK_NAMESPACE': os.getenv('VOLUME_CHECK_NAMESPACE', '').strip(),
+        'VOLUME_CHECK_CACHE_TTL': float(os.getenv('VOLUME_CHECK_CACHE_TTL', '30')),
+        'VOLUME_CHECK_PARALLELISM': int(os.getenv('VOLUME_CHECK_PARALLELISM', '8')),
+        'VOLUME_CHECK_TIMEOUT': float(os.getenv('VOLUME_CHECK_TIMEOUT', '5')),
+        'IDEMPOTENCY_TTL': float(os.getenv('IDEMPOTENCY_TTL', '3600')),
+        'IDEMPOTENCY_MAX_KEYS': int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000')),
+        'KUBE_CONFIG_MODE': os.getenv('KUBE_CONFIG_MODE', 'auto').strip(),
+        'KUBE_REQUEST_TIMEOUT': float(os.getenv('KUBE_REQUEST_TIMEOUT', '20')),
+    }
+
+    # launch polls the hub for up to INTERVAL * COUNT seconds, leave room for the other calls
+    settings['REQUEST_DEADLINE'] = float(os.getenv(
+        'REQUEST_DEADLINE',
+        settings['STATUS_CHECK_INTERVAL'] * settings['STATUS_CHECK_COUNT'] + 60
+    ))
+
+    return settings
 
-    logger = logging.getLogger(LOG_NAME)
-    logger.addHandler(handler)
-    logger.setLevel(level)
+bp = Blueprint('launcher-service', __name__)
 
-    return logger
+@bp.before_app_request
+def start_request_deadline():
+    g.deadline_token = start_deadline(
+        parse_deadline_header(request.headers.get(DEADLINE_HEADER), current_app.config['REQUEST_DEADLINE'])
+    )
 
-logger = setup_logger(int(LOG_LEVEL))
+@bp.teardown_app_request
+def clear_request_deadline(exc):
+    clear_deadline(g.pop('deadline_token', None))
 
-logger.info('\n*** Launcher-Service ***\n\nGot envs:\nSTATUS_CHECK_INTERVAL: {}\nSTATUS_CHECK_COUNT: {}\nLOG_LEVEL: {}\nJUPYTERHUB_SERVICE_PREFIX: {}\nJUPYTERHUB_URL: {}\nJUPYTERHUB_API_PREFIX: {}\nJUPYTERHUB_API_TOKEN: {}\n'.format(
-    LAUNCH_STATUS_INTERVAL,
-    LAUNCH_STATUS_CHECK_COUNT,
-    LOG_LEVEL,
-    service_prefix,
-    hub_url,
-    hub_api_prefix,
-    hub_api_token
-))
+@bp.app_errorhandler(CircuitOpenError)
+def upstream_unavailable(e):
+    logger.warning('Circuit Open: %s', e)
+    return Response(
+        json.dumps({'error': '{} is unavailable'.format(e.name)}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        headers={'Retry-After': str(int(math.ceil(e.retry_after)))},
+        status=503
+    )
 
-app = Flask(__name__)
+@bp.app_errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    logger.error('Deadline Error: %s', e)
+    return Response(
+        json.dumps({'error': 'Request deadline exceeded'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=504
+    )
 
-def request_api(session, url, *args, method='get', **kwargs):
+def hub_operation(method, url):
+    """Operation label for url, with user and server names left out"""
+    parts = url.split('/')
+    if len(parts) > 1 and parts[0] == 'users':
+        parts[1] = '{user}'
+    if len(parts) > 3 and parts[2] in ('server', 'servers'):
+        parts[3] = '{server}'
+
+    return '{} {}'.format(method.upper(), '/'.join(parts))
+
+def request_api(hub, url, *args, method='get', timeout=REQUEST_TIMEOUT, **kwargs):
+    session = hub.session
     headers = {
-        'Authorization': 'token {}'.format(hub_api_token)
+        'Authorization': 'token {}'.format(hub.token)
     }
 
-    if method == 'get':
-        resp = session.get(
-            '{}/{}'.format(hub_api_url, url),
-            headers=headers,
-            timeout=REQUEST_TIMEOUT,
-            *args, **kwargs
-        )
-    elif method == 'post':
-        resp = session.post(
-            '{}/{}'.format(hub_api_url, url),
-            headers=headers,
-            timeout=REQUEST_TIMEOUT,
-            **kwargs
-        )
-    elif method == 'delete':
-        resp = session.delete(
-            '{}/{}'.format(hub_api_url, url),
-            headers=headers,
-            timeout=REQUEST_TIMEOUT,
-            **kwargs
-        )
+    with upstream(
+        hub.upstream,
+        hub_operation(method, url),
+        timeout=timeout,
+        is_failure=is_request_failure
+    ) as call:
+        # a hub with tracing joins the launch trace
+        headers = tracing.inject(headers)
+
+        if method == 'get':
+            resp = session.get(
+                '{}/{}'.format(hub.api_url, url),
+                headers=headers,
+                timeout=call.timeout,
+                *args, **kwargs
+            )
+        elif method == 'post':
+            resp = session.post(
+                '{}/{}'.format(hub.api_url, url),
+                headers=headers,
+                timeout=call.timeout,
+                **kwargs
+            )
+        elif method == 'delete':
+            resp = session.delete(
+                '{}/{}'.format(hub.api_url, url),
+                headers=headers,
+                timeout=call.timeout,
+                **kwargs
+            )
+
+        if resp.status_code >= 500:
+            call.fail()
 
     if (method == 'get') and (resp.status_code != 404): # allow GET 404
         resp.raise_for_status()
 
     return resp
 
+class Hub(object):
+    """One jupyterhub, with its own connection pool and circuit breaker"""
+
+    def __init__(self, name, url, api_prefix, token, upstream_name=HUB_UPSTREAM, pool_size=32):
+        self.name = name
+        # public url, notebook endpoints live under it
+        self.url = url
+        self.api_url = '{}{}'.format(url, api_prefix)
+        self.token = token
+        self.upstream = upstream_name
+        self.pool_size = pool_size
+
+        # from the last load poll, and the users placed here since
+        self.active = 0
+        self.pending = 0
+        self.placed = 0
+
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        # a forked worker gets its own pool
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session, self._pid = session, os.getpid()
+
+        return self._session
+
+    @property
+    def healthy(self):
+        return resilience.get_breaker(self.upstream).state != resilience.OPEN
+
+    @property
+    def load(self):
+        return self.active + self.pending + self.placed
+
+class HubRouter(object):
+    """Routes users to hubs.
+
+    A user goes to the hub owning it on a consistent hash ring. With
+    least-loaded placement a new user goes to the healthy hub with the fewest
+    active and pending servers instead, found by polling every hub's /users
+    in the background, and existing users are looked up on the hubs.
+    """
+
+    def __init__(self, hubs, placement='hash', replicas=64, load_interval=10.0):
+        self.hubs = {hub.name: hub for hub in hubs}
+        self.ring = HashRing(self.hubs, replicas=replicas)
+        self.least_loaded = placement == 'least-loaded' and len(hubs) > 1
+        self.load_interval = load_interval
+
+        # user -> (hub name, monotonic time it was seen by the load poll or placed here)
+        self._users = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pid = None
+
+    def __iter__(self):
+        return iter(self.hubs.values())
+
+    def owner(self, username):
+        return self.hubs[self.ring.get(username)]
+
+    def _remember(self, username, hub):
+        if self.least_loaded:
+            with self._lock:
+                self._users[username] = (hub.name, time.monotonic())
+
+    def _candidates(self, username):
+        if not self.least_loaded:
+            return [self.owner(username)]
+
+        self._ensure_started()
+        known = self._users.get(username, (None, 0.0))[0]
+        names = self.ring.preference(username)
+        if known in names:
+            names.remove(known)
+            names.insert(0, known)
+        return [self.hubs[name] for name in names]
+
+    def find_user(self, username):
+        """Returns (hub, user model) from the hub that has username, (None, None) if none has it"""
+        for hub in self._candidates(username):
+            user_data = request_api(hub, 'users/{}'.format(username)).json()
+            if user_data.get('status') != 404:
+                self._remember(username, hub)
+                return hub, user_data
+
+        return None, None
+
+    def hub_for(self, username):
+        """Returns the hub of an existing user, its ring owner if no hub has it"""
+        if self.least_loaded:
+            hub, user_data = self.find_user(username)
+            if hub is not None:
+                return hub
+
+        return self.owner(username)
+
+    def place(self, username):
+        """Returns the hub a new user is created on"""
+        hub = self.owner(username)
+        if self.least_loaded:
+            healthy = [candidate for candidate in self._candidates(username) if candidate.healthy]
+            # ties go to the ring order
+            if healthy:
+                hub = min(healthy, key=lambda candidate: candidate.load)
+
+        with self._lock:
+            hub.placed += 1
+        self._remember(username, hub)
+        HUB_PLACEMENTS.labels(hub.name).inc()
+
+        return hub
+
+    # load polling
+    def _ensure_started(self):
+        # a forked worker starts its own poller
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name='launcher-hub-load', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            for hub in self:
+                try:
+                    self.poll(hub)
+                except CircuitOpenError:
+                    pass
+                except Exception as e:
+                    logger.warning('Hub load poll of %s failed: %s', hub.name, e)
+
+            if self._stop.wait(self.load_interval):
+                return
+
+    def stop(self):
+        self._stop.set()
+
+    def poll(self, hub):
+        started = time.monotonic()
+        users = request_api(hub, 'users', timeout=max(self.load_interval, 1)).json()
+
+        active = pending = 0
+        for user in users:
+            for server in (user.get('servers') or {}).values():
+                if server.get('pending') == 'spawn':
+                    pending += 1
+                elif server.get('ready'):
+                    active += 1
+
+        with self._lock:
+            # the hub's entries are replaced, so deleted users drop out, users placed
+            # since the list was asked for may not be in it yet and stay
+            users_here = {user['name'] for user in users}
+            self._users = {
+                username: (name, seen) for username, (name, seen) in self._users.items()
+                if name != hub.name or username in users_here or seen >= started
+            }
+            for username in users_here:
+                if self._users.get(username, (None, 0.0))[1] < started:
+                    self._users[username] = (hub.name, started)
+            hub.active, hub.pending, hub.placed = active, pending, 0
+        HUB_SERVERS.labels(hub.name, 'active').set(active)
+        HUB_SERVERS.labels(hub.name, 'pending').set(pending)
+
+def parse_hubs(value):
+    # name=url,name=url
+    hubs = []
+    for item in value.split(','):
+        if item.strip():
+            name, url = item.split('=', 1)
+            hubs.append((name.strip(), url.strip()))
+
+    return hubs
+
+def create_hub_router(config):
+    if config['HUB_PLACEMENT'] not in ('hash', 'least-loaded'):
+        raise ValueError('unknown hub placement: {}'.format(config['HUB_PLACEMENT']))
+
+    if not config['JUPYTERHUB_HUBS']:
+        hubs = [Hub(
+            HUB_UPSTREAM,
+            config['JUPYTERHUB_URL'],
+            config['JUPYTERHUB_API_PREFIX'],
+            config['JUPYTERHUB_API_TOKEN'],
+            pool_size=config['HUB_POOL_SIZE']
+        )]
+    else:
+        tokens = dict(parse_hubs(config['JUPYTERHUB_HUB_TOKENS']))
+        hubs = [
+            Hub(
+                name,
+                url,
+                config['JUPYTERHUB_API_PREFIX'],
+                tokens.get(name, config['JUPYTERHUB_API_TOKEN']),
+                upstream_name='{}-{}'.format(HUB_UPSTREAM, name),
+                pool_size=config['HUB_POOL_SIZE']
+            )
+            for name, url in parse_hubs(config['JUPYTERHUB_HUBS'])
+        ]
+
+    return HubRouter(
+        hubs,
+        placement=config['HUB_PLACEMENT'],
+        replicas=config['HUB_RING_REPLICAS'],
+        load_interval=config['HUB_LOAD_INTERVAL']
+    )
+
+def hub_router():
+    return current_app.extensions['launcher_hubs']
+
+def expand_vols(vols):
+    # vols: [{'pvc': claim name, 'mount': mount path}]
+    vol_names = [str(uuid.uuid4()) for vol in vols]
+    volumes = []
+    volume_mounts = []
+
+    for i, vol in enumerate(vols):
+        volumes.append({
+            'name': vol_names[i],
+            'persistentVolumeClaim': {
+                'claimName': vol['pvc']
+            }
+        })
+
+        volume_mounts.append({
+            'name': vol_names[i],
+            'mountPath': vol['mount']
+        })
+
+    return volumes, volume_mounts
+
+# volume pre-flight
+# claim states a spawn cannot get past
+VOLUME_NOT_READY = ('missing', 'unbound', 'lost', 'terminating')
+
+class VolumeChecker(object):
+    """Checks the claims a launch mounts before the spawn.
+
+    A server mounting a missing or unbound claim stays pending until
+    STATUS_CHECK_COUNT runs out, the check fails the launch in one round
+    trip instead. Claims are read concurrently, a claim found bound is not
+    read again for cache_ttl seconds. A claim that could not be read does
+    not fail the launch, the spawn finds out as it did before.
+    """
+
+    def __init__(self, namespace, cache_ttl=30.0, parallelism=8, timeout=5.0, max_cached=10000):
+        self.namespace = namespace
+        self.cache_ttl = cache_ttl
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.max_cached = max_cached
+
+        # key -> expiry, of the bound claims and the storage classes that bind on first use
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, key):
+        with self._lock:
+            expires_at = self._cache.get(key)
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._cache[key]
+                expires_at = None
+        return expires_at is not None
+
+    def _remember(self, key):
+        with self._lock:
+            if len(self._cache) >= self.max_cached:
+                now = time.monotonic()
+                self._cache = {item: expires_at for item, expires_at in self._cache.items() if expires_at > now}
+                if len(self._cache) >= self.max_cached:
+                    return
+            self._cache[key] = time.monotonic() + self.cache_ttl
+
+    def _binds_on_first_use(self, storage_class):
+        key = ('storageclass', storage_class)
+        if self._cached(key):
+            return True
+
+        try:
+            binding = kube.call_json(
+                kube.storage_v1(),
+                'read_storage_class',
+                storage_class,
+                timeout=self.timeout
+            ).get('volumeBindingMode')
+        except kube.ApiException as e:
+            if e.status != 404:
+                raise
+            return False
+
+        if binding == 'WaitForFirstConsumer':
+            self._remember(key)
+            return True
+        return False
+
+    def claim_status(self, claim):
+        """Returns (status, message) of a claim, status is bound, cached or one of VOLUME_NOT_READY, unknown if it could not be read"""
+        if self._cached(('claim', claim)):
+            return 'cached', None
+
+        try:
+            pvc = kube.call_json(
+                kube.core_v1(),
+                'read_namespaced_persistent_volume_claim',
+                claim,
+                self.namespace,
+                timeout=self.timeout
+            )
+            if pvc['metadata'].get('deletionTimestamp'):
+                return 'terminating', 'claim {} is being deleted'.format(claim)
+
+            phase = (pvc.get('status') or {}).get('phase')
+            if phase == 'Lost':
+                return 'lost', 'claim {} lost its volume'.format(claim)
+            if phase != 'Bound':
+                # a claim of a WaitForFirstConsumer class binds when the server's pod is scheduled
+                storage_class = (pvc.get('spec') or {}).get('storageClassName')
+                if not storage_class or not self._binds_on_first_use(storage_class):
+                    return 'unbound', 'claim {} is {}, no volume is bound to it'.format(claim, phase or 'Pending')
+        except kube.ApiException as e:
+            if e.status == 404:
+                return 'missing', 'claim {} does not exist in namespace {}'.format(claim, self.namespace)
+            logger.warning('Volume check of %s failed: %s', claim, e)
+            return 'unknown', str(e.reason)
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            return 'unknown', str(e)
+
+        self._remember(('claim', claim))
+        return 'bound', None
+
+    def check(self, claims):
+        """Returns the status of each claim, [{'pvc', 'status', 'message'}], in their order"""
+        statuses = {}
+        pending = []
+        for claim in dict.fromkeys(claims):
+            if self._cached(('claim', claim)):
+                statuses[claim] = ('cached', None)
+            else:
+                pending.append(claim)
+
+        if len(pending) == 1:
+            statuses[pending[0]] = self.claim_status(pending[0])
+        elif pending:
+            with ThreadPoolExecutor(max_workers=min(self.parallelism, len(pending))) as executor:
+                # each read runs in its own copy of the context, keeping the deadline and the trace
+                futures = {
+                    claim: executor.submit(contextvars.copy_context().run, self.claim_status, claim)
+                    for claim in pending
+                }
+                for claim, future in futures.items():
+                    statuses[claim] = future.result()
+
+        results = []
+        for claim in claims:
+            status, message = statuses[claim]
+            VOLUME_CHECKS.labels(status).inc()
+            results.append({'pvc': claim, 'status': status, 'message': message})
+        return results
+
 def get_launch_params(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -103,26 +670,10 @@ def get_launch_params(f):
                 mimetype='application/json',
             )
         server_name = body['server_name'] if 'server_name' in body.keys() else ''
+        tenant = body['tenant'] if 'tenant' in body.keys() else None
 
         if 'vols' in body.keys():
-            vols = body['vols']
-
-            vol_names = [str(uuid.uuid4()) for vol in vols]
-            volumes = []
-            volume_mounts = []
-
-            for i, vol in enumerate(vols):
-                volumes.append({
-                    'name': vol_names[i],
-                    'persistentVolumeClaim': {
-                        'claimName': vol['pvc']
-                    }
-                })
-
-                volume_mounts.append({
-                    'name': vol_names[i],
-                    'mountPath': vol['mount']
-                })
+            volumes, volume_mounts = expand_vols(body['vols'])
         else:
             volumes = None
             volume_mounts = None
@@ -132,6 +683,7 @@ def get_launch_params(f):
             body['username'],
             *args,
             server_name=server_name,
+            tenant=tenant,
             volumes=volumes,
             volume_mounts=volume_mounts,
             **kwargs
@@ -139,40 +691,84 @@ def get_launch_params(f):
 
     return decorated
 
-@app.route('{}{}'.format(service_prefix, 'containers'), methods=['POST'])
+@bp.route('/containers', methods=['POST'])
+@idempotency.idempotent
 @get_launch_params
-def launch(image, username, server_name='', volumes=None, volume_mounts=None):
+def launch(image, username, server_name='', tenant=None, volumes=None, volume_mounts=None):
     try:
-        session = requests.Session()
+        hubs = hub_router()
+
+        # only noted here, the nodes pull in the background
+        prepuller = current_app.extensions.get('launcher_prepull')
+        if prepuller is not None:
+            prepuller.demand(image)
+
+        # fail now rather than after STATUS_CHECK_COUNT polls of a server that cannot start
+        checker = current_app.extensions.get('launcher_volumes')
+        if checker is not None and volumes:
+            with tracing.span('kube.check_volumes', volumes=len(volumes)), VOLUME_CHECK_SECONDS.labels().time():
+                checked = checker.check([volume['persistentVolumeClaim']['claimName'] for volume in volumes])
+            not_ready = [
+                dict(volume, mount=mount['mountPath'])
+                for volume, mount in zip(checked, volume_mounts)
+                if volume['status'] in VOLUME_NOT_READY
+            ]
+            if not_ready:
+                return Response(
+                    json.dumps(
+                        {'error': 'volumes are not ready', 'volumes': not_ready},
+                        indent=1,
+                        sort_keys=True
+                    ),
+                    status=400,
+                    mimetype='application/json'
+                )
 
         # named server not enabled
         # just check if the user has a running server ''
+        claimed = None
         if server_name == '':
-            user_data = request_api(session, 'users/{}'.format(username)).json()
-            
-            if 'status' in user_data and user_data['status'] == 404:
-                new_user = request_api(session, 'users/{}'.format(username), method='post').json()
-            elif 'servers' in user_data.keys() and server_name in user_data['servers'].keys():
-                    return Response(
-                        json.dumps(
-                            {'error': '{} already has a running server'.format(username)},
-                            indent=1,
-                            sort_keys=True
-                        ),
-                        status=400,
-                        mimetype='application/json'
-                    )
+            with tracing.span('hub.ensure_user') as span:
+                hub, user_data = hubs.find_user(username)
 
-        user_token_resp = request_api(
-            session,
-            'users/{}/tokens'.format(username),
-            method='post',
-            json={
-                'note': 'launcher_token',
-                'expires_in': user_token_lifetime
-            }
-        ).json()
-        print(user_token_resp)
+                if hub is None:
+                    hub = hubs.place(username)
+                    new_user = request_api(hub, 'users/{}'.format(username), method='post').json()
+                elif 'servers' in user_data.keys() and server_name in user_data['servers'].keys():
+                    server = user_data['servers'][server_name]
+                    if prespawned_session(server) is None or server.get('pending') == 'stop':
+                        return Response(
+                            json.dumps(
+                                {'error': '{} already has a running server'.format(username)},
+                                indent=1,
+                                sort_keys=True
+                            ),
+                            status=400,
+                            mimetype='application/json'
+                        )
+
+                    if matches_launch(server, image, tenant, volumes, volume_mounts):
+                        # started ahead of the student's session, handed over as it is
+                        claimed = server
+                    else:
+                        # started for another image, make room for the one asked for
+                        release_prespawned(hub, username)
+
+                if span is not None:
+                    span.set_attribute('hub', hub.name)
+        else:
+            hub = hubs.hub_for(username)
+
+        with tracing.span('hub.mint_token'), TOKEN_MINT_SECONDS.labels().time():
+            user_token_resp = request_api(
+                hub,
+                'users/{}/tokens'.format(username),
+                method='post',
+                json={
+                    'note': LAUNCH_TOKEN_NOTE,
+                    'expires_in': current_app.config['USER_TOKEN_LIFETIME']
+                }
+            ).json()
         user_token = user_token_resp['token']
         
         data = {
@@ -182,51 +778,71 @@ def launch(image, username, server_name='', volumes=None, volume_mounts=None):
             'volumes': volumes,
             'volume_mounts': volume_mounts
         }
+        if tenant is not None:
+            # kept in the server's user_options, cull selects by it
+            data['tenant'] = tenant
 
         # call jupyterhub api to launch server
-        server_resp = request_api(
-            session,
-            'users/{}/servers/{}'.format(username, server_name),
-            method='post',
-            json=data
-        )
+        spawn_start = time.perf_counter()
+        if claimed is None:
+            with tracing.span('hub.spawn', image=image) as span:
+                server_resp = request_api(
+                    hub,
+                    'users/{}/servers/{}'.format(username, server_name),
+                    method='post',
+                    json=data
+                )
+                if span is not None:
+                    span.set_attribute('status', server_resp.status_code)
+        else:
+            PRESPAWN_CLAIMS.labels('ready' if claimed.get('ready') else 'pending').inc()
 
-        # wait for the server to start
-        if server_resp.status_code == 202:
-            for i in range(LAUNCH_STATUS_CHECK_COUNT):
-                user_data = request_api(
-                    session,
-                    'users/{}'.format(username)
-                ).json()
-
-                logger.debug(user_data)
-
-                if server_name in user_data['servers'].keys():
-                    if user_data['servers'][server_name]['ready']:
-                        # return container endpoint
-                        data['url'] = '{}/user/{}/{}'.format(
-                            hub_url,
-                            username,
-                            server_name
-                        )
-                        data['token'] = user_token
+        # wait for the server to start, a claimed one is usually ready at the first check
+        if claimed is not None or server_resp.status_code == 202:
+            with tracing.span('hub.wait_ready') as span:
+                for i in range(current_app.config['STATUS_CHECK_COUNT']):
+                    if span is not None:
+                        span.set_attribute('polls', i + 1)
 
-                        return Response(
-                            json.dumps(
-                                data,
-                                indent=1,
-                                sort_keys=True
-                            ),
-                            status=200,
-                            mimetype='application/json'
-                        )
-                else:
-                    raise ChildProcessError('launch failed')
+                    user_data = request_api(
+                        hub,
+                        'users/{}'.format(username)
+                    ).json()
 
-                time.sleep(LAUNCH_STATUS_INTERVAL)
+                    logger.debug(
+                        'Waiting for server %s/%s, check %d: %s',
+                        username, server_name, i, user_data['servers'].get(server_name)
+                    )
+
+                    if server_name in user_data['servers'].keys():
+                        if user_data['servers'][server_name]['ready']:
+                            LAUNCH_READY_SECONDS.labels(image).observe(time.perf_counter() - spawn_start)
+                            LAUNCH_POLLS.labels().observe(i + 1)
+
+                            # return container endpoint
+                            data['url'] = '{}/user/{}/{}'.format(
+                                hub.url,
+                                username,
+                                server_name
+                            )
+                            data['token'] = user_token
+
+                            return Response(
+                                json.dumps(
+                                    data,
+                                    indent=1,
+                                    sort_keys=True
+                                ),
+                                status=200,
+                                mimetype='application/json'
+                            )
+                    else:
+                        raise ChildProcessError('launch failed')
+
+                    resilience.sleep(current_app.config['STATUS_CHECK_INTERVAL'])
     except requests.exceptions.RequestException as e:
         # there might be something wrong with jupyterhub or network
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
                 json.dumps(
                     {'error': 'Request to jupyterhub API failed.'},
@@ -238,7 +854,7 @@ def launch(image, username, server_name='', volumes=None, volume_mounts=None):
             )
     except ChildProcessError as e:
         # cannot properly start a container
-        logger.error('Container Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.error('Container Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Jupyterhub container launch failed.'},
@@ -248,9 +864,12 @@ def launch(image, username, server_name='', volumes=None, volume_mounts=None):
             status=500,
             mimetype='application/json'
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Launcher service failed.'},
@@ -261,10 +880,9 @@ def launch(image, username, server_name='', volumes=None, volume_mounts=None):
             mimetype='application/json'
         )
 
-@app.route('{}{}'.format(service_prefix, 'containers'), methods=['GET'])
+@bp.route('/containers', methods=['GET'])
 def read_container():
     try:
-        session = requests.Session()
         body = request.args
 
         if 'username' not in body.keys():
@@ -275,7 +893,9 @@ def read_container():
         username = body['username']
         server_name = body['server_name'] if 'server_name' in body.keys() else ''
 
-        user_data = request_api(session, 'users/{}'.format(username)).json()
+        hub, user_data = hub_router().find_user(username)
+        if hub is None:
+            user_data = {'servers': {}}
 
         if server_name in user_data['servers'].keys():
             return Response(
@@ -290,7 +910,7 @@ def read_container():
             )
     except requests.exceptions.RequestException as e:
         # there might be something wrong with jupyterhub or network
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
                 json.dumps(
                     {'error': 'Request to jupyterhub API failed.'},
@@ -300,9 +920,12 @@ def read_container():
                 status=500,
                 mimetype='application/json'
             )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Launcher service failed.'},
@@ -313,10 +936,9 @@ def read_container():
             mimetype='application/json'
         )
 
-@app.route('{}{}'.format(service_prefix, 'containers'), methods=['DELETE'])
+@bp.route('/containers', methods=['DELETE'])
 def remove_container():
     try:
-        session = requests.Session()
         body = request.args
 
         if 'username' not in body.keys():
@@ -327,15 +949,16 @@ def remove_container():
         username = body['username']
         server_name = body['server_name'] if 'server_name' in body.keys() else ''
 
+        hub = hub_router().hub_for(username)
         if server_name == '':
-            server_resp = request_api(session, 'users/{}/server'.format(username), method='delete')
+            server_resp = request_api(hub, 'users/{}/server'.format(username), method='delete')
         else:
-            server_resp = request_api(session, 'users/{}/server/{}'.format(username, server_name), method='delete')
+            server_resp = request_api(hub, 'users/{}/server/{}'.format(username, server_name), method='delete')
 
         return Response(status=200)
     except requests.exceptions.RequestException as e:
         # there might be something wrong with jupyterhub or network
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Request to jupyterhub API failed.'},
@@ -345,9 +968,12 @@ def remove_container():
             status=500,
             mimetype='application/json'
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Launcher service failed.'},
@@ -357,4 +983,1060 @@ def remove_container():
             status=500,
             mimetype='application/json'
         )
-        
\ No newline at end of file
+
+def parse_hub_time(value):
+    # eg. 2019-03-15T03:01:17.012565Z, always utc
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def select_idle_servers(users, now, max_idle_seconds=None, image=None, tenant=None):
+    """Returns the running servers in a hub /users answer matching all the given filters"""
+    selected = []
+    for user in users:
+        for server_name, server in (user.get('servers') or {}).items():
+            # a spawn or stop in progress is left alone
+            if server.get('pending'):
+                continue
+
+            options = server.get('user_options') or {}
+            if image is not None and options.get('image') != image:
+                continue
+            if tenant is not None and options.get('tenant') != tenant:
+                continue
+
+            last_activity = server.get('last_activity') or server.get('started')
+            idle_seconds = now - parse_hub_time(last_activity) if last_activity else None
+            if max_idle_seconds is not None and (idle_seconds is None or idle_seconds < max_idle_seconds):
+                continue
+
+            selected.append({
+                'username': user['name'],
+                'server_name': server_name,
+                'image': options.get('image'),
+                'tenant': options.get('tenant'),
+                'last_activity': last_activity,
+                'idle_seconds': idle_seconds,
+            })
+
+    return selected
+
+def stop_server(hub, server):
+    # runs on a cull worker thread, in a copy of the request's context
+    try:
+        if server['server_name'] == '':
+            url = 'users/{}/server'.format(server['username'])
+        else:
+            url = 'users/{}/server/{}'.format(server['username'], server['server_name'])
+        resp = request_api(hub, url, method='delete')
+
+        if resp.status_code == 204:
+            server['outcome'] = 'stopped'
+        elif resp.status_code == 202:
+            # the hub keeps stopping it in the background
+            server['outcome'] = 'stopping'
+        else:
+            server['outcome'] = 'failed'
+            server['error'] = 'jupyterhub answered {}'.format(resp.status_code)
+    except CircuitOpenError as e:
+        server['outcome'] = 'failed'
+        server['error'] = '{} is unavailable'.format(e.name)
+    except DeadlineExceeded:
+        server['outcome'] = 'failed'
+        server['error'] = 'Request deadline exceeded'
+    except requests.exceptions.RequestException as e:
+        logger.error('Request Error: %s', e)
+        server['outcome'] = 'failed'
+        server['error'] = 'Request to jupyterhub API failed.'
+
+    CULLED_SERVERS.labels(server['outcome']).inc()
+    return server
+
+def get_cull_params(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        body = request.get_json(silent=True) or {}
+
+        max_idle_seconds = body.get('max_idle_seconds')
+        image = body.get('image')
+        tenant = body.get('tenant')
+        if max_idle_seconds is None and image is None and tenant is None:
+            # never stop every server on the hub by accident
+            return Response(
+                json.dumps({'error': 'no max_idle_seconds, image or tenant parameter specified'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+
+        try:
+            if max_idle_seconds is not None:
+                max_idle_seconds = float(max_idle_seconds)
+            parallelism = int(body.get('parallelism', current_app.config['CULL_MAX_PARALLELISM']))
+        except (TypeError, ValueError):
+            return Response(
+                json.dumps({'error': 'max_idle_seconds and parallelism must be numbers'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+
+        return f(
+            *args,
+            max_idle_seconds=max_idle_seconds,
+            image=image,
+            tenant=tenant,
+            dry_run=bool(body.get('dry_run', False)),
+            parallelism=max(1, min(parallelism, current_app.config['CULL_MAX_PARALLELISM'])),
+            **kwargs
+        )
+
+    return decorated
+
+@bp.route('/containers/cull', methods=['POST'])
+@get_cull_params
+def cull_containers(max_idle_seconds=None, image=None, tenant=None, dry_run=False, parallelism=1):
+    try:
+        hubs = hub_router()
+
+        # one listing of every user and server per hub instead of a call per user
+        servers = []
+        with tracing.span('hub.list_users'):
+            for hub in hubs:
+                users = request_api(hub, 'users').json()
+                for server in select_idle_servers(users, time.time(), max_idle_seconds, image, tenant):
+                    server['hub'] = hub.name
+                    servers.append(server)
+
+        if dry_run:
+            for server in servers:
+                server['outcome'] = 'would_stop'
+        elif servers:
+            with tracing.span('hub.cull', servers=len(servers), parallelism=parallelism):
+                with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                    # each stop runs in its own copy of the context, keeping the deadline and the trace
+                    futures = [
+                        executor.submit(contextvars.copy_context().run, stop_server, hubs.hubs[server['hub']], server)
+                        for server in servers
+                    ]
+                    for future in futures:
+                        future.result()
+
+        outcomes = {}
+        for server in servers:
+            outcomes[server['outcome']] = outcomes.get(server['outcome'], 0) + 1
+        logger.info('Culled %d servers (dry run: %s): %s', len(servers), dry_run, outcomes)
+
+        return Response(
+            json.dumps(
+                {'dry_run': dry_run, 'outcomes': outcomes, 'servers': servers},
+                indent=1,
+                sort_keys=True
+            ),
+            status=200,
+            mimetype='application/json'
+        )
+    except requests.exceptions.RequestException as e:
+        # there might be something wrong with jupyterhub or network
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Request to jupyterhub API failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Launcher service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+
+# image pre-pull
+MANAGED_BY_LABEL = 'moop.io/managed-by'
+MANAGED_BY = 'launcher-service'
+PREPULL_LABEL = 'moop.io/prepull'
+IMAGE_ANNOTATION = 'moop.io/image'
+LAST_DEMAND_ANNOTATION = 'moop.io/last-demand'
+PULL_FAILED_REASONS = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'ErrImageNeverPull')
+# the image is on the node once its container was created, even if it cannot run there
+PULL_DONE_REASONS = ('CrashLoopBackOff', 'RunContainerError', 'CreateContainerError', 'StartError')
+PREPULL_BIN = '/moop-prepull'
+
+def prepull_key(image):
+    # image references do not fit label values
+    return hashlib.sha1(image.encode()).hexdigest()[:12]
+
+def prepull_name(image):
+    return 'prepull-{}'.format(prepull_key(image))
+
+def pull_state(pod):
+    # the pull init container is what pulls the image, the main one only holds the node
+    statuses = {
+        status.get('name'): status
+        for status in (pod.get('status') or {}).get('initContainerStatuses') or []
+    }
+    for status in statuses.values():
+        if ((status.get('state') or {}).get('waiting') or {}).get('reason') in PULL_FAILED_REASONS:
+            return 'failed'
+
+    status = statuses.get('pull')
+    if status is None:
+        return 'pulling'
+
+    # a pull container that fails or crash-loops still has its image pulled
+    state = status.get('state') or {}
+    if status.get('imageID') or 'terminated' in state or 'running' in state:
+        return 'pulled'
+    if (state.get('waiting') or {}).get('reason') in PULL_DONE_REASONS:
+        return 'pulled'
+
+    return 'pulling'
+
+class ImagePrePuller(object):
+    """Keeps the images being launched pulled on every node.
+
+    launch notes each image it starts. A background reconciler keeps a
+    DaemonSet per image, whose init container pulls the image on each node,
+    and records the last demand on it, so every worker sees the images the
+    others launched. Images not launched for cold_after seconds, and the
+    least recent ones beyond max_images, have their DaemonSet deleted.
+    """
+
+    def __init__(self, namespace, interval=30.0, cold_after=21600.0, max_images=20,
+                 pause_image='registry.k8s.io/pause:3.9', helper_image='busybox:1.36', node_selector=None):
+        self.namespace = namespace
+        self.interval = interval
+        self.cold_after = cold_after
+        self.max_images = max_images
+        self.pause_image = pause_image
+        self.helper_image = helper_image
+        self.node_selector = node_selector or {}
+
+        # image -> last launch, since the last reconcile
+        self._demand = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def demand(self, image):
+        with self._lock:
+            self._demand[image] = time.time()
+        self._ensure_started()
+
+    def _ensure_started(self):
+        # a forked worker starts its own reconciler
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            threading.Thread(target=self._run, name='launcher-prepull', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reconcile()
+            except CircuitOpenError:
+                pass
+            except Exception as e:
+                logger.warning('Image pre-pull reconcile failed: %s', e)
+
+    def _selector(self, image=None):
+        selector = '{}={}'.format(MANAGED_BY_LABEL, MANAGED_BY)
+        if image is not None:
+            selector += ',{}={}'.format(PREPULL_LABEL, prepull_key(image))
+        return selector
+
+    def daemon_set(self, image, last_demand):
+        labels = {MANAGED_BY_LABEL: MANAGED_BY, PREPULL_LABEL: prepull_key(image)}
+        resources = {'requests': {'cpu': '1m', 'memory': '8Mi'}, 'limits': {'cpu': '100m', 'memory': '64Mi'}}
+
+        return {
+            'apiVersion': 'apps/v1',
+            'kind': 'DaemonSet',
+            'metadata': {
+                'name': prepull_name(image),
+                'labels': labels,
+                'annotations': {
+                    IMAGE_ANNOTATION: image,
+                    LAST_DEMAND_ANNOTATION: str(int(last_demand)),
+                },
+            },
+            'spec': {
+                'selector': {'matchLabels': labels},
+                'updateStrategy': {'type': 'RollingUpdate', 'rollingUpdate': {'maxUnavailable': '100%'}},
+                'template': {
+                    'metadata': {'labels': labels},
+                    'spec': {
+                        'nodeSelector': self.node_selector,
+                        'tolerations': [{'operator': 'Exists'}],
+                        'terminationGracePeriodSeconds': 0,
+                        'automountServiceAccountToken': False,
+                        'volumes': [{'name': 'prepull-bin', 'emptyDir': {}}],
+                        # the image may have no shell, it runs a static busybox copied in as true
+                        'initContainers': [
+                            {
+                                'name': 'helper',
+                                'image': self.helper_image,
+                                'imagePullPolicy': 'IfNotPresent',
+                                'command': ['/bin/cp', '/bin/busybox', '{}/true'.format(PREPULL_BIN)],
+                                'volumeMounts': [{'name': 'prepull-bin', 'mountPath': PREPULL_BIN}],
+                                'resources': resources,
+                            },
+                            {
+                                'name': 'pull',
+                                'image': image,
+                                'imagePullPolicy': 'IfNotPresent',
+                                'command': ['{}/true'.format(PREPULL_BIN)],
+                                'volumeMounts': [{'name': 'prepull-bin', 'mountPath': PREPULL_BIN, 'readOnly': True}],
+                                'resources': resources,
+                            },
+                        ],
+                        'containers': [{
+                            'name': 'pause',
+                            'image': self.pause_image,
+                            'resources': resources,
+                        }],
+                    },
+                },
+            },
+        }
+
+    def ensure(self, image, last_demand=None):
+        """Creates the DaemonSet pulling image, or records a later demand on it"""
+        if last_demand is None:
+            last_demand = time.time()
+        name = prepull_name(image)
+        patch = {'metadata': {'annotations': {LAST_DEMAND_ANNOTATION: str(int(last_demand))}}}
+
+        try:
+            return kube.call_json(
+                kube.apps_v1(),
+                'patch_namespaced_daemon_set',
+                name,
+                self.namespace,
+                patch,
+                _content_type='application/merge-patch+json'
+            )
+        except kube.ApiException as e:
+            if e.status != 404:
+                raise
+
+        try:
+            logger.info('Pre-pulling %s as %s', image, name)
+            return kube.call_json(kube.apps_v1(), 'create_namespaced_daemon_set', self.namespace, self.daemon_set(image, last_demand))
+        except kube.ApiException as e:
+            # created by another worker meanwhile
+            if e.status != 409:
+                raise
+            return kube.call_json(kube.apps_v1(), 'read_namespaced_daemon_set', name, self.namespace)
+
+    def retire(self, image, reason='requested'):
+        """Deletes the DaemonSet pulling image and its pods, False if there was none"""
+        with self._lock:
+            self._demand.pop(image, None)
+
+        try:
+            kube.call_json(
+                kube.apps_v1(),
+                'delete_namespaced_daemon_set',
+                prepull_name(image),
+                self.namespace,
+                propagation_policy='Background'
+            )
+        except kube.ApiException as e:
+            if e.status != 404:
+                raise
+            return False
+
+        logger.info('Retired pre-pull of %s (%s)', image, reason)
+        PREPULL_RETIRED.labels(reason).inc()
+        return True
+
+    def status(self, image=None):
+        """Returns the pre-pulled images with the pull state of each node, the most recently launched first"""
+        daemon_sets = kube.call_json(
+            kube.apps_v1(),
+            'list_namespaced_daemon_set',
+            self.namespace,
+            label_selector=self._selector(image)
+        )['items']
+        pods = kube.call_json(
+            kube.core_v1(),
+            'list_namespaced_pod',
+            self.namespace,
+            label_selector=self._selector(image)
+        )['items']
+
+        nodes = {}
+        for pod in pods:
+            key = (pod['metadata'].get('labels') or {}).get(PREPULL_LABEL)
+            node = (pod.get('spec') or {}).get('nodeName')
+            if node:
+                nodes.setdefault(key, {})[node] = pull_state(pod)
+
+        images = []
+        for daemon_set in daemon_sets:
+            metadata = daemon_set['metadata']
+            states = nodes.get((metadata.get('labels') or {}).get(PREPULL_LABEL), {})
+            counts = {state: 0 for state in ('pulled', 'pulling', 'failed')}
+            for state in states.values():
+                counts[state] += 1
+            images.append({
+                'image': (metadata.get('annotations') or {}).get(IMAGE_ANNOTATION),
+                'name': metadata['name'],
+                'last_demand': int((metadata.get('annotations') or {}).get(LAST_DEMAND_ANNOTATION, 0)),
+                'desired': (daemon_set.get('status') or {}).get('desiredNumberScheduled', 0),
+                'nodes': states,
+                'counts': counts,
+            })
+
+        images.sort(key=lambda item: item['last_demand'], reverse=True)
+        return images
+
+    def reconcile(self):
+        with self._lock:
+            demand, self._demand = self._demand, {}
+
+        with tracing.span('prepull.reconcile', demanded=len(demand)):
+            images = {item['image']: item for item in self.status()}
+
+            # the newest demand of this worker and the one recorded by every worker
+            last = {image: item['last_demand'] for image, item in images.items()}
+            for image, when in demand.items():
+                last[image] = max(last.get(image, 0), when)
+
+            now = time.time()
+            warm = [image for image, when in last.items() if now - when <= self.cold_after]
+            warm.sort(key=lambda image: last[image], reverse=True)
+            keep = set(warm[:self.max_images])
+
+            for image in demand:
+                if image in keep:
+                    self.ensure(image, last[image])
+            for image in images:
+                if image not in keep:
+                    self.retire(image, 'cold' if image not in warm else 'evicted')
+
+        counts = {state: 0 for state in ('pulled', 'pulling', 'failed')}
+        for image in keep & set(images):
+            for state, count in images[image]['counts'].items():
+                counts[state] += count
+        PREPULL_IMAGES.labels().set(len(keep))
+        for state, count in counts.items():
+            PREPULL_NODES.labels(state).set(count)
+
+def get_prepuller(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        prepuller = current_app.extensions.get('launcher_prepull')
+        if prepuller is None:
+            return Response(
+                json.dumps({'error': 'image pre-pull is not enabled'}, indent=1, sort_keys=True),
+                status=404,
+                mimetype='application/json'
+            )
+
+        return f(prepuller, *args, **kwargs)
+    return decorated
+
+@bp.route('/containers/prepull', methods=['POST'])
+@get_prepuller
+def prepull_image(prepuller):
+    try:
+        body = request.get_json(silent=True) or {}
+        if not body.get('image'):
+            return Response(
+                json.dumps({'error': 'no image parameter specified'}, indent=1, sort_keys=True),
+                status=400,
+                mimetype='application/json'
+            )
+
+        # ahead of a class, pulled now rather than after the first launch
+        prepuller.ensure(body['image'])
+
+        return Response(
+            json.dumps(prepuller.status(body['image'])[0], indent=1, sort_keys=True),
+            status=202,
+            mimetype='application/json'
+        )
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Launcher service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+@bp.route('/containers/prepull', methods=['GET'])
+@get_prepuller
+def prepull_status(prepuller):
+    try:
+        image = request.args.get('image') or None
+        images = prepuller.status(image)
+        if image is not None and not images:
+            return Response(
+                json.dumps({'error': '{} is not pre-pulled'.format(image)}, indent=1, sort_keys=True),
+                status=404,
+                mimetype='application/json'
+            )
+
+        return Response(
+            json.dumps({'images': images}, indent=1, sort_keys=True),
+            status=200,
+            mimetype='application/json'
+        )
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Launcher service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+@bp.route('/containers/prepull', methods=['DELETE'])
+@get_prepuller
+def retire_image(prepuller):
+    try:
+        image = request.args.get('image')
+        if not image:
+            return Response(
+                json.dumps({'error': 'no image parameter specified'}, indent=1, sort_keys=True),
+                status=400,
+                mimetype='application/json'
+            )
+
+        if not prepuller.retire(image):
+            return Response(
+                json.dumps({'error': '{} is not pre-pulled'.format(image)}, indent=1, sort_keys=True),
+                status=404,
+                mimetype='application/json'
+            )
+
+        return Response(status=200)
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Launcher service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+
+# timetable pre-spawn
+PRESPAWN_OPTION = 'prespawn'
+
+def prespawned_session(server):
+    """Returns the session a server was started ahead of, None for a launched one"""
+    return (server.get('user_options') or {}).get(PRESPAWN_OPTION)
+
+def volume_claims(volumes, volume_mounts):
+    # volume names are random, a server is matched by its claims and mount paths
+    return sorted(
+        (volume['persistentVolumeClaim']['claimName'], mount['mountPath'])
+        for volume, mount in zip(volumes or [], volume_mounts or [])
+    )
+
+def matches_launch(server, image, tenant, volumes, volume_mounts):
+    options = server.get('user_options') or {}
+    return (
+        options.get('image') == image and
+        options.get('tenant') == tenant and
+        volume_claims(options.get('volumes'), options.get('volume_mounts')) == volume_claims(volumes, volume_mounts)
+    )
+
+def release_prespawned(hub, username):
+    """Stops a pre-spawned server launch cannot hand over, waits until the hub let it go"""
+    resp = request_api(hub, 'users/{}/server'.format(username), method='delete')
+    PRESPAWN_CLAIMS.labels('replaced').inc()
+    if resp.status_code != 202:
+        return
+
+    for i in range(current_app.config['STATUS_CHECK_COUNT']):
+        resilience.sleep(current_app.config['STATUS_CHECK_INTERVAL'])
+        user_data = request_api(hub, 'users/{}'.format(username)).json()
+        if '' not in (user_data.get('servers') or {}):
+            return
+
+    raise ChildProcessError('pre-spawned server of {} did not stop'.format(username))
+
+def format_hub_time(value):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(value))
+
+def load_timetable(path, lead=900.0, grace=900.0):
+    """Returns the sessions of a timetable file, with their students and times resolved"""
+    with open(path) as f:
+        timetable = json.load(f)
+
+    rosters = timetable.get('rosters') or {}
+    sessions = []
+    for session in timetable.get('sessions') or []:
+        # a roster name or the usernames themselves
+        roster = session['roster']
+        users = rosters[roster] if isinstance(roster, str) else roster
+
+        sessions.append({
+            'id': session['id'],
+            'start': parse_hub_time(session['start']),
+            'lead': float(session.get('lead', lead)),
+            'grace': float(session.get('grace', grace)),
+            'image': session['image'],
+            'tenant': session.get('tenant'),
+            'vols': session.get('vols') or [],
+            'users': list(dict.fromkeys(users)),
+        })
+
+    return sessions
+
+def session_phase(session, now):
+    if now < session['start'] - session['lead']:
+        return 'scheduled'
+    if now < session['start']:
+        return 'ramping'
+    if now < session['start'] + session['grace']:
+        return 'started'
+    return 'ended'
+
+class PrespawnScheduler(object):
+    """Starts the servers of scheduled sessions before their students arrive.
+
+    The sessions and their rosters come from a timetable file, read again
+    whenever it changes. From lead seconds before a session starts, each of
+    its students gets a hub user and a server of the session's image, at most
+    rate spawns per second, marked with the session in its user_options.
+    launch hands such a server over to the student asking for the same image,
+    tenant and volumes. Servers no launch claimed grace seconds after the
+    start are stopped.
+
+    Every worker runs a scheduler, only the one holding lock_file does the
+    work, the others take over when its process goes away.
+    """
+
+    def __init__(self, hubs, path, lead=900.0, rate=1.0, grace=900.0, interval=10.0, lock_file=''):
+        self.hubs = hubs
+        self.path = path
+        self.lead = lead
+        self.rate = rate
+        self.grace = grace
+        self.interval = interval
+        self.lock_file = lock_file or os.path.join(tempfile.gettempdir(), 'launcher-prespawn.lock')
+
+        self._sessions = []
+        self._mtime = None
+        # session id -> students whose server was started or found
+        self._spawned = {}
+        self._culled = set()
+        self._lock = threading.Lock()
+        self._lock_fd = None
+        self._stop = threading.Event()
+        self._pid = None
+
+    def sessions(self):
+        with self._lock:
+            return list(self._sessions)
+
+    def reload(self):
+        """Reads the timetable again if it changed, a broken one leaves the last sessions in place"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            sessions = load_timetable(self.path, self.lead, self.grace)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Timetable %s not loaded: %s', self.path, e)
+            return
+
+        with self._lock:
+            self._sessions, self._mtime = sessions, mtime
+        logger.info('Timetable loaded: %d sessions', len(sessions))
+
+    @property
+    def leader(self):
+        return self._lock_fd is not None
+
+    def _lead(self):
+        # one worker per host does the work, the lock goes away with its process
+        if self._lock_fd is not None:
+            return True
+
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        self._lock_fd = fd
+        return True
+
+    def _pace(self):
+        # rate limit of the hub calls, False once stopped
+        if self.rate > 0:
+            return not self._stop.wait(1.0 / self.rate)
+        return not self._stop.is_set()
+
+    def spawn(self, session, username):
+        """Starts the session's server for username, returns the outcome"""
+        hub, user_data = self.hubs.find_user(username)
+        if hub is None:
+            hub = self.hubs.place(username)
+            request_api(hub, 'users/{}'.format(username), method='post')
+        elif '' in (user_data.get('servers') or {}):
+            # launched by the student already, or started by an earlier pass
+            return 'exists'
+
+        # eg. {"pvc": "pvc-exam-{username}-default"}, a claim per student
+        vols = [{'pvc': vol['pvc'].format(username=username), 'mount': vol['mount']} for vol in session['vols']]
+        volumes, volume_mounts = expand_vols(vols) if vols else (None, None)
+        data = {
+            'image': session['image'],
+            'username': username,
+            'server_name': '',
+            'volumes': volumes,
+            'volume_mounts': volume_mounts,
+            PRESPAWN_OPTION: session['id'],
+        }
+        if session['tenant'] is not None:
+            data['tenant'] = session['tenant']
+
+        server_resp = request_api(hub, 'users/{}/servers/'.format(username), method='post', json=data)
+        if server_resp.status_code not in (201, 202):
+            logger.warning('Pre-spawn of %s for %s failed: %s', username, session['id'], server_resp.status_code)
+            return 'failed'
+
+        return 'spawned'
+
+    def ramp(self, session, budget):
+        """Starts up to budget servers of the session, returns how many hub calls it made"""
+        with self._lock:
+            done = self._spawned.setdefault(session['id'], set())
+
+        calls = 0
+        for username in session['users']:
+            if username in done:
+                continue
+            if calls >= budget or (calls and not self._pace()):
+                break
+
+            calls += 1
+            try:
+                outcome = self.spawn(session, username)
+            except CircuitOpenError:
+                # the hub is failing, the next pass tries again
+                break
+            except requests.exceptions.RequestException as e:
+                logger.warning('Pre-spawn of %s for %s failed: %s', username, session['id'], e)
+                outcome = 'failed'
+
+            PRESPAWN_SERVERS.labels(outcome).inc()
+            if outcome != 'failed':
+                with self._lock:
+                    done.add(username)
+
+        return calls
+
+    def claimed(self, hub, username, server):
+        # launch mints a token for the student it hands the server to
+        started = parse_hub_time(server['started'])
+        tokens = request_api(hub, 'users/{}/tokens'.format(username)).json().get('api_tokens') or []
+
+        return any(
+            token.get('note') == LAUNCH_TOKEN_NOTE and token.get('created') and parse_hub_time(token['created']) >= started
+            for token in tokens
+        )
+
+    def cull(self, session_ids):
+        """Stops the servers of the ended sessions no launch claimed, returns the sessions done with"""
+        outcomes = {}
+        # sessions with a server to look at again on the next pass
+        unfinished = set()
+        for hub in self.hubs:
+            for user in request_api(hub, 'users').json():
+                server = (user.get('servers') or {}).get('')
+                session_id = prespawned_session(server) if server else None
+                if session_id not in session_ids:
+                    continue
+                # a spawn or stop in progress is left alone until it settles
+                if server.get('pending'):
+                    unfinished.add(session_id)
+                    continue
+                if self.claimed(hub, user['name'], server):
+                    continue
+                if not self._pace():
+                    return set()
+
+                resp = request_api(hub, 'users/{}/server'.format(user['name']), method='delete')
+                outcome = 'stopped' if resp.status_code in (202, 204) else 'failed'
+                if outcome == 'failed':
+                    unfinished.add(session_id)
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                PRESPAWN_CULLED.labels(outcome).inc()
+
+        if outcomes:
+            logger.info('Culled the unclaimed servers of %s: %s', sorted(session_ids), outcomes)
+        return set(session_ids) - unfinished
+
+    def run_once(self):
+        self.reload()
+        if not self._lead():
+            return
+
+        now = time.time()
+        # a pass makes about as many spawns as the rate allows until the next one
+        budget = max(1, int(self.rate * self.interval))
+        ended = set()
+        for session in self.sessions():
+            phase = session_phase(session, now)
+            if phase == 'ramping' and budget > 0:
+                with tracing.span('prespawn.ramp', session=session['id']):
+                    budget -= self.ramp(session, budget)
+            elif phase == 'ended' and session['id'] not in self._culled:
+                ended.add(session['id'])
+
+        if ended:
+            with tracing.span('prespawn.cull', sessions=len(ended)):
+                self._culled |= self.cull(ended)
+
+    def status(self):
+        """Returns the sessions with their phase, the most recent start first"""
+        now = time.time()
+        with self._lock:
+            spawned = {session_id: len(users) for session_id, users in self._spawned.items()}
+
+        sessions = [
+            {
+                'id': session['id'],
+                'start': format_hub_time(session['start']),
+                'phase': session_phase(session, now),
+                'image': session['image'],
+                'tenant': session['tenant'],
+                'users': len(session['users']),
+                'spawned': spawned.get(session['id'], 0),
+                'culled': session['id'] in self._culled,
+            }
+            for session in self.sessions()
+        ]
+        sessions.sort(key=lambda session: session['start'], reverse=True)
+        return sessions
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except CircuitOpenError:
+                pass
+            except Exception as e:
+                logger.warning('Pre-spawn pass failed: %s', e)
+
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        # a forked worker starts its own scheduler, and competes for the lock with its own file
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._lock_fd = None
+                threading.Thread(target=self._run, name='launcher-prespawn', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+def get_prespawner(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        scheduler = current_app.extensions.get('launcher_prespawn')
+        if scheduler is None:
+            return Response(
+                json.dumps({'error': 'pre-spawn is not enabled'}, indent=1, sort_keys=True),
+                status=404,
+                mimetype='application/json'
+            )
+
+        return f(scheduler.start(), *args, **kwargs)
+    return decorated
+
+@bp.route('/containers/prespawn', methods=['GET'])
+@get_prespawner
+def prespawn_status(scheduler):
+    try:
+        return Response(
+            json.dumps(
+                {'leader': scheduler.leader, 'sessions': scheduler.status()},
+                indent=1,
+                sort_keys=True
+            ),
+            status=200,
+            mimetype='application/json'
+        )
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Launcher service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+
+def create_app(settings=None):
+    """App factory, picked up by flask run and gunicorn 'launcher-service:create_app()'"""
+    app = Flask(__name__)
+    app.config.update(load_settings())
+    if settings is not None:
+        app.config.update(settings)
+    app.config['JUPYTERHUB_API_URL'] = '{}{}'.format(
+        app.config['JUPYTERHUB_URL'],
+        app.config['JUPYTERHUB_API_PREFIX']
+    )
+
+    setup_logger(app.config)
+
+    logger.info('\n*** Launcher-Service ***\n\nGot envs:\nSTATUS_CHECK_INTERVAL: {}\nSTATUS_CHECK_COUNT: {}\nLOG_LEVEL: {}\nJUPYTERHUB_SERVICE_PREFIX: {}\nJUPYTERHUB_URL: {}\nJUPYTERHUB_API_PREFIX: {}\nJUPYTERHUB_API_TOKEN: {}\n'.format(
+        app.config['STATUS_CHECK_INTERVAL'],
+        app.config['STATUS_CHECK_COUNT'],
+        app.config['LOG_LEVEL'],
+        app.config['JUPYTERHUB_SERVICE_PREFIX'],
+        app.config['JUPYTERHUB_URL'],
+        app.config['JUPYTERHUB_API_PREFIX'],
+        app.config['JUPYTERHUB_API_TOKEN']
+    ))
+
+    configure_breakers(
+        failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+        recovery_timeout=app.config['BREAKER_RECOVERY_TIMEOUT']
+    )
+    tracing.configure(
+        app.config['TRACE_EXPORTER'],
+        service='launcher-service',
+        path=app.config['TRACE_FILE'],
+        logger=logger,
+        sample_ratio=app.config['TRACE_SAMPLE_RATIO']
+    )
+
+    instrument_app(app)
+    # off unless PROFILING_TOKEN is set
+    profiling.install(
+        app,
+        app.config['PROFILING_TOKEN'],
+        output_dir=app.config['PROFILING_DIR'],
+        max_seconds=app.config['PROFILING_MAX_SECONDS']
+    )
+    # off unless RECORD_DIR is set
+    recorder.install(
+        app,
+        app.config['RECORD_DIR'],
+        'launcher-service',
+        sample_ratio=app.config['RECORD_SAMPLE_RATIO'],
+        salt=app.config['RECORD_SALT']
+    )
+
+    # off when IDEMPOTENCY_TTL is 0
+    idempotency.install(app, app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_MAX_KEYS'])
+    # a single hub unless JUPYTERHUB_HUBS is set
+    app.extensions['launcher_hubs'] = create_hub_router(app.config)
+    # the kube config is loaded on first use
+    if app.config['PREPULL_NAMESPACE'] or app.config['VOLUME_CHECK_NAMESPACE']:
+        kube.configure(
+            config_mode=app.config['KUBE_CONFIG_MODE'],
+            request_timeout=app.config['KUBE_REQUEST_TIMEOUT']
+        )
+    # off unless VOLUME_CHECK_NAMESPACE is set
+    if app.config['VOLUME_CHECK_NAMESPACE']:
+        app.extensions['launcher_volumes'] = VolumeChecker(
+            app.config['VOLUME_CHECK_NAMESPACE'],
+            cache_ttl=app.config['VOLUME_CHECK_CACHE_TTL'],
+            parallelism=app.config['VOLUME_CHECK_PARALLELISM'],
+            timeout=app.config['VOLUME_CHECK_TIMEOUT']
+        )
+    # off unless PREPULL_NAMESPACE is set
+    if app.config['PREPULL_NAMESPACE']:
+        app.extensions['launcher_prepull'] = ImagePrePuller(
+            app.config['PREPULL_NAMESPACE'],
+            interval=app.config['PREPULL_INTERVAL'],
+            cold_after=app.config['PREPULL_COLD_AFTER'],
+            max_images=app.config['PREPULL_MAX_IMAGES'],
+            pause_image=app.config['PREPULL_PAUSE_IMAGE'],
+            helper_image=app.config['PREPULL_HELPER_IMAGE'],
+            node_selector=app.config['PREPULL_NODE_SELECTOR']
+        )
+    # off unless PRESPAWN_TIMETABLE is set
+    if app.config['PRESPAWN_TIMETABLE']:
+        app.extensions['launcher_prespawn'] = PrespawnScheduler(
+            app.extensions['launcher_hubs'],
+            app.config['PRESPAWN_TIMETABLE'],
+            lead=app.config['PRESPAWN_LEAD'],
+            rate=app.config['PRESPAWN_RATE'],
+            grace=app.config['PRESPAWN_GRACE'],
+            interval=app.config['PRESPAWN_INTERVAL'],
+            lock_file=app.config['PRESPAWN_LOCK_FILE']
+        ).start()
+
+    # routes live under the jupyterhub service prefix, eg. /services/launcher/containers
+    app.register_blueprint(bp, url_prefix=app.config['JUPYTERHUB_SERVICE_PREFIX'].rstrip('/'))
+
+    return app
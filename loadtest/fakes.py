@@ -0,0 +1,979 @@
+"""Local stand-ins for the upstreams of the services.
+
+- FakeHub: the JupyterHub REST API under /hub/api (users, tokens, servers).
+  A spawned server turns ready after ``spawn_delay`` seconds.
+- FakeTenantService: GET /service/v1/tenants/<id>, every tenant gets the
+  templates of benchmarks/fixtures/tenant.json with its id as namespace.
+  PUT /fake/failure {"status": 503} makes every tenant call answer that
+  status, until PUT /fake/failure {"status": null}.
+- FakeKube: a minimal Kubernetes API for core/v1 pods, persistentvolumes
+  and persistentvolumeclaims. Supports create, get (and the status
+  subresource), list, watch, replace, merge patch, delete and delete
+  collection, with label and field selectors. A pod writes a log line
+  every ``log_interval`` seconds until it finishes, read with the log
+  subresource (follow, tailLines, sinceSeconds, limitBytes). Deleted pvs
+  and pvcs stay, marked with a deletionTimestamp, for ``finalizer_delay``
+  seconds, like the protection finalizers keep them. apps/v1 daemonsets
+  get a pod on each of ``nodes`` fake nodes, whose init containers pull
+  their image in ``pull_delay`` seconds, images with "missing" in their
+  name fail with ErrImagePull. Deleting a daemonset deletes its pods.
+  Pods get the container defaults of their namespace's limitranges and
+  are refused with a 403 when they would exceed a resourcequota, whose
+  status.used follows the pods that are not done. storage.k8s.io/v1
+  storageclasses are only stored. The exec subresource of a running pod
+  answers over a websocket, its shell script's echo, sleep and exit
+  commands are played, everything else is ignored.
+
+State is kept in memory. All three run in one process:
+
+    python loadtest/fakes.py --hub-port 8081 --tenant-port 8082 --kube-port 8083
+"""
+import argparse
+import base64
+from collections import deque
+import copy
+import datetime
+import hashlib
+import json
+import math
+import os
+import re
+import secrets
+import shlex
+import struct
+import sys
+import threading
+import time
+import uuid
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+TENANT_FIXTURE = os.path.join(ROOT, 'benchmarks', 'fixtures', 'tenant.json')
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+_QUANTITY_SUFFIXES = {
+    'm': Decimal('0.001'), '': Decimal(1),
+    'k': Decimal(10) ** 3, 'M': Decimal(10) ** 6, 'G': Decimal(10) ** 9, 'T': Decimal(10) ** 12,
+    'Ki': Decimal(2) ** 10, 'Mi': Decimal(2) ** 20, 'Gi': Decimal(2) ** 30, 'Ti': Decimal(2) ** 40,
+}
+
+
+def parse_quantity(value):
+    match = re.match(r'^([0-9.]+)([A-Za-z]*)$', str(value))
+    return Decimal(match.group(1)) * _QUANTITY_SUFFIXES[match.group(2)]
+
+
+def format_quantity(value):
+    return '{:f}'.format(value.normalize())
+
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class Reply(object):
+    def __init__(self, status=200, body=None, content_type='application/json', stream=None, websocket=None):
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        # an iterator of str chunks, sent with chunked encoding
+        self.stream = stream
+        # websocket(send), send(channel, data) writes a frame of a channel.k8s.io stream
+        self.websocket = websocket
+
+
+def json_reply(status, data):
+    return Reply(status, json.dumps(data))
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive, like the real upstreams
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, do not let them wait for an ack
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _dispatch(self):
+        url = urlsplit(self.path)
+        # exec repeats command, once per argument
+        query = {key: values if key == 'command' else values[-1] for key, values in parse_qs(url.query).items()}
+
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw) if raw else None
+        except ValueError:
+            body = None
+
+        try:
+            reply = self.server.app.handle(self.command, url.path, query, body)
+        except Exception as e:
+            reply = json_reply(500, {'error': str(e)})
+
+        if reply.websocket is not None:
+            self._websocket(reply.websocket)
+            return
+
+        if reply.stream is not None:
+            self.send_response(reply.status)
+            self.send_header('Content-Type', reply.content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for chunk in reply.stream:
+                    data = chunk.encode()
+                    self.wfile.write('{:x}\r\n'.format(len(data)).encode() + data + b'\r\n')
+                    self.wfile.flush()
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+            return
+
+        data = reply.body.encode() if isinstance(reply.body, str) else (reply.body or b'')
+        self.send_response(reply.status)
+        self.send_header('Content-Type', reply.content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _websocket(self, handler):
+        accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.send_header('Sec-WebSocket-Protocol', 'v4.channel.k8s.io')
+        self.end_headers()
+        self.close_connection = True
+
+        def frame(opcode, payload):
+            if len(payload) < 126:
+                header = struct.pack('!BB', 0x80 | opcode, len(payload))
+            elif len(payload) < 1 << 16:
+                header = struct.pack('!BBH', 0x80 | opcode, 126, len(payload))
+            else:
+                header = struct.pack('!BBQ', 0x80 | opcode, 127, len(payload))
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+        def send(channel, data):
+            frame(0x2, bytes([channel]) + data.encode())
+
+        try:
+            handler(send)
+            frame(0x8, struct.pack('!H', 1000))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+
+def serve(app, port, host='127.0.0.1'):
+    """Serves app on a background thread, returns the server"""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.app = app
+
+    threading.Thread(target=server.serve_forever, name=type(app).__name__, daemon=True).start()
+    return server
+
+
+# jupyterhub
+class FakeHub(object):
+    PREFIX = '/hub/api/'
+
+    def __init__(self, spawn_delay=2.0, latency=0.0):
+        self.spawn_delay = spawn_delay
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self.users = {}
+
+    def _user_model(self, user):
+        now = time.monotonic()
+        servers = {}
+        for name, server in user['servers'].items():
+            ready = now >= server['ready_at']
+            servers[name] = {
+                'name': name,
+                'ready': ready,
+                'pending': None if ready else 'spawn',
+                'url': '/user/{}/{}'.format(user['name'], name),
+                'started': server['started'],
+                'last_activity': server['started'],
+                'user_options': server['user_options'],
+            }
+
+        return {'kind': 'user', 'name': user['name'], 'admin': False, 'servers': servers}
+
+    def handle(self, method, path, query, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if not path.startswith(self.PREFIX):
+            return json_reply(404, {'status': 404, 'message': 'Not Found'})
+        parts = path[len(self.PREFIX):].split('/')
+
+        with self._lock:
+            if parts == ['users'] and method == 'GET':
+                return json_reply(200, [self._user_model(user) for user in self.users.values()])
+
+            if parts[0] != 'users' or len(parts) < 2:
+                return json_reply(404, {'status': 404, 'message': 'Not Found'})
+
+            name = parts[1]
+            user = self.users.get(name)
+
+            if len(parts) == 2:
+                if method == 'POST':
+                    if user is not None:
+                        return json_reply(409, {'status': 409, 'message': 'User {} already exists'.format(name)})
+                    user = self.users[name] = {'name': name, 'servers': {}, 'tokens': []}
+                    return json_reply(201, self._user_model(user))
+                if user is None:
+                    return json_reply(404, {'status': 404, 'message': 'Not Found'})
+                if method == 'DELETE':
+                    del self.users[name]
+                    return Reply(204)
+                return json_reply(200, self._user_model(user))
+
+            if user is None:
+                return json_reply(404, {'status': 404, 'message': 'Not Found'})
+
+            if parts[2] == 'tokens' and method == 'POST':
+                token = {
+                    'id': 'a{}'.format(len(user['tokens'])),
+                    'kind': 'api_token',
+                    'note': (body or {}).get('note'),
+                    'created': now_iso(),
+                    'expires_at': None,
+                }
+                user['tokens'].append(token)
+                return json_reply(200, dict(token, token=secrets.token_hex(16)))
+            if parts[2] == 'tokens' and method == 'GET':
+                return json_reply(200, {'api_tokens': user['tokens'], 'oauth_tokens': []})
+
+            # server, server/<name>, servers/<name>
+            if parts[2] in ('server', 'servers'):
+                server_name = parts[3] if len(parts) > 3 else ''
+
+                if method == 'POST':
+                    if server_name in user['servers']:
+                        return json_reply(400, {'status': 400, 'message': 'server {} is already running'.format(server_name)})
+                    user['servers'][server_name] = {
+                        'started': now_iso(),
+                        'ready_at': time.monotonic() + self.spawn_delay,
+                        'user_options': body or {},
+                    }
+                    # always pending, a real hub answers 201 only when the spawn finished at once
+                    return Reply(202)
+
+                if method == 'DELETE':
+                    if user['servers'].pop(server_name, None) is None:
+                        return json_reply(400, {'status': 400, 'message': 'no such server'})
+                    return Reply(204)
+
+        return json_reply(404, {'status': 404, 'message': 'Not Found'})
+
+
+# tenant service
+class FakeTenantService(object):
+    PREFIX = '/service/v1/tenants/'
+    FAILURE_PATH = '/fake/failure'
+
+    def __init__(self, latency=0.0, fixture=TENANT_FIXTURE, tenants=10):
+        self.latency = latency
+        self.tenants = tenants
+        # status every tenant call answers while set
+        self.failure = None
+        with open(fixture) as f:
+            self.template = json.load(f)
+
+    def tenant(self, tenant_id):
+        tenant = copy.deepcopy(self.template)
+        tenant['id'] = tenant['namespace'] = tenant_id
+        return tenant
+
+    def handle(self, method, path, query, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path == self.FAILURE_PATH:
+            if method == 'PUT':
+                self.failure = (body or {}).get('status')
+            return json_reply(200, {'status': self.failure})
+        if self.failure:
+            return json_reply(self.failure, {'error': 'injected failure'})
+
+        if method != 'GET':
+            return json_reply(404, {'error': 'not found'})
+        # the list and the change feed the tenant mirror follows, the tenants never change
+        if path == self.PREFIX.rstrip('/'):
+            return json_reply(200, {
+                'epoch': 'fake',
+                'version': 1,
+                'tenants': [self.tenant('tenant-{}'.format(n)) for n in range(self.tenants)],
+            })
+        if path == self.PREFIX + 'changes':
+            time.sleep(min(float(query.get('timeout') or 0), 60))
+            return json_reply(200, {'epoch': 'fake', 'version': 1, 'changes': []})
+        if not path.startswith(self.PREFIX):
+            return json_reply(404, {'error': 'not found'})
+
+        return json_reply(200, self.tenant(path[len(self.PREFIX):]))
+
+
+# kubernetes
+KINDS = {
+    'pods': ('Pod', True),
+    'persistentvolumes': ('PersistentVolume', False),
+    'persistentvolumeclaims': ('PersistentVolumeClaim', True),
+    'daemonsets': ('DaemonSet', True),
+    'resourcequotas': ('ResourceQuota', True),
+    'limitranges': ('LimitRange', True),
+    'storageclasses': ('StorageClass', False),
+}
+API_VERSIONS = {
+    'daemonsets': 'apps/v1',
+    'storageclasses': 'storage.k8s.io/v1',
+}
+
+_PATH = re.compile(r'^/(?:api/v1|apis/apps/v1|apis/storage\.k8s\.io/v1)(?:/namespaces/(?P<namespace>[^/]+))?/(?P<plural>[^/]+)(?:/(?P<name>[^/]+))?(?:/(?P<sub>[^/]+))?$')
+
+
+def status_reply(code, reason, message):
+    return json_reply(code, {
+        'kind': 'Status',
+        'apiVersion': 'v1',
+        'metadata': {},
+        'status': 'Failure',
+        'reason': reason,
+        'message': message,
+        'code': code,
+    })
+
+
+def _field(obj, path):
+    for key in path.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def _selector(value):
+    # [(key, op, value)], op is =, != or exists
+    terms = []
+    for term in filter(None, (value or '').split(',')):
+        if '!=' in term:
+            key, _, expected = term.partition('!=')
+            terms.append((key.strip(), '!=', expected.strip()))
+        elif '=' in term:
+            key, _, expected = term.partition('=')
+            terms.append((key.strip(), '=', expected.strip().lstrip('=')))
+        else:
+            terms.append((term.strip(), 'exists', None))
+    return terms
+
+
+def _matches(terms, lookup):
+    for key, op, expected in terms:
+        value = lookup(key)
+        if op == 'exists' and value is None:
+            return False
+        if op == '=' and value != expected:
+            return False
+        if op == '!=' and value == expected:
+            return False
+    return True
+
+
+def _merge(target, patch):
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class FakeKube(object):
+    # events kept for watches that resume from a resourceVersion
+    EVENT_LOG_SIZE = 10000
+
+    def __init__(self, latency=0.0, pod_start_delay=0.0, log_interval=1.0, finalizer_delay=0.0, nodes=3, pull_delay=1.0):
+        self.latency = latency
+        self.pod_start_delay = pod_start_delay
+        self.log_interval = log_interval
+        self.finalizer_delay = finalizer_delay
+        self.nodes = ['node-{}'.format(i) for i in range(nodes)]
+        self.pull_delay = pull_delay
+
+        self._cond = threading.Condition()
+        self.version = 0
+        self.objects = {plural: {} for plural in KINDS}
+        self.events = deque(maxlen=self.EVENT_LOG_SIZE)
+
+    # state
+    def _record(self, plural, event_type, obj):
+        # caller holds the lock
+        self.version += 1
+        obj['metadata']['resourceVersion'] = str(self.version)
+        self.events.append((self.version, plural, event_type, copy.deepcopy(obj)))
+        self._cond.notify_all()
+
+        if plural == 'pods':
+            self._update_quotas(obj['metadata'].get('namespace'))
+
+    # quotas
+    def _namespaced(self, plural, namespace):
+        # caller holds the lock
+        return [obj for (obj_namespace, _), obj in self.objects[plural].items() if obj_namespace == namespace]
+
+    def _default_pod(self, namespace, pod):
+        # the LimitRanger admission plugin
+        for limit_range in self._namespaced('limitranges', namespace):
+            for item in limit_range['spec'].get('limits') or []:
+                if item.get('type') != 'Container':
+                    continue
+                for container in pod['spec'].get('containers') or []:
+                    resources = container.setdefault('resources', {})
+                    limits = resources.setdefault('limits', {})
+                    requests = resources.setdefault('requests', {})
+                    for name, value in limits.items():
+                        requests.setdefault(name, value)
+                    for name, value in (item.get('default') or {}).items():
+                        limits.setdefault(name, value)
+                    for name, value in (item.get('defaultRequest') or item.get('default') or {}).items():
+                        requests.setdefault(name, value)
+
+    @staticmethod
+    def _pod_usage(pod):
+        usage = {'pods': Decimal(1), 'count/pods': Decimal(1)}
+        for container in pod['spec'].get('containers') or []:
+            resources = container.get('resources') or {}
+            for kind in ('requests', 'limits'):
+                for name, value in (resources.get(kind) or {}).items():
+                    for key in ['{}.{}'.format(kind, name)] + ([name] if kind == 'requests' else []):
+                        usage[key] = usage.get(key, Decimal(0)) + parse_quantity(value)
+        return usage
+
+    def _quota_used(self, namespace, hard):
+        # caller holds the lock
+        used = {name: Decimal(0) for name in hard}
+        for pod in self._namespaced('pods', namespace):
+            if pod['status'].get('phase') in ('Succeeded', 'Failed'):
+                continue
+            for name, value in self._pod_usage(pod).items():
+                if name in used:
+                    used[name] += value
+        return {name: format_quantity(value) for name, value in used.items()}
+
+    def _update_quotas(self, namespace):
+        # caller holds the lock
+        for quota in self._namespaced('resourcequotas', namespace):
+            used = self._quota_used(namespace, quota['spec'].get('hard') or {})
+            if used != quota['status'].get('used'):
+                quota['status']['used'] = used
+                self._record('resourcequotas', 'MODIFIED', quota)
+
+    def _admit_pod(self, namespace, pod):
+        # the ResourceQuota admission plugin, answers the refusal or None
+        usage = self._pod_usage(pod)
+        for quota in self._namespaced('resourcequotas', namespace):
+            hard = quota['spec'].get('hard') or {}
+            used = quota['status'].get('used') or {}
+            for name in sorted(hard):
+                if name not in usage:
+                    if name not in ('pods', 'count/pods'):
+                        return status_reply(403, 'Forbidden', 'pods "{}" is forbidden: failed quota: {}: must specify {}'.format(
+                            pod['metadata']['name'], quota['metadata']['name'], name
+                        ))
+                    continue
+                if parse_quantity(used.get(name, '0')) + usage[name] > parse_quantity(hard[name]):
+                    return status_reply(403, 'Forbidden', (
+                        'pods "{}" is forbidden: exceeded quota: {}, requested: {}={}, used: {}={}, limited: {}={}'
+                    ).format(
+                        pod['metadata']['name'], quota['metadata']['name'],
+                        name, format_quantity(usage[name]), name, used.get(name, '0'), name, hard[name]
+                    ))
+        return None
+
+    def _initial_status(self, plural):
+        if plural == 'pods':
+            return {'phase': 'Pending' if self.pod_start_delay else 'Running', 'startTime': now_iso()}
+        if plural == 'persistentvolumes':
+            return {'phase': 'Available'}
+        if plural == 'daemonsets':
+            return {'desiredNumberScheduled': len(self.nodes), 'currentNumberScheduled': 0, 'numberReady': 0}
+        if plural in ('resourcequotas', 'limitranges', 'storageclasses'):
+            return {}
+        return {'phase': 'Bound'}
+
+    def _start_pod(self, key):
+        with self._cond:
+            pod = self.objects['pods'].get(key)
+            if pod is not None and pod['status'].get('phase') == 'Pending':
+                pod['status']['phase'] = 'Running'
+                self._record('pods', 'MODIFIED', pod)
+
+    def create(self, plural, namespace, obj):
+        kind, namespaced = KINDS[plural]
+        metadata = obj.setdefault('metadata', {})
+        if not metadata.get('name') and metadata.get('generateName'):
+            metadata['name'] = metadata['generateName'] + secrets.token_hex(3)
+        if not metadata.get('name'):
+            return status_reply(422, 'Invalid', 'metadata.name is required')
+
+        obj['kind'] = kind
+        obj['apiVersion'] = API_VERSIONS.get(plural, 'v1')
+        metadata['uid'] = str(uuid.uuid4())
+        metadata['creationTimestamp'] = now_iso()
+        if namespaced:
+            metadata['namespace'] = namespace
+        else:
+            metadata.pop('namespace', None)
+        obj.setdefault('status', self._initial_status(plural))
+        if plural == 'pods':
+            # the log is written from here on
+            obj['status'].setdefault('startTime', now_iso())
+
+        key = (namespace if namespaced else None, metadata['name'])
+        with self._cond:
+            if key in self.objects[plural]:
+                return status_reply(409, 'AlreadyExists', '{} "{}" already exists'.format(plural, metadata['name']))
+            if plural == 'pods':
+                self._default_pod(namespace, obj)
+                refused = self._admit_pod(namespace, obj)
+                if refused is not None:
+                    return refused
+            if plural == 'resourcequotas':
+                hard = (obj.get('spec') or {}).get('hard') or {}
+                obj['status'] = {'hard': dict(hard), 'used': self._quota_used(namespace, hard)}
+            self.objects[plural][key] = obj
+            self._record(plural, 'ADDED', obj)
+            created = copy.deepcopy(obj)
+
+        if plural == 'pods' and self.pod_start_delay:
+            timer = threading.Timer(self.pod_start_delay, self._start_pod, (key,))
+            timer.daemon = True
+            timer.start()
+        if plural == 'daemonsets':
+            self._schedule_daemon_pods(created)
+
+        return json_reply(201, created)
+
+    # daemonsets
+    def _schedule_daemon_pods(self, daemonset):
+        template = daemonset['spec']['template']
+        namespace = daemonset['metadata']['namespace']
+
+        with self._cond:
+            for node in self.nodes:
+                spec = copy.deepcopy(template.get('spec') or {})
+                spec['nodeName'] = node
+                pod = {
+                    'kind': 'Pod',
+                    'apiVersion': 'v1',
+                    'metadata': {
+                        'name': '{}-{}'.format(daemonset['metadata']['name'], node),
+                        'namespace': namespace,
+                        'uid': str(uuid.uuid4()),
+                        'creationTimestamp': now_iso(),
+                        'labels': dict((template.get('metadata') or {}).get('labels') or {}),
+                        'ownerReferences': [{
+                            'kind': 'DaemonSet',
+                            'name': daemonset['metadata']['name'],
+                            'uid': daemonset['metadata']['uid'],
+                        }],
+                    },
+                    'spec': spec,
+                    'status': {
+                        'phase': 'Pending',
+                        'startTime': now_iso(),
+                        'initContainerStatuses': [
+                            {
+                                'name': container['name'],
+                                'image': container['image'],
+                                'imageID': '',
+                                'ready': False,
+                                'restartCount': 0,
+                                'state': {'waiting': {'reason': 'PodInitializing'}},
+                            }
+                            for container in spec.get('initContainers') or []
+                        ],
+                    },
+                }
+                self.objects['pods'][(namespace, pod['metadata']['name'])] = pod
+                self._record('pods', 'ADDED', pod)
+
+            self._update_daemonset_status(namespace, daemonset['metadata']['name'])
+
+        timer = threading.Timer(self.pull_delay, self._pull_images, (namespace, daemonset['metadata']['name']))
+        timer.daemon = True
+        timer.start()
+
+    def _daemon_pods(self, namespace, name):
+        # caller holds the lock
+        return [
+            pod for (pod_namespace, _), pod in self.objects['pods'].items()
+            if pod_namespace == namespace and any(
+                owner.get('kind') == 'DaemonSet' and owner.get('name') == name
+                for owner in pod['metadata'].get('ownerReferences') or []
+            )
+        ]
+
+    def _update_daemonset_status(self, namespace, name):
+        # caller holds the lock
+        daemonset = self.objects['daemonsets'].get((namespace, name))
+        if daemonset is None:
+            return
+
+        pods = self._daemon_pods(namespace, name)
+        daemonset['status'].update({
+            'currentNumberScheduled': len(pods),
+            'numberReady': sum(1 for pod in pods if pod['status']['phase'] == 'Running'),
+        })
+        self._record('daemonsets', 'MODIFIED', daemonset)
+
+    def _pull_images(self, namespace, name):
+        with self._cond:
+            for pod in self._daemon_pods(namespace, name):
+                statuses = pod['status']['initContainerStatuses']
+                for status in statuses:
+                    if 'missing' in status['image']:
+                        status['state'] = {'waiting': {'reason': 'ErrImagePull', 'message': 'manifest unknown'}}
+                    else:
+                        status['imageID'] = 'fake://{}'.format(status['image'])
+                        status['state'] = {'terminated': {'exitCode': 0, 'reason': 'Completed', 'finishedAt': now_iso()}}
+                if all('terminated' in status['state'] for status in statuses):
+                    pod['status']['phase'] = 'Running'
+                self._record('pods', 'MODIFIED', pod)
+
+            self._update_daemonset_status(namespace, name)
+
+    def _matches_query(self, obj, namespace, query):
+        if namespace is not None and obj['metadata'].get('namespace') != namespace:
+            return False
+
+        return (
+            _matches(_selector(query.get('labelSelector')), lambda key: (obj['metadata'].get('labels') or {}).get(key)) and
+            _matches(_selector(query.get('fieldSelector')), lambda key: _field(obj, key))
+        )
+
+    def _select(self, plural, namespace, query):
+        return [obj for obj in self.objects[plural].values() if self._matches_query(obj, namespace, query)]
+
+    def list(self, plural, namespace, query):
+        kind = KINDS[plural][0]
+        with self._cond:
+            items = [copy.deepcopy(obj) for obj in self._select(plural, namespace, query)]
+            version = self.version
+
+        return json_reply(200, {
+            'kind': '{}List'.format(kind),
+            'apiVersion': 'v1',
+            'metadata': {'resourceVersion': str(version)},
+            'items': items,
+        })
+
+    def watch(self, plural, namespace, query):
+        timeout = min(float(query.get('timeoutSeconds') or 60), 300)
+        since = query.get('resourceVersion')
+
+        with self._cond:
+            if since and since != '0':
+                since = int(since)
+                if self.events and since < self.events[0][0] - 1:
+                    return status_reply(410, 'Expired', 'too old resource version: {}'.format(since))
+                initial = []
+            else:
+                initial = [('ADDED', copy.deepcopy(obj)) for obj in self._select(plural, namespace, query)]
+                since = self.version
+
+        def events():
+            last = since
+            for event_type, obj in initial:
+                yield json.dumps({'type': event_type, 'object': obj}) + '\n'
+
+            deadline = time.monotonic() + timeout
+            while True:
+                with self._cond:
+                    pending = [event for event in self.events if event[0] > last]
+                    if not pending:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            return
+                        self._cond.wait(left)
+                        continue
+
+                for version, event_plural, event_type, obj in pending:
+                    last = version
+                    if event_plural == plural and self._matches_query(obj, namespace, query):
+                        yield json.dumps({'type': event_type, 'object': obj}) + '\n'
+
+        return Reply(200, stream=events())
+
+    def _finalize(self, plural, key):
+        with self._cond:
+            obj = self.objects[plural].pop(key, None)
+            if obj is not None:
+                self._record(plural, 'DELETED', obj)
+
+    def delete(self, plural, namespace, name):
+        key = (namespace if KINDS[plural][1] else None, name)
+        with self._cond:
+            obj = self.objects[plural].get(key)
+            if obj is None:
+                return status_reply(404, 'NotFound', '{} "{}" not found'.format(plural, name))
+            if 'deletionTimestamp' in obj['metadata']:
+                return json_reply(200, copy.deepcopy(obj))
+            obj['metadata']['deletionTimestamp'] = now_iso()
+
+            if plural == 'daemonsets':
+                # the garbage collector takes the pods along
+                for pod in self._daemon_pods(namespace, name):
+                    self.objects['pods'].pop((namespace, pod['metadata']['name']))
+                    self._record('pods', 'DELETED', pod)
+
+            if plural in ('pods', 'daemonsets') or not self.finalizer_delay:
+                self.objects[plural].pop(key)
+                self._record(plural, 'DELETED', obj)
+                return json_reply(200, obj)
+
+            # kept until the finalizers are done
+            self._record(plural, 'MODIFIED', obj)
+            deleting = copy.deepcopy(obj)
+
+        timer = threading.Timer(self.finalizer_delay, self._finalize, (plural, key))
+        timer.daemon = True
+        timer.start()
+
+        return json_reply(200, deleting)
+
+    def delete_collection(self, plural, namespace, query):
+        with self._cond:
+            deleted = list(self._select(plural, namespace, query))
+            for obj in deleted:
+                self.objects[plural].pop((obj['metadata'].get('namespace'), obj['metadata']['name']))
+                obj['metadata']['deletionTimestamp'] = now_iso()
+                self._record(plural, 'DELETED', obj)
+
+        return json_reply(200, {
+            'kind': '{}List'.format(KINDS[plural][0]),
+            'apiVersion': 'v1',
+            'metadata': {'resourceVersion': str(self.version)},
+            'items': deleted,
+        })
+
+    def update(self, plural, namespace, name, body, merge):
+        key = (namespace if KINDS[plural][1] else None, name)
+        with self._cond:
+            obj = self.objects[plural].get(key)
+            if obj is None:
+                return status_reply(404, 'NotFound', '{} "{}" not found'.format(plural, name))
+
+            if merge:
+                _merge(obj, body or {})
+            else:
+                metadata = obj['metadata']
+                obj.clear()
+                obj.update(body or {})
+                obj['metadata'] = dict(obj.get('metadata') or {}, uid=metadata['uid'], creationTimestamp=metadata['creationTimestamp'])
+            if plural == 'resourcequotas':
+                hard = (obj.get('spec') or {}).get('hard') or {}
+                obj['status'] = {'hard': dict(hard), 'used': self._quota_used(namespace, hard)}
+            self._record(plural, 'MODIFIED', obj)
+            updated = copy.deepcopy(obj)
+
+        return json_reply(200, updated)
+
+    def get(self, plural, namespace, name):
+        key = (namespace if KINDS[plural][1] else None, name)
+        with self._cond:
+            obj = self.objects[plural].get(key)
+            if obj is None:
+                return status_reply(404, 'NotFound', '{} "{}" not found'.format(plural, name))
+            return json_reply(200, copy.deepcopy(obj))
+
+    def _pod_running(self, key):
+        with self._cond:
+            pod = self.objects['pods'].get(key)
+            return pod is not None and pod['status'].get('phase') not in ('Succeeded', 'Failed')
+
+    def log(self, namespace, name, query):
+        key = (namespace, name)
+        with self._cond:
+            pod = self.objects['pods'].get(key)
+            if pod is None:
+                return status_reply(404, 'NotFound', 'pods "{}" not found'.format(name))
+            started = datetime.datetime.strptime(pod['status']['startTime'], '%Y-%m-%dT%H:%M:%SZ').replace(
+                tzinfo=datetime.timezone.utc
+            ).timestamp()
+
+        interval = self.log_interval
+        follow = query.get('follow') in ('true', '1')
+        limit = int(query['limitBytes']) if query.get('limitBytes') else None
+
+        # line i is written at started + i * interval
+        now = time.time()
+        first = 0
+        if query.get('sinceSeconds'):
+            first = max(first, int(math.ceil((now - int(query['sinceSeconds']) - started) / interval)))
+        if query.get('tailLines'):
+            first = max(first, int((now - started) / interval) + 1 - int(query['tailLines']))
+
+        def lines():
+            sent = 0
+            i = first
+            while True:
+                while started + i * interval <= time.time():
+                    line = '{} line {}\n'.format(name, i)
+                    i += 1
+                    if limit is not None and sent + len(line) >= limit:
+                        yield line[:limit - sent]
+                        return
+                    sent += len(line)
+                    yield line
+
+                if not follow or not self._pod_running(key):
+                    return
+                time.sleep(max(started + i * interval - time.time(), 0))
+
+        return Reply(200, content_type='text/plain', stream=lines())
+
+    def exec(self, namespace, name, query):
+        with self._cond:
+            pod = self.objects['pods'].get((namespace, name))
+            if pod is None:
+                return status_reply(404, 'NotFound', 'pods "{}" not found'.format(name))
+            if pod['status'].get('phase') != 'Running':
+                return status_reply(400, 'BadRequest', 'pod {} is not running'.format(name))
+
+        command = query.get('command') or []
+        if isinstance(command, str):
+            command = [command]
+        # /bin/sh -c script, or a plain command
+        script = command[-1] if len(command) > 2 and command[1] == '-c' else ' '.join(command)
+
+        def run(send):
+            code = 0
+            for line in re.split(r';|&&|\n', script):
+                try:
+                    words = shlex.split(line)
+                except ValueError:
+                    words = line.split()
+                if not words:
+                    continue
+                if words[0] == 'echo':
+                    send(1, ' '.join(words[1:]) + '\n')
+                elif words[0] == 'sleep' and len(words) > 1:
+                    time.sleep(float(words[1]))
+                elif words[0] == 'exit':
+                    code = int(words[1]) if len(words) > 1 else 0
+                    break
+
+            if code == 0:
+                status = {'metadata': {}, 'status': 'Success'}
+            else:
+                status = {
+                    'metadata': {},
+                    'status': 'Failure',
+                    'message': 'command terminated with non-zero exit code: exit status {}'.format(code),
+                    'reason': 'NonZeroExitCode',
+                    'details': {'causes': [{'reason': 'ExitCode', 'message': str(code)}]},
+                }
+            send(3, json.dumps(status))
+
+        return Reply(websocket=run)
+
+    def handle(self, method, path, query, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        match = _PATH.match(path)
+        if match is None or match.group('plural') not in KINDS:
+            return status_reply(404, 'NotFound', 'the server could not find the requested resource')
+
+        plural, namespace, name, sub = match.group('plural', 'namespace', 'name', 'sub')
+        if sub == 'log' and plural == 'pods' and name is not None and method == 'GET':
+            return self.log(namespace, name, query)
+        if sub == 'exec' and plural == 'pods' and name is not None and method in ('GET', 'POST'):
+            return self.exec(namespace, name, query)
+        if sub not in (None, 'status'):
+            return status_reply(404, 'NotFound', 'unknown subresource {}'.format(sub))
+
+        if name is None:
+            if method == 'GET' and query.get('watch') in ('true', '1'):
+                return self.watch(plural, namespace, query)
+            if method == 'GET':
+                return self.list(plural, namespace, query)
+            if method == 'POST':
+                return self.create(plural, namespace, body or {})
+            if method == 'DELETE':
+                return self.delete_collection(plural, namespace, query)
+        else:
+            if method == 'GET':
+                return self.get(plural, namespace, name)
+            if method == 'DELETE':
+                return self.delete(plural, namespace, name)
+            if method in ('PUT', 'PATCH'):
+                return self.update(plural, namespace, name, body, merge=method == 'PATCH')
+
+        return status_reply(405, 'MethodNotAllowed', 'method {} is not allowed'.format(method))
+
+
+def kubeconfig(url):
+    """A kubeconfig for the fake api server at url"""
+    return json.dumps({
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{'name': 'fake', 'cluster': {'server': url}}],
+        'users': [{'name': 'fake', 'user': {'token': 'fake'}}],
+        'contexts': [{'name': 'fake', 'context': {'cluster': 'fake', 'user': 'fake', 'namespace': 'default'}}],
+        'current-context': 'fake',
+    }, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hub-port', type=int, default=8081)
+    parser.add_argument('--tenant-port', type=int, default=8082)
+    parser.add_argument('--kube-port', type=int, default=8083)
+    parser.add_argument('--spawn-delay', type=float, default=2.0, help='seconds until a spawned server is ready')
+    parser.add_argument('--pod-start-delay', type=float, default=0.0, help='seconds until a created pod is running')
+    parser.add_argument('--hub-latency', type=float, default=0.0, help='seconds added to every hub call')
+    parser.add_argument('--tenant-latency', type=float, default=0.0, help='seconds added to every tenant call')
+    parser.add_argument('--tenants', type=int, default=10, help='tenants in the tenant list')
+    parser.add_argument('--kube-latency', type=float, default=0.0, help='seconds added to every kubernetes call')
+    parser.add_argument('--log-interval', type=float, default=1.0, help='seconds between the log lines of a pod')
+    parser.add_argument('--finalizer-delay', type=float, default=0.0, help='seconds a deleted pv or pvc is kept')
+    parser.add_argument('--nodes', type=int, default=3, help='nodes daemonset pods are scheduled on')
+    parser.add_argument('--pull-delay', type=float, default=1.0, help='seconds a daemonset pod takes to pull its images')
+    args = parser.parse_args()
+
+    serve(FakeHub(args.spawn_delay, args.hub_latency), args.hub_port)
+    serve(FakeTenantService(args.tenant_latency, tenants=args.tenants), args.tenant_port)
+    serve(
+        FakeKube(args.kube_latency, args.pod_start_delay, args.log_interval, args.finalizer_delay, args.nodes, args.pull_delay),
+        args.kube_port
+    )
+
+    print('fakes ready', flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
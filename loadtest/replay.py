@@ -0,0 +1,246 @@
+"""Replays recorded traffic against local fakes.
+
+Reads the request recordings the services write when RECORD_DIR is set
+(moop_common/recorder.py), starts the fakes and the services like run.py
+and sends every recorded request at its recorded offset divided by
+--speed, so a recorded course start can be played back at 1x, 5x or 10x:
+
+    python loadtest/replay.py recordings/ --speed 5 --output replay.json
+
+Hashed strings in the parameters are replaced by stand-ins made from the
+hash, the same hash always gets the same stand-in, so users and tenants
+keep their identity across requests and services. A request that uses a
+name handed out by an earlier request (a pod name) waits for that request
+to answer and sends the name the replay got. Requests of one user or for
+one object (the same username or name) are sent one after the other, as
+their client did, the others keep their schedule.
+
+Exits with status 1 when more than --max-mismatch-rate of the requests of a
+route failed where the recorded one succeeded, or the other way around.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+from moop_common.recorder import HASH_PREFIX, read_records
+from run import Client, Environment, Recorder, add_environment_arguments, summarize
+from serve import SERVICES
+
+
+def stand_in(hashed):
+    # lowercase hex, valid in kubernetes names and hub user names
+    return 'r' + hashed[len(HASH_PREFIX):]
+
+
+def recorded_ok(record):
+    return record['status'] < 400 and not record.get('error', False)
+
+
+class Names(object):
+    """Stand-ins for hashed strings, and the names the replayed requests got back"""
+
+    def __init__(self, records, timeout):
+        self.timeout = timeout
+        # hash -> time of the first request that answered with it
+        self.created_at = {}
+        for record in records:
+            if 'created' in record:
+                self.created_at.setdefault(record['created'], record['time'])
+
+        self._names = {}
+        self._answered = {hashed: threading.Event() for hashed in self.created_at}
+
+    def resolve(self, value, at):
+        """Returns value with the hashed strings replaced, at is the recorded time of the request"""
+        if isinstance(value, str):
+            if not value.startswith(HASH_PREFIX):
+                return value
+            if self.created_at.get(value, at) < at:
+                self._answered[value].wait(self.timeout)
+            return self._names.get(value) or stand_in(value)
+        if isinstance(value, dict):
+            return {key: self.resolve(item, at) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item, at) for item in value]
+
+        return value
+
+    def answered(self, record, data):
+        hashed = record.get('created')
+        if hashed is None or self.created_at.get(hashed) != record['time']:
+            return
+
+        if isinstance(data, dict):
+            self._names[hashed] = (data.get('metadata') or {}).get('name')
+        # a failed create releases the waiting requests as well, they send the stand-in
+        self._answered[hashed].set()
+
+
+# requests sharing these parameters come from one client, in order
+ACTOR_KEYS = ('username', 'name')
+
+
+def actor(record):
+    params = dict(record.get('query') or {})
+    if isinstance(record.get('body'), dict):
+        params.update(record['body'])
+
+    values = tuple(params[key] for key in ACTOR_KEYS if isinstance(params.get(key), str))
+    return values or None
+
+
+def route_key(record):
+    return '{} {} {}'.format(record['service'], record['method'], record['route'])
+
+
+def load(paths, services):
+    records = [
+        record for record in read_records(paths)
+        if record.get('service') in SERVICES and (not services or record['service'] in services)
+    ]
+    records.sort(key=lambda record: record['time'])
+
+    return records
+
+
+def replay(client, records, names, args):
+    """Sends the records on their schedule, returns (seconds it took, mismatches by route)"""
+    executor = ThreadPoolExecutor(max_workers=args.max_in_flight)
+    mismatches = {}
+    lock = threading.Lock()
+
+    def send(record, scheduled, previous, done):
+        if previous is not None:
+            previous.wait(args.timeout)
+        # how far behind the schedule the replay is running
+        client.recorder.add('replay.lag', time.monotonic() - scheduled, True)
+
+        data = None
+        try:
+            key = route_key(record)
+            kwargs = {'params': names.resolve(record.get('query') or {}, record['time'])}
+            if record.get('body') is not None:
+                kwargs['json'] = names.resolve(record['body'], record['time'])
+
+            data = client.step(key, record['method'], record['service'], record['route'], **kwargs)
+            if (data is not None) != recorded_ok(record):
+                with lock:
+                    mismatches[key] = mismatches.get(key, 0) + 1
+        finally:
+            names.answered(record, data)
+            done.set()
+
+    # actor -> Event set when its last request answered
+    last = {}
+
+    start = time.monotonic()
+    first = records[0]['time']
+    for record in records:
+        at = start + (record['time'] - first) / args.speed
+        delay = at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        done = threading.Event()
+        key = actor(record)
+        previous = last.get(key) if key is not None else None
+        if key is not None:
+            last[key] = done
+        executor.submit(send, record, at, previous, done)
+
+    executor.shutdown(wait=True)
+    return time.monotonic() - start, mismatches
+
+
+def recorded_results(records):
+    recorder = Recorder()
+    for record in records:
+        recorder.add(route_key(record), record['duration'], recorded_ok(record))
+
+    return summarize(recorder, records[-1]['time'] - records[0]['time'])
+
+
+def launcher_prefix(records):
+    # launcher routes are one path segment under JUPYTERHUB_SERVICE_PREFIX
+    for record in records:
+        if record['service'] == 'launcher-service':
+            return record['route'].rsplit('/', 1)[0] + '/'
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recordings', nargs='+', help='recording files, or directories of them')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay this many times faster than recorded')
+    parser.add_argument('--service', action='append', choices=sorted(SERVICES), help='services to replay, all recorded by default')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='concurrent requests, later ones queue')
+    parser.add_argument('--name-timeout', type=float, default=60.0, help='seconds to wait for the request that hands out a name')
+    add_environment_arguments(parser)
+    parser.add_argument('--max-mismatch-rate', type=float, default=0.01)
+    parser.add_argument('--output', help='write the json report to this file as well')
+    args = parser.parse_args()
+
+    records = load(args.recordings, args.service)
+    if not records:
+        print('no recorded requests found', file=sys.stderr)
+        return 1
+
+    args.service = sorted({record['service'] for record in records})
+    prefix = launcher_prefix(records)
+    if prefix is not None:
+        args.env = (args.env or []) + [['JUPYTERHUB_SERVICE_PREFIX', prefix]]
+
+    env = Environment(args)
+    try:
+        env.start()
+        recorder = Recorder()
+        elapsed, mismatches = replay(Client(env, recorder, args.timeout), records, Names(records, args.name_timeout), args)
+    finally:
+        env.stop()
+
+    results = summarize(recorder, elapsed)
+    for result in results:
+        result['mismatches'] = mismatches.get(result['name'], 0)
+        result['mismatch_rate'] = result['mismatches'] / result['count'] if result['count'] else 0.0
+
+    report = {
+        'benchmark': 'replay',
+        'python': platform.python_version(),
+        'config': {
+            'services': args.service,
+            'speed': args.speed,
+            'records': len(records),
+            'max_in_flight': args.max_in_flight,
+            'spawn_delay': args.spawn_delay,
+            'kube_latency': args.kube_latency,
+            'tenant_latency': args.tenant_latency,
+            'hub_latency': args.hub_latency,
+        },
+        'recorded_seconds': records[-1]['time'] - records[0]['time'],
+        'elapsed_seconds': elapsed,
+        'results': results,
+        'recorded': recorded_results(records),
+    }
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    return 1 if any(result['mismatch_rate'] > args.max_mismatch_rate for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
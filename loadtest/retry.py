@@ -0,0 +1,91 @@
+"""Checks that a retry with an Idempotency-Key outlives an upstream failure.
+
+Starts the fakes and pod-service, with executors, like run.py. For every check the fake
+tenant service fails while a create is sent with an Idempotency-Key, then
+recovers, and the same request is sent again with the same key: the retry
+has to run for real and succeed, not get the failure of the first attempt
+replayed.
+
+    python loadtest/retry.py
+
+Exits with status 1 when a check fails.
+"""
+import argparse
+import sys
+import time
+
+import requests
+
+from run import Environment, add_environment_arguments
+
+CHECKS = {
+    'pod.create': ('/service/v1/pods', {'tenant': 'tenant-0', 'cmd': 'true'}),
+    'pod.exec': ('/service/v1/pods/exec', {'tenant': 'tenant-0', 'cmd': 'echo retried'}),
+}
+
+
+def set_tenant_failure(env, status):
+    requests.put(
+        'http://127.0.0.1:{}/fake/failure'.format(env.tenant_port),
+        json={'status': status},
+        timeout=5
+    ).raise_for_status()
+
+
+def failed(resp):
+    try:
+        data = resp.json()
+    except ValueError:
+        return True
+    # the services answer some failures with 200 and an error body
+    return resp.status_code >= 400 or (isinstance(data, dict) and 'error' in data)
+
+
+def retry_after_recovery(env, name, path, body, args):
+    """Returns why the check failed, None when it passed"""
+    headers = {'Idempotency-Key': 'retry-{}-{}'.format(args.run_id, name)}
+
+    set_tenant_failure(env, 503)
+    try:
+        first = requests.post(env.url('pod-service', path), json=body, headers=headers, timeout=args.timeout)
+    finally:
+        set_tenant_failure(env, None)
+    if not failed(first):
+        return 'the attempt during the tenant failure succeeded: {} {}'.format(first.status_code, first.text)
+
+    retry = requests.post(env.url('pod-service', path), json=body, headers=headers, timeout=args.timeout)
+    if retry.headers.get('Idempotent-Replayed'):
+        return 'the retry got the failed attempt replayed: {} {}'.format(retry.status_code, retry.text)
+    if failed(retry):
+        return 'the retry failed: {} {}'.format(retry.status_code, retry.text)
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--check', action='append', choices=sorted(CHECKS), help='checks to run, all by default')
+    add_environment_arguments(parser)
+    args = parser.parse_args()
+
+    args.service = ['pod-service']
+    args.env = [['POD_EXEC_POOL_SIZE', '2']] + (args.env or [])
+    args.run_id = '{:x}'.format(int(time.time()))
+
+    env = Environment(args)
+    failures = 0
+    try:
+        env.start()
+        for name in args.check or sorted(CHECKS):
+            path, body = CHECKS[name]
+            error = retry_after_recovery(env, name, path, body, args)
+            print('{}: {}'.format(name, error or 'ok'))
+            failures += error is not None
+    finally:
+        env.stop()
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""End-to-end load test against local fakes.
+
+Starts the fake hub, tenant service and kubernetes API (loadtest/fakes.py),
+starts the services under test (loadtest/serve.py) pointed at them, and
+drives each service with an open-loop arrival process:
+
+- launcher-service: launch a server, read it, remove it
+- pod-service: create a pod, read it, delete it
+- volume-service: create a pv and a matching pvc, read both, delete both
+
+Every step is timed from the moment it is sent. Each scenario is also timed
+from its scheduled arrival, so a saturated service shows up as latency and
+is not hidden by a slower arrival rate. Nothing outside the machine is
+needed:
+
+    python loadtest/run.py --rate 20 --duration 30 --output load.json
+
+Exits with status 1 when a step fails more often than --max-error-rate.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, HERE)
+from fakes import kubeconfig
+
+LAUNCHER_PREFIX = '/services/launcher'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30.0, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError('{} exited with {}'.format(' '.join(process.args), process.returncode))
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+    raise RuntimeError('{} did not come up in {}s'.format(url, timeout))
+
+
+class Environment(object):
+    """The fakes and the services under test, each in its own process"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix='moop-loadtest-')
+        self.processes = []
+
+        self.hub_port, self.tenant_port, self.kube_port = free_port(), free_port(), free_port()
+        self.ports = {}
+
+    def _spawn(self, argv, env=None, log_name=None):
+        log = open(os.path.join(self.workdir, log_name), 'w')
+        process = subprocess.Popen(argv, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        return process
+
+    def service_env(self):
+        with open(os.path.join(self.workdir, 'kubeconfig'), 'w') as f:
+            f.write(kubeconfig('http://127.0.0.1:{}'.format(self.kube_port)))
+
+        env = dict(os.environ)
+        # never the cluster this may run in
+        env.pop('KUBERNETES_SERVICE_HOST', None)
+        env.update({
+            'LOG_LEVEL': '40',
+            'KUBECONFIG': os.path.join(self.workdir, 'kubeconfig'),
+            'KUBE_CONFIG_MODE': 'kubeconfig',
+            'TENANT_SERVICE_URL': 'http://127.0.0.1:{}/service/v1/tenants'.format(self.tenant_port),
+            'NFS_SERVER': '127.0.0.1',
+            'NFS_PREFIX': '/nfs/',
+            'STATUS_CHECK_INTERVAL': str(self.args.status_check_interval),
+            'STATUS_CHECK_COUNT': str(self.args.status_check_count),
+            'JUPYTERHUB_SERVICE_PREFIX': LAUNCHER_PREFIX + '/',
+            'JUPYTERHUB_URL': 'http://127.0.0.1:{}'.format(self.hub_port),
+            'JUPYTERHUB_API_PREFIX': '/hub/api',
+            'JUPYTERHUB_API_TOKEN': 'loadtest',
+            'USER_TOKEN_LIFETIME': '1800',
+        })
+        env.update(dict(self.args.env or []))
+
+        return env
+
+    def start(self):
+        fakes = self._spawn([
+            sys.executable, os.path.join(HERE, 'fakes.py'),
+            '--hub-port', str(self.hub_port),
+            '--tenant-port', str(self.tenant_port),
+            '--kube-port', str(self.kube_port),
+            '--spawn-delay', str(self.args.spawn_delay),
+            '--pod-start-delay', str(self.args.pod_start_delay),
+            '--hub-latency', str(self.args.hub_latency),
+            '--tenant-latency', str(self.args.tenant_latency),
+            '--tenants', str(self.args.tenants),
+            '--kube-latency', str(self.args.kube_latency),
+            '--finalizer-delay', str(self.args.finalizer_delay),
+            '--nodes', str(self.args.nodes),
+            '--pull-delay', str(self.args.pull_delay),
+        ], log_name='fakes.log')
+        wait_for('http://127.0.0.1:{}/'.format(self.kube_port), process=fakes)
+
+        env = self.service_env()
+        for service in self.args.service:
+            port = self.ports[service] = free_port()
+            process = self._spawn(
+                [sys.executable, os.path.join(HERE, 'serve.py'), service, '--port', str(port)],
+                env=env,
+                log_name='{}.log'.format(service)
+            )
+            wait_for(self.url(service, '/metrics'), process=process)
+
+    def url(self, service, path):
+        return 'http://127.0.0.1:{}{}'.format(self.ports[service], path)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+        if self.args.keep_logs:
+            print('logs kept in {}'.format(self.workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# results
+class Recorder(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, step, seconds, ok):
+        with self._lock:
+            self.latencies.setdefault(step, [])
+            self.errors.setdefault(step, 0)
+            if ok:
+                self.latencies[step].append(seconds)
+            else:
+                self.errors[step] += 1
+
+
+def percentile(values, q):
+    # nearest rank
+    return values[max(int(math.ceil(q * len(values))) - 1, 0)]
+
+
+def summarize(recorder, elapsed):
+    results = []
+    for step in sorted(recorder.latencies):
+        latencies = sorted(recorder.latencies[step])
+        errors = recorder.errors[step]
+        count = len(latencies) + errors
+
+        result = {
+            'name': step,
+            'count': count,
+            'errors': errors,
+            'error_rate': errors / count if count else 0.0,
+            'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        }
+        if latencies:
+            result['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'p999': percentile(latencies, 0.999),
+                'max': latencies[-1],
+            }
+        results.append(result)
+
+    return results
+
+
+# scenarios
+class Client(object):
+    def __init__(self, env, recorder, timeout):
+        self.env = env
+        self.recorder = recorder
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def step(self, name, method, service, path, **kwargs):
+        """Sends one request, returns its json body, None if it failed"""
+        start = time.perf_counter()
+        try:
+            resp = self.session().request(method, self.env.url(service, path), timeout=self.timeout, **kwargs)
+            data = resp.json() if resp.content else {}
+            # the services answer some failures with 200 and an error body
+            ok = resp.status_code < 400 and not (isinstance(data, dict) and 'error' in data)
+        except (requests.exceptions.RequestException, ValueError):
+            data, ok = None, False
+
+        self.recorder.add(name, time.perf_counter() - start, ok)
+        return data if ok else None
+
+
+def launcher_scenario(client, n, args):
+    username = 'lt-{}-{}'.format(args.run_id, n)
+
+    launched = client.step(
+        'launcher.launch', 'POST', 'launcher-service', LAUNCHER_PREFIX + '/containers',
+        json={'image': 'jupyter/base-notebook', 'username': username, 'vols': [{'pvc': 'home', 'mount': '/home/jovyan'}]}
+    )
+    if launched is None:
+        return False
+
+    params = {'username': username}
+    client.step('launcher.read', 'GET', 'launcher-service', LAUNCHER_PREFIX + '/containers', params=params)
+    return client.step('launcher.remove', 'DELETE', 'launcher-service', LAUNCHER_PREFIX + '/containers', params=params) is not None
+
+
+def pod_scenario(client, n, args):
+    tenant = 'tenant-{}'.format(n % args.tenants)
+
+    pod = client.step(
+        'pod.create', 'POST', 'pod-service', '/service/v1/pods',
+        json={'tenant': tenant, 'cmd': 'true', 'vols': [{'pvc': 'data', 'mount': '/data'}]}
+    )
+    if pod is None:
+        return False
+
+    params = {'tenant': tenant, 'name': pod['metadata']['name']}
+    client.step('pod.read', 'GET', 'pod-service', '/service/v1/pods', params=params)
+    return client.step('pod.delete', 'DELETE', 'pod-service', '/service/v1/pods', params=params) is not None
+
+
+def volume_scenario(client, n, args):
+    tenant = 'tenant-{}'.format(n % args.tenants)
+    username = 'lt-{}-{}'.format(args.run_id, n)
+    params = {'tenant': tenant, 'username': username}
+
+    pv = client.step(
+        'volume.create_pv', 'POST', 'volume-service', '/service/v1/volumes/pvs',
+        json=dict(params, path='loadtest/{}'.format(username))
+    )
+    pvc = client.step(
+        'volume.create_pvc', 'POST', 'volume-service', '/service/v1/volumes/pvcs',
+        json=dict(params, match=True)
+    )
+    if pv is None or pvc is None:
+        return False
+
+    client.step('volume.read_pv', 'GET', 'volume-service', '/service/v1/volumes/pvs', params=params)
+    client.step('volume.read_pvc', 'GET', 'volume-service', '/service/v1/volumes/pvcs', params=params)
+    ok = client.step('volume.delete_pvc', 'DELETE', 'volume-service', '/service/v1/volumes/pvcs', params=params) is not None
+    return client.step('volume.delete_pv', 'DELETE', 'volume-service', '/service/v1/volumes/pvs', params=params) is not None and ok
+
+
+SCENARIOS = {
+    'launcher-service': launcher_scenario,
+    'pod-service': pod_scenario,
+    'volume-service': volume_scenario,
+}
+
+
+def drive(client, args):
+    """Runs the arrival processes of all services, returns the seconds it took"""
+    rng = random.Random(args.seed)
+    executor = ThreadPoolExecutor(max_workers=args.max_in_flight)
+
+    def run_scenario(service, n, scheduled):
+        try:
+            ok = SCENARIOS[service](client, n, args)
+        except Exception:
+            ok = False
+        client.recorder.add('{}.scenario'.format(service), time.monotonic() - scheduled, ok)
+
+    def arrivals(service, offset):
+        n = 0
+        at = start + offset
+        while at < start + args.duration:
+            delay = at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run_scenario, service, n, at)
+
+            n += 1
+            at += rng.expovariate(args.rate) if args.arrival == 'poisson' else 1.0 / args.rate
+
+    start = time.monotonic()
+    schedulers = [
+        threading.Thread(target=arrivals, args=(service, i / (args.rate * len(args.service))), daemon=True)
+        for i, service in enumerate(args.service)
+    ]
+    for scheduler in schedulers:
+        scheduler.start()
+    for scheduler in schedulers:
+        scheduler.join()
+
+    executor.shutdown(wait=True)
+    return time.monotonic() - start
+
+
+def add_environment_arguments(parser):
+    """Options of the fakes and the services under test, shared with replay.py"""
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds, per request')
+    parser.add_argument('--spawn-delay', type=float, default=2.0, help='seconds until the fake hub reports a server ready')
+    parser.add_argument('--pod-start-delay', type=float, default=0.0)
+    parser.add_argument('--hub-latency', type=float, default=0.0)
+    parser.add_argument('--tenant-latency', type=float, default=0.0)
+    parser.add_argument('--tenants', type=int, default=10, help='tenants in the fake tenant list')
+    parser.add_argument('--kube-latency', type=float, default=0.0)
+    parser.add_argument('--finalizer-delay', type=float, default=0.0, help='seconds the fake api server keeps a deleted pv or pvc')
+    parser.add_argument('--nodes', type=int, default=3, help='nodes of the fake api server, each gets a pod of every daemonset')
+    parser.add_argument('--pull-delay', type=float, default=1.0, help='seconds a fake daemonset pod takes to pull its images')
+    parser.add_argument('--status-check-interval', type=int, default=1)
+    parser.add_argument('--status-check-count', type=int, default=60)
+    parser.add_argument('--env', action='append', type=lambda value: value.split('=', 1), help='extra service env, NAME=value')
+    parser.add_argument('--keep-logs', action='store_true', help='keep the logs of the fakes and services')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--service', action='append', choices=sorted(SCENARIOS), help='services to drive, all by default')
+    parser.add_argument('--rate', type=float, default=10.0, help='scenario arrivals per second, per service')
+    parser.add_argument('--arrival', choices=['poisson', 'constant'], default='poisson')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of arrivals')
+    parser.add_argument('--max-in-flight', type=int, default=256, help='concurrent scenarios, later arrivals queue')
+    parser.add_argument('--seed', type=int, default=1)
+    add_environment_arguments(parser)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--output', help='write the json report to this file as well')
+    args = parser.parse_args()
+
+    args.service = args.service or sorted(SCENARIOS)
+    args.run_id = '{:x}'.format(int(time.time()))
+
+    env = Environment(args)
+    try:
+        env.start()
+        recorder = Recorder()
+        elapsed = drive(Client(env, recorder, args.timeout), args)
+    finally:
+        env.stop()
+
+    results = summarize(recorder, elapsed)
+    report = {
+        'benchmark': 'loadtest',
+        'python': platform.python_version(),
+        'config': {
+            'services': args.service,
+            'rate': args.rate,
+            'arrival': args.arrival,
+            'duration': args.duration,
+            'max_in_flight': args.max_in_flight,
+            'spawn_delay': args.spawn_delay,
+            'kube_latency': args.kube_latency,
+            'tenant_latency': args.tenant_latency,
+            'hub_latency': args.hub_latency,
+        },
+        'elapsed_seconds': elapsed,
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    return 1 if any(result['error_rate'] > args.max_error_rate for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""Serves one service with a threaded werkzeug server, for the load harness.
+
+    python loadtest/serve.py pod-service --port 5001
+
+The service reads its envs as usual.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import sys
+
+from werkzeug.serving import make_server
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+SERVICES = {
+    'launcher-service': 'launcher-service/launcher-service.py',
+    'pod-service': 'pod-service/pod-service.py',
+    'tenant-service': 'tenant-service/tenant-service.py',
+    'volume-service': 'volume-service/volume-service.py',
+}
+
+
+def load_app(service):
+    module_spec = importlib.util.spec_from_file_location(service.replace('-', '_'), os.path.join(ROOT, SERVICES[service]))
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+
+    return module.create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+
+    # no access log, it would be the busiest writer in the process
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server(args.host, args.port, load_app(args.service), threaded=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,5 @@
+"""Helpers shared by the moop services.
+
+Every service adds the repository root to ``sys.path`` before importing from
+this package, so it works with ``flask run`` from the service directory.
+"""
@@ -0,0 +1,64 @@
+"""Consistent hashing of keys to nodes.
+
+Every node is placed on the ring at ``replicas`` points, a key belongs to the
+first node point at or after its own hash. Adding or removing a node only
+moves the keys of the ring segments it takes or gives up, every other key
+keeps its node, so routing by the ring stays sticky while nodes come and go.
+"""
+import bisect
+import hashlib
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing(object):
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._owners.values()))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash('{}#{}'.format(node, i))
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+            self._owners[point] = node
+
+    def remove(self, node):
+        points = [point for point, owner in self._owners.items() if owner == node]
+        for point in points:
+            del self._owners[point]
+        self._points = sorted(self._owners)
+
+    def get(self, key):
+        """Returns the node key belongs to, None on an empty ring"""
+        if not self._points:
+            return None
+
+        i = bisect.bisect_left(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+    def preference(self, key):
+        """Returns every node once, in ring order from the one key belongs to"""
+        nodes = []
+        if not self._points:
+            return nodes
+
+        count = len(self)
+        start = bisect.bisect_left(self._points, _hash(key))
+        for i in range(len(self._points)):
+            node = self._owners[self._points[(start + i) % len(self._points)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+
+        return nodes
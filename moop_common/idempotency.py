@@ -0,0 +1,193 @@
+"""Idempotency keys for the create endpoints.
+
+A caller that may retry a create sends the same ``IDEMPOTENCY_HEADER`` with
+every attempt. The first attempt runs and its answer is kept for ``ttl``
+seconds, a retry gets that answer back, marked with ``REPLAYED_HEADER``,
+instead of doing the work again. A retry arriving while the first attempt
+still runs waits for it, up to its own deadline. Only successful answers
+are kept, after a failed attempt the next one runs for real: an answer
+with a 4xx or 5xx status, or with an ``error`` in its json body, which
+some handlers still answer with 200. A key sent again with another request
+is refused with 422.
+
+Answers are kept per worker process, at most ``max_entries`` of them, the
+least recently used go first. A retry routed to another worker runs again,
+so the work itself should be idempotent where it matters, eg. pod-service
+names the pod after the key.
+"""
+from collections import OrderedDict
+from functools import wraps
+import hashlib
+import json
+import threading
+import time
+
+from flask import Response, current_app, request
+
+from moop_common import metrics, resilience
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+IDEMPOTENT_REQUESTS = metrics.Counter(
+    'moop_idempotent_requests_total',
+    'Requests sent with an idempotency key, by route and outcome.',
+    ['route', 'outcome']
+)
+
+
+class _Entry(object):
+    __slots__ = ('fingerprint', 'done', 'response', 'expires_at')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        # (status, headers, body) once kept
+        self.response = None
+        # None while the first attempt runs
+        self.expires_at = None
+
+
+class IdempotencyStore(object):
+    """Answers by key, at most max_entries of them, each kept for ttl seconds"""
+
+    def __init__(self, ttl=3600.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def claim(self, key, fingerprint):
+        """Returns (entry, True) if the caller runs the request, (entry, False) if an earlier attempt did or does"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at is not None and entry.expires_at <= now:
+                del self._entries[key]
+                entry = None
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry, False
+
+            entry = self._entries[key] = _Entry(fingerprint)
+            while len(self._entries) > self.max_entries:
+                # an evicted attempt still answers the retries already waiting on it
+                self._entries.popitem(last=False)
+
+            return entry, True
+
+    def complete(self, entry, status, headers, body):
+        entry.response = (status, headers, body)
+        entry.expires_at = time.monotonic() + self.ttl
+        entry.done.set()
+
+    def release(self, key, entry):
+        """Forgets a failed attempt, the next one runs for real"""
+        with self._lock:
+            if self._entries.get(key) is entry:
+                del self._entries[key]
+        entry.done.set()
+
+
+def _error(message, status, headers=None):
+    return Response(
+        json.dumps({'error': message}, indent=1, sort_keys=True),
+        status=status,
+        headers=headers,
+        mimetype='application/json'
+    )
+
+
+def _failed(response):
+    if response.status_code >= 400:
+        return True
+    if not response.is_json:
+        return False
+
+    data = response.get_json(silent=True)
+    return isinstance(data, dict) and 'error' in data
+
+
+def current_key():
+    """Returns the idempotency key of the current request, None without one or when idempotency is off"""
+    if current_app.extensions.get('moop_idempotency') is None:
+        return None
+
+    return request.headers.get(IDEMPOTENCY_HEADER) or None
+
+
+def idempotent(f):
+    """Decorates a create view, runs it once per idempotency key"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        store = current_app.extensions.get('moop_idempotency')
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if store is None or not key:
+            return f(*args, **kwargs)
+
+        if len(key) > MAX_KEY_LENGTH:
+            return _error('{} is longer than {} characters'.format(IDEMPOTENCY_HEADER, MAX_KEY_LENGTH), 400)
+
+        route = request.url_rule.rule
+        digest = hashlib.sha256(request.method.encode())
+        digest.update(request.path.encode())
+        digest.update(request.get_data(cache=True))
+        fingerprint = digest.hexdigest()
+        entry_key = (request.method, request.path, key)
+
+        while True:
+            entry, first = store.claim(entry_key, fingerprint)
+            if entry.fingerprint != fingerprint:
+                IDEMPOTENT_REQUESTS.labels(route, 'mismatch').inc()
+                return _error('{} was already used with another request'.format(IDEMPOTENCY_HEADER), 422)
+            if first:
+                break
+
+            # attach to the attempt in flight, for as long as this request may take
+            deadline = resilience.current_deadline()
+            if not entry.done.wait(None if deadline is None else max(deadline.remaining(), 0)):
+                IDEMPOTENT_REQUESTS.labels(route, 'in_progress').inc()
+                return _error(
+                    'a request with this {} is still in progress'.format(IDEMPOTENCY_HEADER),
+                    409,
+                    headers={'Retry-After': '1'}
+                )
+            if entry.response is not None:
+                status, headers, body = entry.response
+                IDEMPOTENT_REQUESTS.labels(route, 'replayed').inc()
+                return Response(body, status=status, headers=headers + [(REPLAYED_HEADER, 'true')])
+            # the attempt failed and was forgotten, run it again
+
+        try:
+            response = current_app.make_response(f(*args, **kwargs))
+        except BaseException:
+            store.release(entry_key, entry)
+            raise
+
+        # services answer upstream failures with 4xx or an error body too, only a success is final
+        if response.is_streamed or _failed(response):
+            store.release(entry_key, entry)
+        else:
+            headers = [(name, value) for name, value in response.headers.items() if name != 'Content-Length']
+            store.complete(entry, response.status_code, headers, response.get_data())
+        IDEMPOTENT_REQUESTS.labels(route, 'first').inc()
+
+        return response
+
+    return decorated
+
+
+def install(app, ttl=3600.0, max_entries=10000):
+    """Keeps the answers of app's idempotent views, they run every time with ttl <= 0"""
+    if ttl <= 0:
+        return app
+
+    app.extensions['moop_idempotency'] = IdempotencyStore(ttl, max_entries)
+
+    return app
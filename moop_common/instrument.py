@@ -0,0 +1,97 @@
+"""Request instrumentation shared by the Flask services."""
+import time
+
+from flask import Response, g, request
+from werkzeug.wsgi import ClosingIterator
+
+from moop_common import logs, metrics, tracing
+
+metrics.CallbackMetric(
+    'moop_log_records_dropped_total',
+    'Log records dropped because the log queue was full.',
+    'counter',
+    lambda: [({'logger': name}, dropped) for name, dropped in logs.dropped_records().items()]
+)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_route = _route()
+    metrics.REQUESTS_IN_FLIGHT.labels(request.method, g.metrics_route).inc()
+
+    # continues the caller's trace, if it sent one
+    g.trace_span, g.trace_token = tracing.start_span(
+        '{} {}'.format(request.method, g.metrics_route),
+        request.headers.get(tracing.TRACEPARENT_HEADER),
+        method=request.method,
+        route=g.metrics_route
+    )
+
+
+def _finish_request(method, route, status, start, span, exc=None):
+    metrics.REQUESTS_IN_FLIGHT.labels(method, route).dec()
+    metrics.REQUEST_SECONDS.labels(method, route, str(status)).observe(time.perf_counter() - start)
+
+    if span is not None:
+        span.set_attribute('status', status)
+        tracing.end_span(span, None, exc)
+
+
+def _take_request():
+    # (start, route, span) of the request, the span is no longer current
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return None
+
+    span = g.pop('trace_span', None)
+    token = g.pop('trace_token', None)
+    if token is not None:
+        tracing.detach(token)
+
+    return start, g.pop('metrics_route'), span
+
+
+def _record_status(response):
+    g.metrics_status = response.status_code
+
+    if response.is_streamed:
+        # the body is sent after the request context is gone, eg. a followed log or
+        # an event stream, the request ends once the server closes the body; the body
+        # is wrapped since call_on_close is skipped with direct_passthrough
+        taken = _take_request()
+        if taken is not None:
+            start, route, span = taken
+            method, status = request.method, response.status_code
+            response.response = ClosingIterator(
+                response.response,
+                lambda: _finish_request(method, route, status, start, span)
+            )
+
+    return response
+
+
+def _end_request(exc):
+    taken = _take_request()
+    if taken is None:
+        return
+
+    start, route, span = taken
+    _finish_request(request.method, route, g.pop('metrics_status', 500), start, span, exc)
+
+
+def read_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def instrument_app(app):
+    """Times and traces every request, and serves GET /metrics"""
+    app.before_request(_start_request)
+    app.after_request(_record_status)
+    app.teardown_request(_end_request)
+    app.add_url_rule('/metrics', 'metrics', read_metrics, methods=['GET'])
+
+    return app
@@ -0,0 +1,538 @@
+"""Kubernetes client layer.
+
+The services share one ApiClient per process (``scope='process'``, the
+default) or keep one per thread (``scope='thread'``, for servers with a fixed
+thread pool). Clients are created on first use and re-created after a fork,
+so preforked workers never share the sockets of their parent.
+
+The urllib3 pool behind each client is sized with ``pool_maxsize``. It
+blocks for up to ``pool_timeout`` seconds when every connection is busy,
+instead of dialing a throwaway connection, and its sockets use TCP
+keep-alive. The time spent waiting for a pooled connection is recorded in
+``pool_stats``.
+
+Importing the kubernetes package is slow, so it is only imported on first
+use (or by ``preload``), together with loading the kube config: in-cluster
+when running in a pod, from ``.kube`` otherwise.
+
+Commands run in pods with ``exec_command``, over a websocket of a client
+each thread keeps for itself.
+
+Tenants may live on other clusters, named by a context of the kubeconfig.
+Each cluster gets its own lazily created client, pool and pool stats, and
+its calls go through its own circuit breaker, ``kubernetes-<context>``.
+``cluster_for`` reads a tenant's cluster from the ``tenant_clusters``
+mapping or the tenant document, None is the default cluster.
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+import urllib3
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from moop_common import metrics, resilience, tracing
+
+KUBE_UPSTREAM = 'kubernetes'
+
+_settings = {
+    # auto, incluster or kubeconfig
+    'config_mode': 'auto',
+    # read timeout cap for a single call, the request deadline may lower it
+    'request_timeout': None,
+    'connect_timeout': 5.0,
+    'pool_maxsize': 16,
+    # seconds to wait for a free pooled connection
+    'pool_timeout': 10.0,
+    'keepalive': True,
+    'scope': 'process',
+    # tenant id -> kube context, wins over the cluster named by the tenant document
+    'tenant_clusters': {},
+}
+
+
+def configure(**settings):
+    if settings.get('scope', 'process') not in ('process', 'thread'):
+        raise ValueError('unknown kubernetes client scope: {}'.format(settings['scope']))
+    if settings.get('config_mode', 'auto') not in ('auto', 'incluster', 'kubeconfig'):
+        raise ValueError('unknown kube config mode: {}'.format(settings['config_mode']))
+
+    _settings.update(settings)
+
+
+def __getattr__(name):
+    # lets services write `except kube.ApiException` without importing kubernetes up front
+    if name == 'ApiException':
+        from kubernetes.client.rest import ApiException
+        return ApiException
+
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+
+# config
+_config_loaded = False
+_config_lock = threading.Lock()
+
+
+def load_config():
+    """Loads the kube config once per process"""
+    global _config_loaded
+
+    if _config_loaded:
+        return
+
+    with _config_lock:
+        if _config_loaded:
+            return
+
+        from kubernetes import config
+
+        mode = _settings['config_mode']
+        if mode == 'auto':
+            mode = 'incluster' if os.getenv('KUBERNETES_SERVICE_HOST') else 'kubeconfig'
+
+        if mode == 'incluster':
+            config.load_incluster_config()
+        else:
+            config.load_kube_config()
+
+        _config_loaded = True
+
+
+def preload():
+    """Imports the kubernetes client and loads the kube config, eg. in a preforking master.
+
+    The API client itself is still created lazily, after the fork.
+    """
+    import kubernetes.client
+
+    load_config()
+
+
+def cluster_for(tenant):
+    """Returns the kube context of the tenant's cluster, None for the default one"""
+    return _settings['tenant_clusters'].get(tenant.get('id')) or tenant.get('cluster') or None
+
+
+def upstream_name(cluster=None):
+    return KUBE_UPSTREAM if cluster is None else '{}-{}'.format(KUBE_UPSTREAM, cluster)
+
+
+# pool metrics
+class PoolStats(object):
+    def __init__(self, cluster=None):
+        self.cluster = cluster
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.in_use = 0
+        self.dials = 0
+
+    def record_checkout(self, waited):
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_seconds += waited
+            if waited > 0.001:
+                self.waits += 1
+            if waited > self.max_wait_seconds:
+                self.max_wait_seconds = waited
+
+    def record_timeout(self, waited):
+        with self._lock:
+            self.timeouts += 1
+            self.wait_seconds += waited
+
+    def record_checkin(self):
+        with self._lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def record_dial(self):
+        with self._lock:
+            self.dials += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'cluster': self.cluster,
+                'scope': _settings['scope'],
+                'pool_maxsize': _settings['pool_maxsize'],
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_seconds_total': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'timeouts': self.timeouts,
+                'in_use': self.in_use,
+                'dials': self.dials,
+            }
+
+
+pool_stats = PoolStats()
+
+_cluster_pool_stats = {}
+_cluster_pool_stats_lock = threading.Lock()
+
+
+def get_pool_stats(cluster=None):
+    """Returns the pool stats of a cluster, kept across forks like the default ones"""
+    if cluster is None:
+        return pool_stats
+
+    with _cluster_pool_stats_lock:
+        if cluster not in _cluster_pool_stats:
+            _cluster_pool_stats[cluster] = PoolStats(cluster)
+        return _cluster_pool_stats[cluster]
+
+
+def all_pool_stats():
+    with _cluster_pool_stats_lock:
+        return [pool_stats] + [_cluster_pool_stats[cluster] for cluster in sorted(_cluster_pool_stats)]
+
+_POOL_SAMPLES = (
+    ('checkouts', 'moop_kube_pool_checkouts_total', 'counter', 'Connections taken from the kubernetes client pool.'),
+    ('waits', 'moop_kube_pool_waits_total', 'counter', 'Checkouts that had to wait for a free connection.'),
+    ('wait_seconds_total', 'moop_kube_pool_wait_seconds_total', 'counter', 'Time spent waiting for a free connection.'),
+    ('timeouts', 'moop_kube_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting for a free connection.'),
+    ('dials', 'moop_kube_pool_dials_total', 'counter', 'New connections opened by the pool.'),
+    ('in_use', 'moop_kube_pool_in_use', 'gauge', 'Connections checked out of the pool.'),
+    ('pool_maxsize', 'moop_kube_pool_maxsize', 'gauge', 'Connections kept in the pool.'),
+)
+
+for key, name, metric_type, documentation in _POOL_SAMPLES:
+    metrics.CallbackMetric(
+        name,
+        documentation,
+        metric_type,
+        # the default cluster's samples keep no label
+        lambda key=key: [
+            ({'cluster': stats.cluster} if stats.cluster else {}, stats.snapshot()[key])
+            for stats in all_pool_stats()
+        ]
+    )
+
+
+class _InstrumentedPoolMixin(object):
+    stats = pool_stats
+
+    def _get_conn(self, timeout=None):
+        if timeout is None:
+            timeout = _settings['pool_timeout']
+
+        start = time.monotonic()
+        try:
+            conn = super(_InstrumentedPoolMixin, self)._get_conn(timeout=timeout)
+        except urllib3.exceptions.EmptyPoolError:
+            self.stats.record_timeout(time.monotonic() - start)
+            raise
+
+        self.stats.record_checkout(time.monotonic() - start)
+        return conn
+
+    def _put_conn(self, conn):
+        self.stats.record_checkin()
+        super(_InstrumentedPoolMixin, self)._put_conn(conn)
+
+    def _new_conn(self):
+        self.stats.record_dial()
+        return super(_InstrumentedPoolMixin, self)._new_conn()
+
+
+class InstrumentedHTTPConnectionPool(_InstrumentedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSConnectionPool(_InstrumentedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+def _keepalive_options():
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+    # linux only, probe idle connections after 60s
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        options.extend([
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4),
+        ])
+
+    return options
+
+
+def _pool_classes(cluster):
+    if cluster is None:
+        return InstrumentedHTTPConnectionPool, InstrumentedHTTPSConnectionPool
+
+    # the pools of a cluster count into its own stats
+    stats = {'stats': get_pool_stats(cluster)}
+    return (
+        type('InstrumentedHTTPConnectionPool', (InstrumentedHTTPConnectionPool,), stats),
+        type('InstrumentedHTTPSConnectionPool', (InstrumentedHTTPSConnectionPool,), stats),
+    )
+
+
+# clients
+def _new_api_client(cluster=None):
+    import kubernetes.client
+
+    if cluster is None:
+        load_config()
+
+        if hasattr(kubernetes.client.Configuration, 'get_default_copy'):
+            configuration = kubernetes.client.Configuration.get_default_copy()
+        else:
+            # older clients return a copy of the default from the constructor
+            configuration = kubernetes.client.Configuration()
+    else:
+        from kubernetes import config
+
+        # other clusters are contexts of the kubeconfig, never the default configuration
+        configuration = kubernetes.client.Configuration()
+        config.load_kube_config(context=cluster, client_configuration=configuration)
+    configuration.connection_pool_maxsize = _settings['pool_maxsize']
+
+    api_client = kubernetes.client.ApiClient(configuration)
+    api_client._moop_cluster = cluster
+
+    http_pool, https_pool = _pool_classes(cluster)
+    pool_manager = api_client.rest_client.pool_manager
+    pool_manager.pool_classes_by_scheme = {
+        'http': http_pool,
+        'https': https_pool,
+    }
+    pool_manager.connection_pool_kw['block'] = True
+    if _settings['keepalive']:
+        socket_options = pool_manager.connection_pool_kw.get('socket_options') or HTTPConnection.default_socket_options
+        pool_manager.connection_pool_kw['socket_options'] = list(socket_options) + _keepalive_options()
+
+    return api_client
+
+
+_shared = {'pid': None, 'clients': {}}
+_shared_lock = threading.Lock()
+_local = threading.local()
+
+
+def api_client(cluster=None):
+    """Returns the ApiClient of a cluster for the current process or thread"""
+    pid = os.getpid()
+
+    if _settings['scope'] == 'thread':
+        if getattr(_local, 'pid', None) != pid:
+            _local.clients = {}
+            _local.pid = pid
+        if cluster not in _local.clients:
+            _local.clients[cluster] = _new_api_client(cluster)
+        return _local.clients[cluster]
+
+    clients = _shared['clients']
+    if _shared['pid'] != pid or cluster not in clients:
+        with _shared_lock:
+            if _shared['pid'] != pid:
+                _shared['clients'] = {}
+                _shared['pid'] = pid
+            if cluster not in _shared['clients']:
+                _shared['clients'][cluster] = _new_api_client(cluster)
+            clients = _shared['clients']
+
+    return clients[cluster]
+
+
+def _api(api_class, cluster=None):
+    import kubernetes.client
+
+    client = api_client(cluster)
+
+    # api objects are cheap, but keep one per client to avoid the churn
+    apis = client.__dict__.setdefault('_moop_apis', {})
+    if api_class not in apis:
+        apis[api_class] = getattr(kubernetes.client, api_class)(client)
+
+    return apis[api_class]
+
+
+def core_v1(cluster=None):
+    return _api('CoreV1Api', cluster)
+
+
+def apps_v1(cluster=None):
+    return _api('AppsV1Api', cluster)
+
+
+def storage_v1(cluster=None):
+    return _api('StorageV1Api', cluster)
+
+
+def dedicated_core_v1(cluster=None):
+    """Returns a CoreV1Api on a client of its own, for long-lived watches.
+
+    Its connections stay checked out for as long as a watch lasts, they must
+    not take the pool requests are served from, nor count in its stats.
+    """
+    import kubernetes.client
+
+    client = _new_api_client(cluster)
+    client.rest_client.pool_manager.pool_classes_by_scheme = {
+        'http': HTTPConnectionPool,
+        'https': HTTPSConnectionPool,
+    }
+
+    return kubernetes.client.CoreV1Api(client)
+
+
+_stream_local = threading.local()
+
+
+def stream_core_v1(cluster=None):
+    """Returns a CoreV1Api on a client of the calling thread, for exec.
+
+    kubernetes.stream swaps the transport of its client while a stream
+    opens, other threads must not send their requests through it meanwhile.
+    """
+    import kubernetes.client
+
+    pid = os.getpid()
+    if getattr(_stream_local, 'pid', None) != pid:
+        _stream_local.apis = {}
+        _stream_local.pid = pid
+    if cluster not in _stream_local.apis:
+        _stream_local.apis[cluster] = kubernetes.client.CoreV1Api(_new_api_client(cluster))
+
+    return _stream_local.apis[cluster]
+
+
+# calls
+def is_failure(e):
+    """Only server side and transport errors count against the breaker, 4xx are the caller's fault"""
+    from kubernetes.client.rest import ApiException
+
+    if isinstance(e, ApiException):
+        return not e.status or e.status == 429 or e.status >= 500
+
+    return isinstance(e, urllib3.exceptions.HTTPError)
+
+
+def request_timeout(read_timeout):
+    """Returns the (connect, read) timeout tuple for a call that may take read_timeout seconds"""
+    if read_timeout is None:
+        return (_settings['connect_timeout'], None)
+
+    return (min(_settings['connect_timeout'], read_timeout), read_timeout)
+
+
+def call(api, method, *args, timeout=None, **kwargs):
+    """Calls api.method with the remaining request deadline as its timeout"""
+    if timeout is None:
+        timeout = _settings['request_timeout']
+
+    name = upstream_name(getattr(api.api_client, '_moop_cluster', None))
+    with resilience.upstream(name, method, timeout=timeout, is_failure=is_failure) as upstream_call:
+        # the api server joins the trace when its tracing is enabled
+        headers = tracing.inject()
+        if headers:
+            kwargs['_headers'] = headers
+
+        return getattr(api, method)(
+            *args,
+            _request_timeout=request_timeout(upstream_call.timeout),
+            **kwargs
+        )
+
+
+def call_json(api, method, *args, timeout=None, **kwargs):
+    """Like call, but answers the parsed json body instead of a model.
+
+    Skips the model deserialization, which is most of the cost of a large
+    list, and keeps what the models drop, eg. the deleted objects a
+    delete collection answers with.
+    """
+    if timeout is None:
+        timeout = _settings['request_timeout']
+
+    name = upstream_name(getattr(api.api_client, '_moop_cluster', None))
+    with resilience.upstream(name, method, timeout=timeout, is_failure=is_failure) as upstream_call:
+        headers = tracing.inject()
+        if headers:
+            kwargs['_headers'] = headers
+
+        response = getattr(api, method)(
+            *args,
+            _preload_content=False,
+            _request_timeout=request_timeout(upstream_call.timeout),
+            **kwargs
+        )
+        try:
+            return json.loads(response.data)
+        finally:
+            response.release_conn()
+
+
+def exec_command(name, namespace, command, container=None, timeout=None, max_output=None, cluster=None):
+    """Runs command in a container of a running pod.
+
+    Returns (exit code, stdout, stderr, truncated). The exit code is None when
+    the command did not exit within timeout, capped by the request deadline,
+    it is left running in the pod then. Each stream keeps its first
+    max_output characters, truncated tells whether any were dropped.
+    """
+    from kubernetes.stream import stream
+
+    api = stream_core_v1(cluster)
+    kwargs = {'stdin': False, 'stdout': True, 'stderr': True, 'tty': False}
+    if container:
+        kwargs['container'] = container
+
+    # only opening the stream counts for the breaker, the command takes its own time
+    with resilience.upstream(upstream_name(cluster), 'exec_namespaced_pod', timeout=_settings['request_timeout']) as upstream_call:
+        ws = stream(
+            api.connect_get_namespaced_pod_exec,
+            name,
+            namespace,
+            command=command,
+            _preload_content=False,
+            _request_timeout=request_timeout(upstream_call.timeout),
+            **kwargs
+        )
+
+    timeout = resilience.upstream_timeout(timeout)
+    end = None if timeout is None else time.monotonic() + timeout
+    output = {1: [], 2: []}
+    sizes = {1: 0, 2: 0}
+    truncated = False
+    try:
+        while True:
+            for channel in (1, 2):
+                data = ws.read_channel(channel)
+                if not data:
+                    continue
+                if max_output is not None and sizes[channel] + len(data) > max_output:
+                    data = data[:max(max_output - sizes[channel], 0)]
+                    truncated = True
+                output[channel].append(data)
+                sizes[channel] += len(data)
+
+            if not ws.is_open():
+                break
+            left = None if end is None else end - time.monotonic()
+            if left is not None and left <= 0:
+                return None, ''.join(output[1]), ''.join(output[2]), truncated
+            ws.update(timeout=left)
+
+        try:
+            exit_code = ws.returncode
+        except (TypeError, KeyError, IndexError, ValueError):
+            # closed without the status of the command, eg. the pod went away
+            from kubernetes.client.rest import ApiException
+            raise ApiException(status=0, reason='exec stream of {} closed without an exit status'.format(name))
+
+        return exit_code, ''.join(output[1]), ''.join(output[2]), truncated
+    finally:
+        # nothing more is read, do not wait for the close handshake
+        ws.close(timeout=0)
@@ -0,0 +1,186 @@
+"""Non-blocking structured logging.
+
+setup_logging() puts a queue handler on a service logger. Request threads
+only append records to a bounded queue; a listener thread formats them and
+writes to stdout. When the queue is full the record is dropped and counted,
+so a slow stdout can never stall a request.
+
+Records are formatted on the listener thread, message args and exception
+traces included, so pass args instead of formatting up front:
+
+    logger.error('Request Error: %s', e, exc_info=True)
+
+RateLimitFilter keeps a token bucket per (logger, level, message template).
+Once a message repeats faster than the bucket allows, only every Nth record
+is kept, carrying the number of records suppressed since the last one.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line"""
+
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'file': record.filename,
+            'line': record.lineno,
+            'func': record.funcName,
+            'pid': record.process,
+            'thread': record.threadName,
+        }
+
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        if getattr(record, 'suppressed', 0):
+            data['suppressed'] = record.suppressed
+
+        # logger.info('...', extra={'fields': {...}}) adds structured fields
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        text = super(TextFormatter, self).format(record)
+
+        if getattr(record, 'suppressed', 0):
+            text = '{} [{} similar records suppressed]'.format(text, record.suppressed)
+
+        return text
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super(NonBlockingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # not locked, an approximate count is good enough
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    # buckets are keyed by message template, forget them all past this many
+    MAX_KEYS = 1024
+
+    def __init__(self, rate, burst, sample_every):
+        super(RateLimitFilter, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = max(sample_every, 1)
+
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else type(record.msg))
+        now = time.monotonic()
+
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_KEYS:
+                    self._buckets.clear()
+                # [tokens, last refill, suppressed since last kept record]
+                bucket = self._buckets[key] = [self.burst, now, 0]
+
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+            else:
+                bucket[2] += 1
+                if bucket[2] % self.sample_every != 0:
+                    return False
+
+            if bucket[2]:
+                record.suppressed = bucket[2]
+                bucket[2] = 0
+
+        return True
+
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def _start_listener(handler, stream):
+    output = logging.StreamHandler(stream=stream)
+    output.setFormatter(handler.formatter)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=False)
+    listener.start()
+
+    return listener
+
+
+def _restart_listeners():
+    # the listener thread does not survive fork, give the child its own queue and thread
+    for name, (handler, listener, stream) in list(_listeners.items()):
+        handler.queue = queue.Queue(handler.queue.maxsize)
+        _listeners[name] = (handler, _start_listener(handler, stream), stream)
+
+
+def _stop_listeners():
+    for handler, listener, stream in list(_listeners.values()):
+        listener.stop()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listeners)
+atexit.register(_stop_listeners)
+
+
+def setup_logging(logger, level, fmt, style='json', queue_size=10000, rate=0, burst=10, sample_every=100, stream=None):
+    """Attaches a non-blocking handler to logger, once per logger.
+
+    style is json or text (fmt is the text format). rate is records per
+    second allowed per message template, 0 disables rate limiting.
+    """
+    with _listeners_lock:
+        if logger.name not in _listeners:
+            handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+            handler.setFormatter(JsonFormatter() if style == 'json' else TextFormatter(fmt))
+
+            stream = stream or sys.stdout
+            _listeners[logger.name] = (handler, _start_listener(handler, stream), stream)
+
+            logger.addHandler(handler)
+            # records stop here, they would block again in a root handler
+            logger.propagate = False
+
+            if rate > 0:
+                logger.addFilter(RateLimitFilter(rate, burst, sample_every))
+
+    logger.setLevel(level)
+
+    return logger
+
+
+def dropped_records():
+    """Records dropped because the queue was full, per logger"""
+    return {name: handler.dropped for name, (handler, listener, stream) in _listeners.items()}
@@ -0,0 +1,257 @@
+"""Minimal Prometheus metrics.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text format by ``render()``. Recording is a dict lookup plus an
+uncontended lock, cheap enough for the request path. Values that already
+live elsewhere (pool stats, breaker states) are exported by callback
+metrics, read only when scraped.
+
+Values are per process: with several workers each scrape sees the worker
+that answered it.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._lock = threading.Lock()
+        self._children = {}
+
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+
+        return child
+
+    def _samples(self):
+        with self._lock:
+            children = list(self._children.items())
+
+        for values, child in children:
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, _format_labels(self.labelnames, values, extra), value
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for name, labels, value in self._samples():
+            lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+
+        return '\n'.join(lines)
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', None, self.value)]
+
+
+class Counter(_Metric):
+    # name it with the _total suffix
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class _GaugeChild(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def samples(self):
+        return [('', None, self.value)]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append(('_bucket', 'le="{}"'.format(_format_value(bound)), cumulative))
+        samples.append(('_sum', None, total))
+        samples.append(('_count', None, cumulative))
+
+        return samples
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class CallbackMetric(object):
+    """Reads its samples from callback() at scrape time.
+
+    callback returns a list of (labels dict, value).
+    """
+
+    def __init__(self, name, documentation, metric_type, callback, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.type = metric_type
+        self.callback = callback
+
+        (registry or REGISTRY).register(self)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for labels, value in self.callback():
+            names = sorted(labels)
+            lines.append('{}{} {}'.format(
+                self.name,
+                _format_labels(names, [labels[name] for name in names]),
+                _format_value(value)
+            ))
+
+        return '\n'.join(lines)
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError('metric {} is already registered'.format(metric.name))
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def render():
+    return REGISTRY.render()
+
+
+# shared by all services
+REQUEST_SECONDS = Histogram(
+    'moop_http_request_duration_seconds',
+    'Time spent answering requests, by route.',
+    ['method', 'route', 'status']
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'moop_http_requests_in_flight',
+    'Requests being answered, by route.',
+    ['method', 'route']
+)
+UPSTREAM_SECONDS = Histogram(
+    'moop_upstream_request_duration_seconds',
+    'Time spent in calls to upstreams (tenant-service, jupyterhub, kubernetes), by operation.',
+    ['target', 'operation', 'outcome']
+)
+UPSTREAM_REJECTED = Counter(
+    'moop_upstream_rejected_total',
+    'Upstream calls failed fast because the circuit breaker was open.',
+    ['target']
+)
@@ -0,0 +1,208 @@
+"""On-demand profiling.
+
+Off unless a profiling token is configured: without one no hook is
+installed and requests pay nothing. With a token, a caller that sends it in
+``PROFILE_TOKEN_HEADER`` can
+
+- profile a single request, by sending ``X-Profile: cprofile`` (deterministic,
+  saved as a pstats file) or ``X-Profile: sample`` (stack sampling, saved as
+  folded stacks), or the same in the ``profile`` query parameter. The saved
+  file is named in the ``X-Profile-File`` response header.
+- sample every thread of the worker process for some seconds with
+  ``GET /debug/profile?seconds=N``, answered with folded stacks, the input
+  format of flamegraph.pl and speedscope.
+
+Only one request per process is profiled at a time, others run as usual.
+"""
+from collections import Counter
+import cProfile
+import hmac
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import Response, g, request
+
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+PROFILE_FILE_HEADER = 'X-Profile-File'
+
+MODES = ('cprofile', 'sample')
+
+_settings = {
+    'token': '',
+    'output_dir': os.path.join(tempfile.gettempdir(), 'moop-profiles'),
+    'max_seconds': 60.0,
+    'interval': 0.005,
+}
+
+# one profiled request per process, profilers do not nest
+_busy = threading.Lock()
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler(object):
+    """Samples the stacks of one thread, or of all threads but its own"""
+
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = 0
+        self.stacks = Counter()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='moop-profiler', daemon=True)
+
+    def _run(self):
+        own = threading.get_ident()
+
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or (self.thread_id is not None and thread_id != self.thread_id):
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        """One 'frame;frame;frame count' line per stack"""
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common())
+
+
+def _authorized():
+    token = request.headers.get(PROFILE_TOKEN_HEADER, '')
+    return hmac.compare_digest(token.encode(), _settings['token'].encode())
+
+
+def _output_path(suffix):
+    os.makedirs(_settings['output_dir'], exist_ok=True)
+
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    name = '{}-{}-{}-{}-{}.{}'.format(
+        time.strftime('%Y%m%dT%H%M%S'),
+        request.method,
+        re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_'),
+        os.getpid(),
+        uuid.uuid4().hex[:8],
+        suffix
+    )
+
+    return os.path.join(_settings['output_dir'], name)
+
+
+def _start_profile():
+    mode = request.headers.get(PROFILE_HEADER) or request.args.get('profile')
+    if mode not in MODES or not _authorized():
+        return
+
+    if not _busy.acquire(blocking=False):
+        return
+
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is active in this interpreter
+            _busy.release()
+            return
+    else:
+        profiler = StackSampler(_settings['interval'], threading.get_ident()).start()
+
+    g.profile = (mode, profiler)
+
+
+def _stop_profile():
+    mode, profiler = g.pop('profile')
+
+    try:
+        if mode == 'cprofile':
+            profiler.disable()
+        else:
+            profiler.stop()
+    finally:
+        _busy.release()
+
+    return mode, profiler
+
+
+def _save_profile(response):
+    if 'profile' not in g:
+        return response
+
+    mode, profiler = _stop_profile()
+
+    if mode == 'cprofile':
+        path = _output_path('prof')
+        profiler.dump_stats(path)
+    else:
+        path = _output_path('folded')
+        with open(path, 'w') as f:
+            f.write(profiler.folded())
+
+    response.headers[PROFILE_FILE_HEADER] = path
+    return response
+
+
+def _abort_profile(exc):
+    # after_request did not run, stop without saving
+    if 'profile' in g:
+        _stop_profile()
+
+
+def sample_process():
+    """GET /debug/profile?seconds=N, samples all threads for N seconds"""
+    if not _authorized():
+        return Response(status=404)
+
+    try:
+        seconds = min(float(request.args.get('seconds', '10')), _settings['max_seconds'])
+        interval = max(float(request.args.get('interval', _settings['interval'])), 0.001)
+    except ValueError:
+        return Response('seconds and interval must be numbers\n', status=400, mimetype='text/plain')
+
+    sampler = StackSampler(interval).start()
+    time.sleep(max(seconds, 0))
+    sampler.stop()
+
+    return Response(
+        sampler.folded(),
+        mimetype='text/plain',
+        headers={'X-Profile-Samples': str(sampler.samples)}
+    )
+
+
+def install(app, token, output_dir=None, max_seconds=60.0, interval=0.005):
+    """Adds the profiling hooks and GET /debug/profile to app, does nothing without a token"""
+    if not token:
+        return app
+
+    _settings.update(token=token, max_seconds=max_seconds, interval=interval)
+    if output_dir:
+        _settings['output_dir'] = output_dir
+
+    app.before_request(_start_profile)
+    app.after_request(_save_profile)
+    app.teardown_request(_abort_profile)
+    app.add_url_rule('/debug/profile', 'debug_profile', sample_process, methods=['GET'])
+
+    return app
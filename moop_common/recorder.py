@@ -0,0 +1,245 @@
+"""Request recording for replay.
+
+Off unless a record directory is configured: without one no hook is
+installed and requests pay nothing. When on, a sampled share of the
+requests to the service's routes is written as one json object per line to
+a gzip file per worker process, by a background thread:
+
+- ``time``, ``duration``: when the request arrived and how long it took
+- ``service``, ``method``, ``route``, ``status``, ``error`` (the body had an
+  ``error`` key)
+- ``query``, ``body``: the parameters with their shape kept and every string
+  replaced by a salted hash, the same value gets the same hash in every
+  worker sharing the salt
+- ``created``: the hashed ``metadata.name`` of the object answered, so a
+  replay can pass the name it gets back to the requests that use it
+- ``upstream``: ``[target, operation, outcome, seconds]`` of every upstream
+  call made while serving the request
+
+Recording needs a salt: an unsalted hash of a username or an image name is
+found again by hashing the candidate values, so ``install`` refuses to
+record without one.
+
+Recordings are replayed by ``loadtest/replay.py``.
+"""
+import atexit
+import contextvars
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+from flask import g, request
+
+from moop_common import resilience
+
+HASH_PREFIX = 'h:'
+
+_settings = {
+    'directory': None,
+    'service': None,
+    'sample_ratio': 1.0,
+    'salt': b'',
+}
+
+# responses larger than this are not parsed for the created name
+_MAX_PARSED_RESPONSE = 64 * 1024
+
+_current_record = contextvars.ContextVar('moop_record', default=None)
+
+
+def anonymize(value, salt=None):
+    """Returns value with its shape kept and every string replaced by a salted hash"""
+    if isinstance(value, str):
+        digest = hmac.new(_settings['salt'] if salt is None else salt, value.encode(), hashlib.sha256)
+        return HASH_PREFIX + digest.hexdigest()[:16]
+    if isinstance(value, dict):
+        return {key: anonymize(item, salt) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [anonymize(item, salt) for item in value]
+
+    return value
+
+
+class RecordWriter(object):
+    """Writes records from a queue to a gzip file, one file per process"""
+
+    def __init__(self, directory, service, queue_size=10000, flush_interval=1.0):
+        self.directory = directory
+        self.service = service
+        self.flush_interval = flush_interval
+        self.dropped = 0
+
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # a forked worker starts its own thread and file
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._queue = queue.Queue(self._queue.maxsize)
+            self._thread = threading.Thread(target=self._run, name='moop-recorder', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _path(self):
+        name = '{}-{}-{}.jsonl.gz'.format(self.service, time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        return os.path.join(self.directory, name)
+
+    def _run(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        with gzip.open(self._path(), 'wt') as f:
+            pending = False
+            while True:
+                try:
+                    record = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    if pending:
+                        # readable while the service runs
+                        f.flush()
+                        pending = False
+                    continue
+
+                if record is None:
+                    return
+
+                f.write(json.dumps(record, default=str, sort_keys=True))
+                f.write('\n')
+                pending = True
+
+    def submit(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+        self._pid = None
+
+
+_writer = None
+
+
+def _close_writer():
+    if _writer is not None:
+        _writer.close()
+
+
+atexit.register(_close_writer)
+
+
+# hooks
+def _record_upstream(name, operation, outcome, elapsed):
+    record = _current_record.get()
+    if record is not None:
+        record['upstream'].append([name, operation, outcome, round(elapsed, 6)])
+
+
+def _start_record():
+    # only the service's own routes, not /metrics or the debug routes
+    if request.blueprint is None or random.random() >= _settings['sample_ratio']:
+        return
+
+    record = {
+        'time': time.time(),
+        'service': _settings['service'],
+        'method': request.method,
+        'route': request.url_rule.rule,
+        'query': anonymize(request.args.to_dict()),
+        'body': anonymize(request.get_json(silent=True)),
+        'upstream': [],
+    }
+    g.record = record
+    g.record_start = time.perf_counter()
+    g.record_token = _current_record.set(record)
+
+
+def _record_response(response):
+    record = g.get('record')
+    if record is None:
+        return response
+
+    record['status'] = response.status_code
+
+    if response.is_json and not response.is_streamed and (response.content_length or 0) <= _MAX_PARSED_RESPONSE:
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            record['error'] = 'error' in data
+            name = (data.get('metadata') or {}).get('name')
+            if name:
+                record['created'] = anonymize(name)
+
+    return response
+
+
+def _end_record(exc):
+    record = g.pop('record', None)
+    if record is None:
+        return
+
+    record['duration'] = round(time.perf_counter() - g.pop('record_start'), 6)
+    record.setdefault('status', 500)
+    _current_record.reset(g.pop('record_token'))
+
+    _writer.submit(record)
+
+
+def install(app, directory, service, sample_ratio=1.0, salt=''):
+    """Records the requests to app's routes under directory, does nothing without one"""
+    global _writer
+
+    if not directory:
+        return app
+    if not salt:
+        raise ValueError('recording to {} needs a salt, set RECORD_SALT'.format(directory))
+
+    _settings.update(directory=directory, service=service, sample_ratio=sample_ratio, salt=salt.encode())
+    _writer = RecordWriter(directory, service)
+
+    resilience.add_upstream_listener(_record_upstream)
+    app.before_request(_start_record)
+    app.after_request(_record_response)
+    app.teardown_request(_end_record)
+
+    return app
+
+
+# reading
+def read_records(paths):
+    """Yields the records in the given files and directories, a file cut short ends early"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl.gz'))))
+        else:
+            files.append(path)
+
+    for path in files:
+        with gzip.open(path, 'rt') as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, ValueError):
+                # the service is still writing this file, or was killed
+                continue
@@ -0,0 +1,341 @@
+"""Per-request deadlines and per-upstream circuit breakers.
+
+A deadline is started for every incoming request and stored in a context
+variable, so every upstream call made while serving the request (tenant
+service, jupyterhub, kubernetes) only gets the time that is left. The
+remaining time is also sent to upstreams in ``DEADLINE_HEADER``.
+
+Each upstream has its own circuit breaker. After ``failure_threshold``
+consecutive failures the breaker opens and calls fail fast with
+``CircuitOpenError``; after ``recovery_timeout`` seconds it lets a limited
+number of probe calls through (half-open) and closes again on success.
+"""
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+from moop_common import metrics, tracing
+
+DEADLINE_HEADER = 'X-Request-Deadline'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name, retry_after):
+        super(CircuitOpenError, self).__init__('circuit breaker for {} is open'.format(name))
+        self.name = name
+        self.retry_after = max(retry_after, 0)
+
+
+# deadlines
+class Deadline(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+_current_deadline = contextvars.ContextVar('moop_deadline', default=None)
+
+
+def start_deadline(timeout):
+    """Starts a deadline for the current context, returns a token for clear_deadline"""
+    return _current_deadline.set(Deadline(timeout))
+
+
+def clear_deadline(token=None):
+    if token is None:
+        _current_deadline.set(None)
+        return
+
+    try:
+        _current_deadline.reset(token)
+    except ValueError:
+        # token was created in another context
+        _current_deadline.set(None)
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+def deadline_expired():
+    deadline = _current_deadline.get()
+    return deadline is not None and deadline.expired()
+
+
+def upstream_timeout(limit=None):
+    """Returns the timeout for an upstream call.
+
+    This is ``limit`` capped by what is left of the current deadline, or
+    ``limit`` if there is no deadline. Raises DeadlineExceeded if the deadline
+    has already passed.
+    """
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return limit
+
+    left = deadline.remaining()
+    if left <= 0:
+        raise DeadlineExceeded('request deadline of {}s exceeded'.format(deadline.timeout))
+
+    return left if limit is None else min(limit, left)
+
+
+def parse_deadline_header(value, limit):
+    """Returns the deadline for an incoming request, honouring the caller's header"""
+    if not value:
+        return limit
+
+    try:
+        timeout = float(value)
+    except ValueError:
+        return limit
+
+    if timeout <= 0:
+        return limit
+
+    return min(timeout, limit)
+
+
+def deadline_headers(headers=None):
+    """Returns headers with the remaining deadline and the trace context added, for calls to our own upstreams"""
+    headers = tracing.inject(headers)
+
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        headers[DEADLINE_HEADER] = '{:.3f}'.format(max(deadline.remaining(), 0))
+
+    return headers
+
+
+def sleep(seconds):
+    """Sleeps for seconds, but never past the current deadline"""
+    deadline = _current_deadline.get()
+    if deadline is not None:
+        seconds = min(seconds, max(deadline.remaining(), 0))
+
+    time.sleep(seconds)
+
+
+# circuit breakers
+class CircuitBreaker(object):
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        # caller holds the lock
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+
+        return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._probes = 0
+
+    def before_call(self):
+        with self._lock:
+            state = self._current_state()
+
+            if state == OPEN:
+                raise CircuitOpenError(
+                    self.name,
+                    self.recovery_timeout - (time.monotonic() - self._opened_at)
+                )
+
+            if state == HALF_OPEN:
+                if self._probes >= self.half_open_max_calls:
+                    # a probe is already in flight, keep failing fast until it reports
+                    raise CircuitOpenError(self.name, 1)
+                self._probes += 1
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probes = 0
+
+    def record_failure(self):
+        with self._lock:
+            if self._current_state() == HALF_OPEN:
+                self._open()
+                return
+
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open()
+
+    def release(self):
+        """Ends a call that neither succeeded nor failed, eg. our own deadline ran out"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+
+BREAKER_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+_breaker_defaults = {
+    'failure_threshold': 5,
+    'recovery_timeout': 30.0,
+    'half_open_max_calls': 1,
+}
+
+
+def configure_breakers(**defaults):
+    """Sets the defaults used for breakers created after this call"""
+    _breaker_defaults.update(defaults)
+
+
+def get_breaker(name):
+    breaker = _breakers.get(name)
+    if breaker is not None:
+        return breaker
+
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_breaker_defaults)
+        return _breakers[name]
+
+
+def breakers():
+    with _breakers_lock:
+        return list(_breakers.values())
+
+
+metrics.CallbackMetric(
+    'moop_circuit_breaker_state',
+    'Circuit breaker state by upstream, 0 closed, 1 half-open, 2 open.',
+    'gauge',
+    lambda: [({'target': breaker.name}, BREAKER_STATES[breaker.state]) for breaker in breakers()]
+)
+
+
+# upstream calls
+def is_request_failure(e):
+    """Failure classifier for calls made with requests"""
+    import requests
+
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+_upstream_listeners = []
+
+
+def add_upstream_listener(listener):
+    """listener(name, operation, outcome, seconds) is called on the calling thread after every upstream call.
+
+    Adding a listener again does nothing, every app factory call may add it.
+    """
+    if listener not in _upstream_listeners:
+        _upstream_listeners.append(listener)
+
+
+def _observe(name, operation, outcome, elapsed):
+    metrics.UPSTREAM_SECONDS.labels(name, operation, outcome).observe(elapsed)
+
+    for listener in _upstream_listeners:
+        try:
+            listener(name, operation, outcome, elapsed)
+        except Exception:
+            # listeners must never fail the call
+            pass
+
+
+class UpstreamCall(object):
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.failed = False
+
+    def fail(self):
+        """Marks the call as failed even though it returned, eg. on a 5xx response"""
+        self.failed = True
+
+
+@contextmanager
+def upstream(name, operation='', timeout=None, is_failure=None):
+    """Guards one call to the named upstream.
+
+    Yields an UpstreamCall whose ``timeout`` is what the call may use. The
+    upstream's breaker is updated with the outcome: exceptions matching
+    ``is_failure`` (all exceptions if not given) and calls marked with
+    ``fail()`` count as failures. The call is timed by target and operation,
+    and traced as a span; send ``tracing.inject()`` headers to continue the
+    trace upstream.
+    """
+    # an expired deadline must not count against the upstream
+    call = UpstreamCall(upstream_timeout(timeout))
+
+    breaker = get_breaker(name)
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        metrics.UPSTREAM_REJECTED.labels(name).inc()
+        raise
+
+    outcome = None
+    with tracing.span(' '.join(filter(None, (name, operation))), target=name, operation=operation) as span:
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception as e:
+            elapsed = time.perf_counter() - start
+
+            if deadline_expired():
+                # the upstream only got the time that was left
+                breaker.release()
+                outcome = 'deadline'
+                _observe(name, operation, outcome, elapsed)
+                raise DeadlineExceeded('request deadline exceeded calling {}'.format(name)) from e
+
+            if is_failure is None or is_failure(e):
+                breaker.record_failure()
+                outcome = 'error'
+            else:
+                breaker.record_success()
+                outcome = 'ok'
+            _observe(name, operation, outcome, elapsed)
+            raise
+        else:
+            elapsed = time.perf_counter() - start
+            if call.failed:
+                breaker.record_failure()
+                outcome = 'error'
+            else:
+                breaker.record_success()
+                outcome = 'ok'
+            _observe(name, operation, outcome, elapsed)
+        finally:
+            if span is not None and outcome is not None:
+                span.set_attribute('outcome', outcome)
@@ -0,0 +1,180 @@
+"""A local copy of tenant-service, kept up to date by its change feed.
+
+TenantMirror lists the tenants once, then long-polls
+``{url}/changes?since=<version>`` and applies every change it gets, so a
+tenant lookup is a dict read instead of a call to tenant-service. When the
+feed answers 410, the mirror fell behind it and lists the tenants again.
+
+A lookup returns None whenever the copy cannot be trusted: before the first
+list, once the feed was not heard from for ``stale_after`` seconds, and for
+ids the copy does not know, eg. a tenant created a moment ago. The caller
+then asks tenant-service as before, so the mirror only ever saves calls.
+
+The poll thread is started per worker process on its first lookup.
+"""
+import copy
+import json
+import os
+import threading
+import time
+
+import requests
+
+from moop_common import metrics, resilience
+
+MIRROR_LOOKUPS = metrics.Counter(
+    'moop_tenant_mirror_lookups_total',
+    'Tenant lookups by outcome, all but hit ask tenant-service.',
+    ['outcome']
+)
+MIRROR_RESYNCS = metrics.Counter(
+    'moop_tenant_mirror_resyncs_total',
+    'Full lists of the tenants, by reason.',
+    ['reason']
+)
+MIRROR_VERSION = metrics.Gauge(
+    'moop_tenant_mirror_version',
+    'Feed version the local copy is at.'
+)
+
+
+class TenantResponse(object):
+    """Answers a lookup the way a requests response from tenant-service does"""
+    status_code = 200
+
+    def __init__(self, tenant):
+        self._tenant = tenant
+
+    @property
+    def text(self):
+        return json.dumps(self._tenant, indent=1, sort_keys=True)
+
+    def json(self):
+        # callers render the tenant's templates in place
+        return copy.deepcopy(self._tenant)
+
+
+class TenantMirror(object):
+    def __init__(self, url, poll_timeout=20.0, request_timeout=5.0, retry_interval=5.0, stale_after=60.0,
+                 upstream_name='tenant-service', logger=None):
+        self.url = url.rstrip('/')
+        self.poll_timeout = poll_timeout
+        self.request_timeout = request_timeout
+        self.retry_interval = retry_interval
+        self.stale_after = stale_after
+        self.upstream_name = upstream_name
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._tenants = {}
+        self._epoch = None
+        # None until the first list
+        self._version = None
+        self._heard = 0.0
+        self._stop = threading.Event()
+        self._pid = None
+
+    @property
+    def synced(self):
+        return self._version is not None and time.monotonic() - self._heard < self.stale_after
+
+    def lookup(self, tenant_id):
+        """Returns a TenantResponse, None when tenant-service has to be asked"""
+        self.start()
+
+        with self._lock:
+            if not self.synced:
+                MIRROR_LOOKUPS.labels('unsynced').inc()
+                return None
+            tenant = self._tenants.get(tenant_id)
+
+        if tenant is None:
+            MIRROR_LOOKUPS.labels('miss').inc()
+            return None
+
+        MIRROR_LOOKUPS.labels('hit').inc()
+        return TenantResponse(tenant)
+
+    def _get(self, operation, path, params=None, timeout=None):
+        with resilience.upstream(
+            self.upstream_name,
+            operation,
+            timeout=timeout or self.request_timeout,
+            is_failure=resilience.is_request_failure
+        ) as call:
+            resp = requests.get('{}{}'.format(self.url, path), params=params, timeout=call.timeout)
+            if resp.status_code >= 500:
+                call.fail()
+
+        return resp
+
+    def sync(self, reason='start'):
+        resp = self._get('list_tenants', '')
+        resp.raise_for_status()
+        data = resp.json()
+
+        with self._lock:
+            self._tenants = {tenant['id']: tenant for tenant in data['tenants']}
+            self._epoch = data['epoch']
+            self._version = data['version']
+            self._heard = time.monotonic()
+
+        MIRROR_RESYNCS.labels(reason).inc()
+        MIRROR_VERSION.labels().set(data['version'])
+        if self.logger is not None:
+            self.logger.info('Tenant mirror synced: %d tenants at version %d', len(data['tenants']), data['version'])
+
+    def poll_once(self):
+        """Applies the changes of one long poll, lists the tenants again if the feed moved on"""
+        if self._version is None:
+            return self.sync()
+
+        resp = self._get(
+            'watch_tenants',
+            '/changes',
+            params={'since': self._version, 'epoch': self._epoch, 'timeout': self.poll_timeout},
+            # the feed answers within poll_timeout, empty if nothing changed
+            timeout=self.poll_timeout + self.request_timeout
+        )
+        if resp.status_code == 410:
+            return self.sync('expired')
+        resp.raise_for_status()
+        data = resp.json()
+
+        with self._lock:
+            for change in data['changes']:
+                if change['type'] == 'delete':
+                    self._tenants.pop(change['id'], None)
+                else:
+                    self._tenants[change['id']] = change['tenant']
+            self._version = data['version']
+            self._heard = time.monotonic()
+
+        MIRROR_VERSION.labels().set(data['version'])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                # lookups go to tenant-service once the copy is stale
+                if self.logger is not None:
+                    self.logger.warning('Tenant Mirror Error: %s', e)
+                self._stop.wait(self.retry_interval)
+
+    def start(self):
+        # threads do not survive a fork, every worker keeps its own copy
+        if self._pid == os.getpid():
+            return self
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._tenants = {}
+                self._version = None
+                threading.Thread(target=self._run, name='tenant-mirror', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
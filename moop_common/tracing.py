@@ -0,0 +1,361 @@
+"""Request tracing.
+
+A span times one phase of a request (the incoming request itself, a launch
+phase, a tenant lookup, an upstream call). The current span lives in a
+context variable, so spans opened while serving a request nest under it
+without being passed around.
+
+Trace context is read from and sent to upstreams in the W3C ``traceparent``
+header, so the spans of the launcher, the hub, pod/volume-service and
+tenant-service calls can be joined into one trace. The sampling decision
+travels with it: a trace that is not recorded is passed on with the
+sampled flag off, and the upstreams leave it out too.
+
+Finished spans go to the configured exporter:
+
+- ``none``: tracing is off, ``span()`` does nothing
+- ``log``: a json log record per span on the service logger
+- ``file``: one json object per line appended to a file, written by a
+  background thread
+- ``module:callable``: callable(span_dict) is called for every span, on the
+  request thread, so it must not block
+
+Span files are summarized, slowest traces with their critical path first:
+
+    python -m moop_common.tracing summarize spans.jsonl
+"""
+from contextlib import contextmanager
+import contextvars
+import importlib
+import json
+import logging
+import random
+import re
+import secrets
+import sys
+import time
+
+from moop_common.logs import setup_logging
+
+TRACEPARENT_HEADER = 'traceparent'
+
+_TRACEPARENT = re.compile(r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_settings = {
+    'service': None,
+    'sample_ratio': 1.0,
+}
+_export = None
+
+
+class Span(object):
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, sampled=True):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        # an unsampled span is not exported, it carries the decision to its children and upstreams
+        self.sampled = sampled
+        self.attributes = dict(attributes) if attributes else {}
+        self.error = None
+
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, e):
+        self.error = '{}: {}'.format(type(e).__name__, e)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def traceparent(self):
+        return '00-{}-{}-{}'.format(self.trace_id, self.span_id, '01' if self.sampled else '00')
+
+    def to_dict(self):
+        data = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': _settings['service'],
+            'start': self.start_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+        if self.error:
+            data['error'] = self.error
+
+        return data
+
+
+# exporters
+class _SpanLine(object):
+    # serialized on the log listener thread, not on the request thread
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, default=str, sort_keys=True)
+
+
+def _log_exporter(logger):
+    # a child logger is not held back by the service logger's rate limit
+    trace_logger = logging.getLogger('{}.trace'.format(logger.name))
+    trace_logger.setLevel(logging.INFO)
+
+    def export(data):
+        trace_logger.info(
+            'span %s %.3fs',
+            data['name'], data['duration'],
+            extra={'fields': {'span': data}}
+        )
+
+    return export
+
+
+def _file_exporter(path):
+    trace_logger = logging.getLogger('moop.trace.file')
+    setup_logging(trace_logger, logging.INFO, '%(message)s', style='text', stream=open(path, 'a', buffering=1))
+
+    def export(data):
+        trace_logger.info('%s', _SpanLine(data))
+
+    return export
+
+
+def _load_exporter(spec):
+    module_name, _, attr = spec.partition(':')
+    if not attr:
+        raise ValueError('unknown trace exporter: {}'.format(spec))
+
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def configure(exporter='none', service=None, path=None, logger=None, sample_ratio=1.0):
+    """Sets the exporter for finished spans.
+
+    path is the span file of the file exporter, logger the service logger
+    used by the log exporter. sample_ratio is the share of new traces that
+    are recorded, traces started upstream follow the caller's decision.
+    """
+    global _export
+
+    _settings['service'] = service
+    _settings['sample_ratio'] = sample_ratio
+
+    if exporter == 'none':
+        _export = None
+    elif exporter == 'log':
+        _export = _log_exporter(logger or logging.getLogger(service))
+    elif exporter == 'file':
+        if not path:
+            raise ValueError('the file trace exporter needs a path')
+        _export = _file_exporter(path)
+    else:
+        _export = _load_exporter(exporter)
+
+
+def enabled():
+    return _export is not None
+
+
+# context
+_current_span = contextvars.ContextVar('moop_span', default=None)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def parse_traceparent(value):
+    """Returns (trace_id, parent_id, sampled) from a traceparent header, None if it is invalid"""
+    match = _TRACEPARENT.match((value or '').strip().lower())
+    if match is None:
+        return None
+
+    version, trace_id, parent_id, flags = match.groups()
+    if version == 'ff' or trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def start_span(name, traceparent=None, **attributes):
+    """Starts a span under the current one and makes it current.
+
+    Without a current span a new trace is started, continuing the caller's
+    trace if traceparent is given. Returns (span, token) for end_span. When
+    the trace is not recorded, its root span is current but not sampled, so
+    the spans under it and the upstream calls keep the decision, and span
+    is None under it.
+    """
+    if _export is None:
+        return None, None
+
+    parent = _current_span.get()
+    if parent is not None:
+        if not parent.sampled:
+            return None, None
+        span = Span(name, parent.trace_id, parent.span_id, attributes)
+    else:
+        context = parse_traceparent(traceparent)
+        if context is not None:
+            trace_id, parent_id, sampled = context
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+            sampled = random.random() < _settings['sample_ratio']
+
+        span = Span(name, trace_id, parent_id, attributes, sampled)
+
+    return span, _current_span.set(span)
+
+
+def detach(token):
+    """Makes the span of token no longer current, for a span ended later with end_span(span, None)"""
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # token was created in another context
+        _current_span.set(None)
+
+
+def end_span(span, token, error=None):
+    if span is None:
+        return
+
+    span.finish()
+    if error is not None:
+        span.set_error(error)
+
+    if token is not None:
+        detach(token)
+
+    if not span.sampled:
+        return
+
+    try:
+        _export(span.to_dict())
+    except Exception:
+        # tracing must never fail a request
+        pass
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the enclosed block as a span, yields the Span or None"""
+    current, token = start_span(name, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        end_span(current, token, e)
+        raise
+    else:
+        end_span(current, token)
+
+
+def inject(headers=None):
+    """Returns headers with the current trace context added, for calls to upstreams"""
+    headers = dict(headers) if headers else {}
+
+    current = _current_span.get()
+    if current is not None:
+        headers[TRACEPARENT_HEADER] = current.traceparent()
+
+    return headers
+
+
+# summary
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def _critical_path(root, children):
+    # follow the child that finished last, it held up its parent the longest
+    path = [root]
+    while children.get(path[-1]['span_id']):
+        path.append(max(
+            children[path[-1]['span_id']],
+            key=lambda child: child['start'] + child['duration']
+        ))
+
+    return path
+
+
+def summarize(spans, slowest=5):
+    """Returns the time per span name and the critical paths of the slowest traces"""
+    by_name = {}
+    for data in spans:
+        by_name.setdefault(data['name'], []).append(data['duration'])
+
+    names = [
+        {
+            'name': name,
+            'count': len(durations),
+            'total': sum(durations),
+            'p50': _percentile(durations, 0.5),
+            'p99': _percentile(durations, 0.99),
+            'max': max(durations),
+        }
+        for name, durations in by_name.items()
+    ]
+    names.sort(key=lambda stats: stats['total'], reverse=True)
+
+    ids = {data['span_id'] for data in spans}
+    children = {}
+    roots = []
+    for data in spans:
+        if data['parent_id'] in ids:
+            children.setdefault(data['parent_id'], []).append(data)
+        else:
+            roots.append(data)
+    roots.sort(key=lambda data: data['duration'], reverse=True)
+
+    traces = []
+    for root in roots[:slowest]:
+        traces.append({
+            'trace_id': root['trace_id'],
+            'duration': root['duration'],
+            'critical_path': [
+                {
+                    'name': data['name'],
+                    'service': data.get('service'),
+                    'duration': data['duration'],
+                    'offset': data['start'] - root['start'],
+                }
+                for data in _critical_path(root, children)
+            ],
+        })
+
+    return {'spans': names, 'slowest_traces': traces}
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m moop_common.tracing')
+    commands = parser.add_subparsers(dest='command')
+    summary = commands.add_parser('summarize', help='summarize span files written by the file exporter')
+    summary.add_argument('files', nargs='+')
+    summary.add_argument('--slowest', type=int, default=5, help='critical paths of this many traces')
+    args = parser.parse_args(argv)
+
+    if args.command != 'summarize':
+        parser.print_help()
+        return 1
+
+    spans = []
+    for path in args.files:
+        with open(path) as f:
+            spans.extend(json.loads(line) for line in f if line.strip())
+
+    print(json.dumps(summarize(spans, args.slowest), indent=1, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
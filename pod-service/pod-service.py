@@ -1,59 +1,1345 @@
 from __future__ import print_function
+from collections import deque
 from functools import wraps
-import traceback
+import calendar
+import copy
+import hashlib
 import time
 import json
+import math
 import os
+import re
 import logging
 import logging.handlers
+import socket
 import sys
 import datetime
+from decimal import Decimal
+import threading
 import uuid
 
-from kubernetes import config
-import kubernetes.client
-from kubernetes.client.rest import ApiException
-
 import requests
-from flask import Flask, redirect, request, Response
+from flask import Flask, Blueprint, redirect, request, Response, g, current_app
 
-# envs
-LOG_LEVEL = int(os.getenv('LOG_LEVEL', ''))
-TENANT_SERVICE_URL = os.environ.get('TENANT_SERVICE_URL', '/').strip()
+# shared helpers live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from moop_common import idempotency, kube, metrics, profiling, recorder, tracing
+from moop_common.tenants import TenantMirror
+from moop_common.instrument import instrument_app
+from moop_common.logs import setup_logging
+from moop_common.resilience import (
+    CircuitOpenError, DeadlineExceeded, DEADLINE_HEADER,
+    configure_breakers, start_deadline, clear_deadline, parse_deadline_header,
+    current_deadline, deadline_headers, upstream, upstream_timeout, is_request_failure
+)
 
 # consts
 SERVICE_PREFIX = '/pods'
 API_VERSION = 'service/v1'
+TENANT_UPSTREAM = 'tenant-service'
 
-# logger
-LOG_NAME = 'Pod-Service'
-LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(name)s:%(funcName)s - [%(levelname)s] %(message)s'
+# labels of the pods pod-service creates
+MANAGED_BY_LABEL = 'moop.io/managed-by'
+MANAGED_BY = 'pod-service'
+TENANT_LABEL = 'moop.io/tenant'
+# Succeeded and Failed pods, field selectors cannot OR
+TERMINAL_FIELD_SELECTOR = 'status.phase!=Pending,status.phase!=Running,status.phase!=Unknown'
+
+# pod and volume names derived from an idempotency key live under this
+POD_NAME_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_DNS, 'pod-service.moop.io')
+
+LABEL_VALUE = re.compile(r'^[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?$')
 
-def setup_logger(level):
-    handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(LOG_FORMAT)
-    handler.setFormatter(formatter)
+PODS_REAPED = metrics.Counter(
+    'pod_reaper_deleted_total',
+    'Terminal pods deleted by the reaper, by phase.',
+    ['phase']
+)
+REAPER_PASS_SECONDS = metrics.Histogram(
+    'pod_reaper_pass_seconds',
+    'Time of one reaper pass over the tracked namespaces.'
+)
+REAPER_ERRORS = metrics.Counter(
+    'pod_reaper_errors_total',
+    'Reaper passes over a namespace that failed.'
+)
 
-    logger = logging.getLogger(LOG_NAME)
-    logger.addHandler(handler)
-    logger.setLevel(level)
+LOG_CHUNK_SIZE = 16 * 1024
+# query parameter -> read_namespaced_pod_log argument
+LOG_INT_PARAMS = {'tail_lines': 'tail_lines', 'since_seconds': 'since_seconds', 'limit_bytes': 'limit_bytes'}
 
-    return logger
+LOG_FOLLOWERS = metrics.Gauge(
+    'pod_log_followers',
+    'Clients following a pod log.'
+)
+
+# list method of each kind the quota cache watches, in every namespace
+QUOTA_KINDS = {
+    'resourcequotas': 'list_resource_quota_for_all_namespaces',
+    'limitranges': 'list_limit_range_for_all_namespaces',
+}
+# quota resources also counted without the requests. prefix
+QUOTA_COMPUTE_RESOURCES = ('cpu', 'memory', 'ephemeral-storage')
+
+QUOTA_REJECTIONS = metrics.Counter(
+    'pod_quota_rejections_total',
+    'Pods refused before the create call, by the quota resource or limit range they would exceed.',
+    ['resource']
+)
+QUOTA_WATCH_ERRORS = metrics.Counter(
+    'pod_quota_watch_errors_total',
+    'Failed lists and watches of resource quotas and limit ranges.'
+)
+
+# executors
+EXECUTOR_LABEL = 'moop.io/executor'
+EXECUTOR_OWNER_LABEL = 'moop.io/executor-owner'
+
+EXEC_COMMANDS = metrics.Counter(
+    'pod_exec_commands_total',
+    'Commands run on executor pods, by outcome.',
+    ['outcome']
+)
+EXEC_SECONDS = metrics.Histogram(
+    'pod_exec_seconds',
+    'Time of a command on an executor pod, from the request until it exited, by whether the executor was warm.',
+    ['start']
+)
+EXECUTORS = metrics.Gauge(
+    'pod_executors',
+    'Executor pods of this worker at the last pass, by state.',
+    ['state']
+)
+EXECUTORS_RETIRED = metrics.Counter(
+    'pod_executors_retired_total',
+    'Executor pods deleted, by reason.',
+    ['reason']
+)
+
+# logger
+LOG_NAME = 'Pod-Service'
+LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(name)s:%(funcName)s - [%(levelname)s] %(message)s'
 
-logger = setup_logger(int(LOG_LEVEL))
+logger = logging.getLogger(LOG_NAME)
 
-# load kube config from .kube
-config.load_kube_config()
+def setup_logger(config):
+    # records are written by a background thread, see moop_common.logs
+    return setup_logging(
+        logger,
+        config['LOG_LEVEL'],
+        LOG_FORMAT,
+        style=config['LOG_STYLE'],
+        queue_size=config['LOG_QUEUE_SIZE'],
+        rate=config['LOG_RATE_LIMIT'],
+        burst=config['LOG_RATE_BURST'],
+        sample_every=config['LOG_SAMPLE_EVERY']
+    )
 
-# create an instance of the API class
-api_instance = kubernetes.client.CoreV1Api()
+# envs, read by create_app
+def load_settings():
+    return {
+        'LOG_LEVEL': int(os.getenv('LOG_LEVEL', '')),
+        'LOG_STYLE': os.getenv('LOG_STYLE', 'json').strip(),
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        'LOG_RATE_LIMIT': float(os.getenv('LOG_RATE_LIMIT', '5')),
+        'LOG_RATE_BURST': int(os.getenv('LOG_RATE_BURST', '20')),
+        'LOG_SAMPLE_EVERY': int(os.getenv('LOG_SAMPLE_EVERY', '100')),
+        'TENANT_SERVICE_URL': os.environ.get('TENANT_SERVICE_URL', '/').strip(),
+        'REQUEST_DEADLINE': float(os.getenv('REQUEST_DEADLINE', '30')),
+        'TENANT_REQUEST_TIMEOUT': float(os.getenv('TENANT_REQUEST_TIMEOUT', '5')),
+        'TENANT_MIRROR': os.getenv('TENANT_MIRROR', '0').strip() == '1',
+        'TENANT_MIRROR_POLL_TIMEOUT': float(os.getenv('TENANT_MIRROR_POLL_TIMEOUT', '20')),
+        'TENANT_MIRROR_STALE_AFTER': float(os.getenv('TENANT_MIRROR_STALE_AFTER', '60')),
+        'KUBE_CONFIG_MODE': os.getenv('KUBE_CONFIG_MODE', 'auto').strip(),
+        'KUBE_REQUEST_TIMEOUT': float(os.getenv('KUBE_REQUEST_TIMEOUT', '20')),
+        'KUBE_CONNECT_TIMEOUT': float(os.getenv('KUBE_CONNECT_TIMEOUT', '5')),
+        'KUBE_POOL_MAXSIZE': int(os.getenv('KUBE_POOL_MAXSIZE', '16')),
+        'KUBE_POOL_TIMEOUT': float(os.getenv('KUBE_POOL_TIMEOUT', '10')),
+        'KUBE_KEEPALIVE': os.getenv('KUBE_KEEPALIVE', '1').strip() == '1',
+        'KUBE_CLIENT_SCOPE': os.getenv('KUBE_CLIENT_SCOPE', 'process').strip(),
+        # tenant=context,tenant=context
+        'KUBE_TENANT_CLUSTERS': dict(
+            item.strip().split('=', 1) for item in os.getenv('KUBE_TENANT_CLUSTERS', '').split(',') if item.strip()
+        ),
+        'BREAKER_FAILURE_THRESHOLD': int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5')),
+        'BREAKER_RECOVERY_TIMEOUT': float(os.getenv('BREAKER_RECOVERY_TIMEOUT', '30')),
+        'TRACE_EXPORTER': os.getenv('TRACE_EXPORTER', 'none').strip(),
+        'TRACE_FILE': os.getenv('TRACE_FILE', '').strip(),
+        'TRACE_SAMPLE_RATIO': float(os.getenv('TRACE_SAMPLE_RATIO', '1')),
+        'PROFILING_TOKEN': os.getenv('PROFILING_TOKEN', '').strip(),
+        'PROFILING_DIR': os.getenv('PROFILING_DIR', '').strip(),
+        'PROFILING_MAX_SECONDS': float(os.getenv('PROFILING_MAX_SECONDS', '60')),
+        'RECORD_DIR': os.getenv('RECORD_DIR', '').strip(),
+        'RECORD_SAMPLE_RATIO': float(os.getenv('RECORD_SAMPLE_RATIO', '1')),
+        'RECORD_SALT': os.getenv('RECORD_SALT', '').strip(),
+        'POD_REAPER_INTERVAL': float(os.getenv('POD_REAPER_INTERVAL', '0')),
+        'POD_REAPER_TTL': float(os.getenv('POD_REAPER_TTL', '3600')),
+        'POD_REAPER_BATCH': int(os.getenv('POD_REAPER_BATCH', '100')),
+        'POD_REAPER_RATE': float(os.getenv('POD_REAPER_RATE', '10')),
+        'POD_REAPER_NAMESPACES': [
+            namespace.strip() for namespace in os.getenv('POD_REAPER_NAMESPACES', '').split(',') if namespace.strip()
+        ],
+        'POD_LOG_BUFFER_BYTES': int(os.getenv('POD_LOG_BUFFER_BYTES', str(1024 * 1024))),
+        'POD_LOG_IDLE_TIMEOUT': float(os.getenv('POD_LOG_IDLE_TIMEOUT', '300')),
+        'POD_QUOTA_CHECK': os.getenv('POD_QUOTA_CHECK', '0').strip() == '1',
+        'POD_QUOTA_WATCH_TIMEOUT': float(os.getenv('POD_QUOTA_WATCH_TIMEOUT', '300')),
+        'POD_QUOTA_SYNC_WAIT': float(os.getenv('POD_QUOTA_SYNC_WAIT', '1')),
+        'POD_EXEC_POOL_SIZE': int(os.getenv('POD_EXEC_POOL_SIZE', '0')),
+        'POD_EXEC_MIN_IDLE': int(os.getenv('POD_EXEC_MIN_IDLE', '1')),
+        'POD_EXEC_MAX_USES': int(os.getenv('POD_EXEC_MAX_USES', '100')),
+        'POD_EXEC_LIFETIME': float(os.getenv('POD_EXEC_LIFETIME', '3600')),
+        'POD_EXEC_IDLE_TIMEOUT': float(os.getenv('POD_EXEC_IDLE_TIMEOUT', '600')),
+        'POD_EXEC_INTERVAL': float(os.getenv('POD_EXEC_INTERVAL', '5')),
+        'POD_EXEC_START_TIMEOUT': float(os.getenv('POD_EXEC_START_TIMEOUT', '60')),
+        'POD_EXEC_TIMEOUT': float(os.getenv('POD_EXEC_TIMEOUT', '30')),
+        'POD_EXEC_MAX_TIMEOUT': float(os.getenv('POD_EXEC_MAX_TIMEOUT', '300')),
+        'POD_EXEC_MAX_OUTPUT': int(os.getenv('POD_EXEC_MAX_OUTPUT', str(1024 * 1024))),
+        'POD_EXEC_KEEPER': os.getenv(
+            'POD_EXEC_KEEPER',
+            'trap "exit 0" TERM; while true; do sleep 30 & wait $!; done'
+        ).strip(),
+        'IDEMPOTENCY_TTL': float(os.getenv('IDEMPOTENCY_TTL', '3600')),
+        'IDEMPOTENCY_MAX_KEYS': int(os.getenv('IDEMPOTENCY_MAX_KEYS', '10000')),
+        'PRELOAD': os.getenv('PRELOAD', '0').strip() == '1',
+    }
 
 # helper
 def datetime_convertor(o):
     if isinstance(o, datetime.datetime):
         return o.__str__()
 
-app = Flask(__name__)
+def expand_vols(vols, name_seed=None):
+    # vols: [{'pvc': claim name, 'mount': mount path}]
+    if name_seed is None:
+        vol_names = [str(uuid.uuid4()) for vol in vols]
+    else:
+        vol_names = [str(uuid.uuid5(name_seed, str(i))) for i, vol in enumerate(vols)]
+    volumes = []
+    volumeMounts = []
+    for i, vol in enumerate(vols):
+        volumes.append(
+            {
+                'name': vol_names[i],
+                'persistentVolumeClaim':
+                {
+                    'claimName': vol['pvc']
+                }
+            }
+        )
+
+        volumeMounts.append(
+            {
+                'name': vol_names[i],
+                'mountPath': vol['mount']
+            }
+        )
+
+    return volumes, volumeMounts
+
+def render_pod(template, tenant_id, cmd, vols, idempotency_key=None):
+    # fills the tenant's pod template in place
+    # every attempt with the same key gets the same names, kubernetes refuses the duplicate pod
+    name_seed = None
+    if idempotency_key is not None:
+        name_seed = uuid.uuid5(POD_NAME_NAMESPACE, '{}/{}'.format(tenant_id, idempotency_key))
+
+    body = template
+    body['metadata']['name'] = body['metadata']['name'].format(
+        tenant_id,
+        uuid.uuid4() if name_seed is None else name_seed
+    )
+    body['spec']['containers'][0]['args'][2] = cmd
+
+    # found again by the reaper and bulk deletes
+    labels = body['metadata'].get('labels') or {}
+    labels[MANAGED_BY_LABEL] = MANAGED_BY
+    if LABEL_VALUE.match(tenant_id):
+        labels[TENANT_LABEL] = tenant_id
+    body['metadata']['labels'] = labels
+
+    # create volumeMounts and volumes from vols
+    volumes, volumeMounts = expand_vols(vols, name_seed)
+    body['spec']['containers'][0]['volumeMounts'] = volumeMounts
+    body['spec']['volumes'] = volumes
+
+    return body
+
+def fetch_tenant(tenant_id):
+    mirror = current_app.extensions.get('tenant_mirror')
+    if mirror is not None:
+        # None until the copy is synced, and for tenants it does not know yet
+        tenant_resp = mirror.lookup(tenant_id)
+        if tenant_resp is not None:
+            return tenant_resp
+
+    with upstream(
+        TENANT_UPSTREAM,
+        'get_tenant',
+        timeout=current_app.config['TENANT_REQUEST_TIMEOUT'],
+        is_failure=is_request_failure
+    ) as call:
+        tenant_resp = requests.get(
+            '{}/{}'.format(current_app.config['TENANT_SERVICE_URL'], tenant_id),
+            headers=deadline_headers(),
+            timeout=call.timeout
+        )
+        if tenant_resp.status_code >= 500:
+            call.fail()
+
+    return tenant_resp
+
+# reaper
+def parse_kube_time(value):
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+
+def pod_finished_at(pod):
+    # when the last container terminated, the pod's start or creation if that is unknown
+    status = pod.get('status') or {}
+    finished = [
+        ((container.get('state') or {}).get('terminated') or {}).get('finishedAt')
+        for container in status.get('containerStatuses') or []
+    ]
+    finished = [value for value in finished if value]
+    if finished:
+        return max(parse_kube_time(value) for value in finished)
+
+    return parse_kube_time(status.get('startTime') or pod['metadata']['creationTimestamp'])
+
+def managed_selector(selector=''):
+    return ','.join(filter(None, ('{}={}'.format(MANAGED_BY_LABEL, MANAGED_BY), selector)))
+
+class PodReaper(object):
+    """Deletes the Succeeded and Failed pods pod-service created, once their namespace's TTL passed"""
+
+    def __init__(self, interval, ttl, batch_size, rate, namespaces=()):
+        self.interval = interval
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.rate = rate
+
+        self._lock = threading.Lock()
+        # (cluster, namespace) -> seconds a terminal pod is kept, negative keeps it
+        self._ttls = {(None, namespace): ttl for namespace in namespaces}
+        self._stop = threading.Event()
+        self._pid = None
+
+    def track(self, namespace, ttl=None, cluster=None):
+        with self._lock:
+            self._ttls[(cluster, namespace)] = self.ttl if ttl is None else ttl
+        self.start()
+
+    def untrack(self, namespace, cluster=None):
+        with self._lock:
+            self._ttls.pop((cluster, namespace), None)
+
+    def namespaces(self):
+        with self._lock:
+            return dict(self._ttls)
+
+    def _pace(self):
+        # rate limit of the delete calls, False once stopped
+        if self.rate > 0:
+            return not self._stop.wait(1.0 / self.rate)
+        return not self._stop.is_set()
+
+    def reap(self, namespace, ttl, cluster=None):
+        """Deletes up to batch_size expired terminal pods in namespace, returns how many"""
+        if ttl < 0:
+            return 0
+
+        pods = kube.call_json(
+            kube.core_v1(cluster),
+            'list_namespaced_pod',
+            namespace,
+            label_selector=managed_selector(),
+            field_selector=TERMINAL_FIELD_SELECTOR
+        )['items']
+        if not pods or not self._pace():
+            return 0
+
+        if ttl == 0:
+            # every terminal pod may go, in one call
+            deleted = kube.call_json(
+                kube.core_v1(cluster),
+                'delete_collection_namespaced_pod',
+                namespace,
+                label_selector=managed_selector(),
+                field_selector=TERMINAL_FIELD_SELECTOR
+            ).get('items', pods)
+            for pod in deleted:
+                PODS_REAPED.labels(pod['status'].get('phase', '')).inc()
+            return len(deleted)
+
+        now = time.time()
+        expired = [pod for pod in pods if pod_finished_at(pod) + ttl <= now]
+
+        count = 0
+        for i, pod in enumerate(expired[:self.batch_size]):
+            if i > 0 and not self._pace():
+                break
+
+            try:
+                kube.call_json(kube.core_v1(cluster), 'delete_namespaced_pod', pod['metadata']['name'], namespace)
+            except kube.ApiException as e:
+                # deleted by someone else meanwhile
+                if e.status != 404:
+                    raise
+                continue
+
+            PODS_REAPED.labels(pod['status'].get('phase', '')).inc()
+            count += 1
+
+        return count
+
+    def run_once(self):
+        with REAPER_PASS_SECONDS.labels().time():
+            for (cluster, namespace), ttl in self.namespaces().items():
+                if self._stop.is_set():
+                    return
+
+                try:
+                    count = self.reap(namespace, ttl, cluster)
+                    if count:
+                        logger.info('Reaped %d pods in %s (cluster %s)', count, namespace, cluster or 'default')
+                except kube.ApiException as e:
+                    if e.status == 404:
+                        # the namespace is gone
+                        self.untrack(namespace, cluster)
+                        continue
+                    REAPER_ERRORS.labels().inc()
+                    logger.warning('Reaper Error: %s %s %s', cluster or 'default', namespace, e)
+                except Exception as e:
+                    REAPER_ERRORS.labels().inc()
+                    logger.warning('Reaper Error: %s %s %s', cluster or 'default', namespace, e)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        # threads do not survive a fork, every worker reaps the namespaces it served
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='pod-reaper', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+def track_namespace(tenant, namespace, cluster=None):
+    reaper = current_app.extensions.get('pod_reaper')
+    if reaper is None:
+        return
+
+    # tenants may set their own ttl, negative keeps their pods
+    ttl = (tenant['resources'].get('reaper') or {}).get('ttlSecondsAfterFinished')
+    reaper.track(namespace, ttl, cluster)
+
+# logs
+def open_pod_log(namespace, name, params, timeout=None, cluster=None):
+    # answers once the headers are in, the log is read from the returned response
+    return kube.call(
+        kube.core_v1(cluster),
+        'read_namespaced_pod_log',
+        name,
+        namespace,
+        _preload_content=False,
+        timeout=timeout,
+        **params
+    )
+
+def stream_pod_log(response):
+    try:
+        for chunk in response.stream(LOG_CHUNK_SIZE, decode_content=True):
+            yield chunk
+    finally:
+        response.release_conn()
+
+class PodLogStream(object):
+    """One upstream follow of a pod log, fanned out to its followers through a ring buffer"""
+
+    def __init__(self, key, namespace, name, params, buffer_bytes, idle_timeout, cluster=None):
+        self.key = key
+        self.cluster = cluster
+        self.namespace = namespace
+        self.name = name
+        self.params = params
+        self.buffer_bytes = buffer_bytes
+        self.idle_timeout = idle_timeout
+
+        self.followers = 0
+        self.opened = threading.Event()
+        self.error = None
+
+        self._cond = threading.Condition()
+        # (offset, bytes, monotonic time it arrived), the last buffer_bytes of the log
+        self._chunks = deque()
+        self._start = 0
+        self._end = 0
+        self._done = False
+        self._response = None
+
+    def start(self):
+        threading.Thread(target=self._run, name='pod-log', daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            # without a request deadline, the read timeout ends a log that stays quiet
+            self._response = open_pod_log(
+                self.namespace,
+                self.name,
+                dict(self.params, follow=True),
+                timeout=self.idle_timeout,
+                cluster=self.cluster
+            )
+        except Exception as e:
+            self.error = e
+            self._finish()
+            return
+        finally:
+            self.opened.set()
+
+        try:
+            for chunk in stream_pod_log(self._response):
+                self._append(chunk)
+                if self.followers <= 0:
+                    break
+        except Exception as e:
+            # idle timeout, or closed after the last follower left
+            logger.debug('Log stream of %s/%s ended: %s', self.namespace, self.name, e)
+        finally:
+            self._finish()
+
+    def _append(self, chunk):
+        with self._cond:
+            self._chunks.append((self._end, chunk, time.monotonic()))
+            self._end += len(chunk)
+            while self._end - self._start > self.buffer_bytes and len(self._chunks) > 1:
+                offset, dropped, arrived = self._chunks.popleft()
+                self._start = offset + len(dropped)
+            self._cond.notify_all()
+
+    def _finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+        with _log_streams_lock:
+            if _log_streams.get(self.key) is self:
+                del _log_streams[self.key]
+
+    def read(self, offset, timeout):
+        """Returns (data, offset) written since offset, b'' after timeout and None at the end"""
+        with self._cond:
+            while offset >= self._end and not self._done:
+                if not self._cond.wait(timeout):
+                    return b'', offset
+
+            # a follower that fell behind the buffer skips what it missed
+            offset = max(offset, self._start)
+            if offset >= self._end:
+                return None, offset
+
+            data = b''.join(
+                chunk[max(offset - chunk_offset, 0):]
+                for chunk_offset, chunk, arrived in self._chunks
+                if chunk_offset + len(chunk) > offset
+            )
+            return data, offset + len(data)
+
+    def tail(self, tail_lines=None, since_seconds=None):
+        """Returns the offset a joining follower reads from, for its own tail_lines and since_seconds.
+
+        The upstream applied them for the first follower only, later ones get
+        the last tail_lines lines of the buffer, and the chunks that arrived in
+        the last since_seconds.
+        """
+        with self._cond:
+            offset = self._start
+            if since_seconds is not None:
+                cutoff = time.monotonic() - since_seconds
+                offset = next(
+                    (chunk_offset for chunk_offset, chunk, arrived in self._chunks if arrived >= cutoff),
+                    self._end
+                )
+            if tail_lines is None:
+                return offset
+
+            data = b''.join(
+                chunk[max(offset - chunk_offset, 0):]
+                for chunk_offset, chunk, arrived in self._chunks
+                if chunk_offset + len(chunk) > offset
+            )
+
+        # the last line's own newline does not start another line
+        pos = len(data) - 1 if data.endswith(b'\n') else len(data)
+        for _ in range(tail_lines):
+            pos = data.rfind(b'\n', 0, pos)
+            if pos < 0:
+                return offset
+
+        return offset + min(pos + 1, len(data))
+
+    def close(self):
+        with self._cond:
+            response = None if self._done else self._response
+        if response is None:
+            return
+
+        try:
+            # wakes the reader blocked on the socket
+            response.shutdown()
+        except Exception:
+            # the log ended meanwhile and the connection went back to the pool
+            pass
+
+_log_streams = {}
+_log_streams_lock = threading.Lock()
+
+metrics.CallbackMetric(
+    'pod_log_streams',
+    'Upstream pod log follow streams, each shared by the followers of a pod.',
+    'gauge',
+    lambda: [({}, len(_log_streams))]
+)
+
+def join_pod_log(namespace, name, params, buffer_bytes, idle_timeout, cluster=None):
+    # followers asking for the same log share one upstream stream
+    key = (cluster, namespace, name) + tuple(sorted(params.items()))
+    with _log_streams_lock:
+        stream = _log_streams.get(key)
+        if stream is None:
+            stream = _log_streams[key] = PodLogStream(
+                key, namespace, name, params, buffer_bytes, idle_timeout, cluster=cluster
+            ).start()
+        stream.followers += 1
+
+    return stream
+
+def leave_pod_log(stream):
+    with _log_streams_lock:
+        stream.followers -= 1
+        if stream.followers > 0:
+            return
+        if _log_streams.get(stream.key) is stream:
+            del _log_streams[stream.key]
+
+    stream.close()
+
+def follow_pod_log(stream, limit_bytes=None, offset=0):
+    LOG_FOLLOWERS.labels().inc()
+    try:
+        sent = 0
+        while True:
+            data, offset = stream.read(offset, 30)
+            if data is None:
+                return
+            if limit_bytes is not None and sent + len(data) >= limit_bytes:
+                yield data[:limit_bytes - sent]
+                return
+
+            sent += len(data)
+            if data:
+                yield data
+    finally:
+        LOG_FOLLOWERS.labels().dec()
+        leave_pod_log(stream)
+
+# quota
+def parse_quantity(value):
+    from kubernetes.utils import parse_quantity as parse
+
+    return parse(value)
+
+def format_quantity(value):
+    return '{:f}'.format(value.normalize())
+
+def container_resources(container, limit_ranges):
+    # (requests, limits) the API server gives the container, with the limit range defaults
+    resources = container.get('resources') or {}
+    limits = {name: parse_quantity(value) for name, value in (resources.get('limits') or {}).items()}
+    requests = {name: parse_quantity(value) for name, value in (resources.get('requests') or {}).items()}
+    # a limit without a request requests as much
+    for name, value in limits.items():
+        requests.setdefault(name, value)
+
+    for limit_range in limit_ranges:
+        for item in (limit_range.get('spec') or {}).get('limits') or []:
+            if item.get('type') != 'Container':
+                continue
+            default = item.get('default') or item.get('max') or {}
+            for name, value in default.items():
+                limits.setdefault(name, parse_quantity(value))
+            for name, value in (item.get('defaultRequest') or default).items():
+                requests.setdefault(name, parse_quantity(value))
+
+    return requests, limits
+
+def pod_usage(pod, limit_ranges):
+    """Returns what creating pod counts against a quota, {quota resource: quantity}"""
+    spec = pod.get('spec') or {}
+    containers = [container_resources(container, limit_ranges) for container in spec.get('containers') or []]
+    init_containers = [container_resources(container, limit_ranges) for container in spec.get('initContainers') or []]
+
+    usage = {'pods': Decimal(1), 'count/pods': Decimal(1)}
+    for index, kind in enumerate(('requests', 'limits')):
+        names = set().union(*(container[index] for container in containers))
+        for name in names:
+            # quotas only count a resource every container sets
+            if not all(name in container[index] for container in containers):
+                continue
+            value = sum(container[index][name] for container in containers)
+            # init containers run one at a time, before the others
+            value = max([value] + [container[index][name] for container in init_containers if name in container[index]])
+
+            usage['{}.{}'.format(kind, name)] = value
+            if kind == 'requests' and name in QUOTA_COMPUTE_RESOURCES:
+                usage[name] = value
+
+    return usage
+
+def quota_applies(quota, pod, usage):
+    spec = quota.get('spec') or {}
+    # priority class selectors are left to the API server
+    if spec.get('scopeSelector'):
+        return False
+
+    terminating = (pod.get('spec') or {}).get('activeDeadlineSeconds') is not None
+    best_effort = not any(
+        '{}.{}'.format(kind, name) in usage for kind in ('requests', 'limits') for name in ('cpu', 'memory')
+    )
+    scopes = {
+        'Terminating': terminating,
+        'NotTerminating': not terminating,
+        'BestEffort': best_effort,
+        'NotBestEffort': not best_effort,
+    }
+    return all(scopes.get(scope, False) for scope in spec.get('scopes') or [])
+
+def check_quota(quotas, limit_ranges, pod):
+    """Returns what the API server would refuse pod for, [{'resource', 'message'}]"""
+    violations = []
+
+    for limit_range in limit_ranges:
+        for item in (limit_range.get('spec') or {}).get('limits') or []:
+            if item.get('type') != 'Container':
+                continue
+            for container in (pod.get('spec') or {}).get('containers') or []:
+                requests, limits = container_resources(container, limit_ranges)
+                for name, value in (item.get('max') or {}).items():
+                    if name in limits and limits[name] > parse_quantity(value):
+                        violations.append({'resource': name, 'message': 'maximum {} usage per Container is {}, but limit is {}'.format(
+                            name, value, format_quantity(limits[name])
+                        )})
+                for name, value in (item.get('min') or {}).items():
+                    if name in requests and requests[name] < parse_quantity(value):
+                        violations.append({'resource': name, 'message': 'minimum {} usage per Container is {}, but request is {}'.format(
+                            name, value, format_quantity(requests[name])
+                        )})
+
+    usage = pod_usage(pod, limit_ranges)
+    for quota in quotas:
+        if not quota_applies(quota, pod, usage):
+            continue
+
+        name = quota['metadata']['name']
+        status = quota.get('status') or {}
+        hard = status.get('hard') or (quota.get('spec') or {}).get('hard') or {}
+        used = status.get('used') or {}
+        for resource in sorted(hard):
+            if resource not in usage:
+                # the API server refuses pods that leave out a resource the quota limits
+                if resource.startswith(('requests.', 'limits.')) or resource in QUOTA_COMPUTE_RESOURCES:
+                    violations.append({'resource': resource, 'message': 'failed quota: {}: must specify {}'.format(name, resource)})
+                continue
+            if parse_quantity(used.get(resource, '0')) + usage[resource] > parse_quantity(hard[resource]):
+                violations.append({'resource': resource, 'message': 'exceeded quota: {}, requested: {}={}, used: {}={}, limited: {}={}'.format(
+                    name,
+                    resource, format_quantity(usage[resource]),
+                    resource, used.get(resource, '0'),
+                    resource, hard[resource]
+                )})
+
+    return violations
+
+def quota_headroom(quotas, limit_ranges, pod):
+    """Returns what is left of each quota, and how many more pods like pod it takes"""
+    usage = pod_usage(pod, limit_ranges)
+
+    headroom = []
+    for quota in quotas:
+        status = quota.get('status') or {}
+        hard = status.get('hard') or (quota.get('spec') or {}).get('hard') or {}
+        used = status.get('used') or {}
+        applies = quota_applies(quota, pod, usage)
+
+        resources = {}
+        pods = None
+        for resource, value in hard.items():
+            remaining = max(parse_quantity(value) - parse_quantity(used.get(resource, '0')), Decimal(0))
+            resources[resource] = {
+                'hard': value,
+                'used': used.get(resource, '0'),
+                'remaining': format_quantity(remaining),
+            }
+            if applies and usage.get(resource):
+                fits = int(remaining // usage[resource])
+                pods = fits if pods is None else min(pods, fits)
+
+        headroom.append({
+            'name': quota['metadata']['name'],
+            'scopes': (quota.get('spec') or {}).get('scopes') or [],
+            'applies': applies,
+            'pods': pods,
+            'resources': resources,
+        })
+
+    return headroom
+
+def watch_events(response):
+    # one json event per line, a line may span chunks
+    try:
+        pending = b''
+        for chunk in response.stream(LOG_CHUNK_SIZE, decode_content=True):
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        response.release_conn()
+
+class QuotaWatch(object):
+    """The ResourceQuotas and LimitRanges of a cluster, kept current by a watch of each kind.
+
+    One watch per kind over every namespace, rather than one per tenant
+    namespace, keeps it to two connections and threads however many
+    tenants there are.
+    """
+
+    def __init__(self, watch_timeout, cluster=None):
+        self.cluster = cluster
+        self.watch_timeout = watch_timeout
+
+        self._lock = threading.Lock()
+        # kind -> (namespace, name) -> object
+        self._objects = {kind: {} for kind in QUOTA_KINDS}
+        self._synced = {kind: threading.Event() for kind in QUOTA_KINDS}
+        self._api = None
+
+    def start(self):
+        # watches hold their connections, never the ones requests are served from
+        self._api = kube.dedicated_core_v1(self.cluster)
+        for kind in QUOTA_KINDS:
+            threading.Thread(target=self._run, args=(kind,), name='pod-quota-watch', daemon=True).start()
+        return self
+
+    def wait(self, timeout):
+        """True once both kinds are listed, False if that takes longer than timeout"""
+        deadline = time.monotonic() + timeout
+        return all(self._synced[kind].wait(max(deadline - time.monotonic(), 0)) for kind in QUOTA_KINDS)
+
+    def items(self, kind, namespace):
+        with self._lock:
+            return [obj for (obj_namespace, _), obj in self._objects[kind].items() if obj_namespace == namespace]
+
+    @staticmethod
+    def _key(obj):
+        return obj['metadata'].get('namespace'), obj['metadata']['name']
+
+    def _list(self, kind):
+        listing = kube.call_json(self._api, QUOTA_KINDS[kind])
+        with self._lock:
+            self._objects[kind] = {self._key(item): item for item in listing['items']}
+        self._synced[kind].set()
+
+        return listing['metadata']['resourceVersion']
+
+    def _watch(self, kind, version):
+        """Applies the events of one watch call, returns the version to resume from, None to list again"""
+        response = kube.call(
+            self._api,
+            QUOTA_KINDS[kind],
+            watch=True,
+            resource_version=version,
+            timeout_seconds=int(self.watch_timeout),
+            allow_watch_bookmarks=True,
+            _preload_content=False,
+            timeout=self.watch_timeout + 10
+        )
+        for event in watch_events(response):
+            obj = event['object']
+            if event['type'] == 'ERROR':
+                # the version is too old to resume from
+                return None
+
+            with self._lock:
+                if event['type'] in ('ADDED', 'MODIFIED'):
+                    self._objects[kind][self._key(obj)] = obj
+                elif event['type'] == 'DELETED':
+                    self._objects[kind].pop(self._key(obj), None)
+            version = obj['metadata'].get('resourceVersion') or version
+
+        return version
+
+    def _run(self, kind):
+        version = None
+        failures = 0
+        while True:
+            try:
+                if version is None:
+                    version = self._list(kind)
+                version = self._watch(kind, version)
+                failures = 0
+            except Exception as e:
+                version = None
+                if isinstance(e, kube.ApiException) and e.status == 410:
+                    continue
+
+                # checks are skipped until the kind is listed again, stale quotas would refuse good pods
+                self._synced[kind].clear()
+                QUOTA_WATCH_ERRORS.labels().inc()
+                logger.warning('Quota Watch Error: %s %s %s', self.cluster or 'default', kind, e)
+                failures += 1
+                time.sleep(min(2 ** failures, 60))
+
+class QuotaCache(object):
+    """The quota watches of the clusters pods are created on, started by the first pod of each"""
+
+    def __init__(self, watch_timeout, sync_wait):
+        self.watch_timeout = watch_timeout
+        self.sync_wait = sync_wait
+
+        self._lock = threading.Lock()
+        # cluster -> QuotaWatch
+        self._watches = {}
+        self._pid = None
+
+    def get(self, cluster=None):
+        with self._lock:
+            # threads do not survive a fork, every worker watches for itself
+            if self._pid != os.getpid():
+                self._watches, self._pid = {}, os.getpid()
+
+            watch = self._watches.get(cluster)
+            if watch is None:
+                watch = self._watches[cluster] = QuotaWatch(self.watch_timeout, cluster=cluster).start()
+
+        return watch
+
+    def check(self, pod, namespace, cluster=None):
+        """Returns what the namespace's quotas and limit ranges would refuse pod for, [] while they are not known"""
+        watch = self.get(cluster)
+        if not watch.wait(self.sync_wait):
+            return []
+
+        return check_quota(watch.items('resourcequotas', namespace), watch.items('limitranges', namespace), pod)
+
+# executors
+class ExecutorsBusy(Exception):
+    pass
+
+class ExecutorStartError(Exception):
+    pass
+
+class ExecutorQuotaExceeded(Exception):
+    def __init__(self, violations):
+        super(ExecutorQuotaExceeded, self).__init__('executor exceeds the quota')
+        self.violations = violations
+
+def executor_owner():
+    # executors belong to the worker process that started them
+    return '{}-{}'.format(socket.gethostname()[:40].strip('-_.'), os.getpid())
+
+class Executor(object):
+    __slots__ = ('name', 'created_at', 'uses')
+
+    def __init__(self, name):
+        self.name = name
+        self.created_at = time.monotonic()
+        self.uses = 0
+
+    def age(self):
+        return time.monotonic() - self.created_at
+
+class ExecutorPool(object):
+    """The executors of one tenant and volume set in this worker"""
+
+    def __init__(self, pool_id, tenant_id, namespace, cluster, template, vols):
+        self.id = pool_id
+        self.tenant_id = tenant_id
+        self.namespace = namespace
+        self.cluster = cluster
+        self.template = template
+        self.vols = vols
+
+        self.cond = threading.Condition()
+        # ready executors, the most recently used last
+        self.idle = []
+        # name -> executor started by a pass, not running yet
+        self.starting = {}
+        # executors running a command, or starting for one
+        self.busy = 0
+        # most busy at once since the last pass
+        self.peak = 0
+        # (executor, reason) deleted by the next pass
+        self.retiring = []
+        self.last_used = time.monotonic()
+
+    def size(self):
+        return len(self.idle) + len(self.starting) + self.busy
+
+    def command(self, cmd):
+        # cmd runs the way the template runs it, eg. /bin/sh -c cmd
+        args = self.template['spec']['containers'][0].get('args') or ['/bin/sh', '-c']
+        return list(args[:2]) + [cmd]
+
+    def container(self):
+        return self.template['spec']['containers'][0].get('name')
+
+class ExecutorPools(object):
+    """Long-lived pods of the tenants' templates that run commands over exec.
+
+    A command takes an idle executor of its tenant and volume set, starts one
+    while the pool is below max_size, or waits for one to free up. An
+    executor runs one command at a time. It is replaced after max_uses
+    commands, after a command that timed out or could not run, and before it
+    gets too old to finish another command within lifetime. Every interval
+    seconds each pool is topped up to its peak of busy executors since the
+    last pass, at least min_idle more than are busy, and a pool without
+    commands for idle_timeout seconds shrinks to nothing.
+
+    Pools live in each worker process. Executors are labeled with the worker
+    that started them, and kubernetes ends them after lifetime seconds, so a
+    worker that went away leaves nothing running for long.
+    """
+
+    def __init__(self, max_size, min_idle=1, max_uses=100, lifetime=3600.0, idle_timeout=600.0, interval=5.0,
+                 start_timeout=60.0, max_timeout=300.0, keeper='sleep 3600', quota=None):
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self.max_uses = max_uses
+        self.lifetime = lifetime
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.start_timeout = start_timeout
+        self.max_timeout = max_timeout
+        self.keeper = keeper
+        # the QuotaCache executors are checked against, if any
+        self.quota = quota
+
+        self._lock = threading.Lock()
+        # key -> pool
+        self._pools = {}
+        self._stop = threading.Event()
+        self._pid = None
+
+    def pool(self, tenant, namespace, cluster, vols):
+        """Returns the pool of the tenant's executors mounting vols"""
+        key = json.dumps([cluster, namespace, tenant['id'], vols], sort_keys=True)
+        template = tenant['resources']['templates']['pod']
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = self._pools[key] = ExecutorPool(
+                    hashlib.sha1(key.encode()).hexdigest()[:16],
+                    tenant['id'],
+                    namespace,
+                    cluster,
+                    copy.deepcopy(template),
+                    vols
+                )
+            elif pool.template != template:
+                # executors started from now on follow the tenant's new template
+                pool.template = copy.deepcopy(template)
+            # not dropped by a pass meanwhile
+            pool.last_used = time.monotonic()
+        self.start()
+
+        return pool
+
+    def render(self, pool):
+        body = render_pod(copy.deepcopy(pool.template), pool.tenant_id, self.keeper, pool.vols)
+        body['metadata']['labels'][EXECUTOR_LABEL] = pool.id
+        body['metadata']['labels'][EXECUTOR_OWNER_LABEL] = executor_owner()
+        # ends the executors of a worker that went away
+        body['spec']['activeDeadlineSeconds'] = int(self.lifetime)
+
+        return body
+
+    def _create(self, pool):
+        body = self.render(pool)
+        if self.quota is not None:
+            violations = self.quota.check(body, pool.namespace, pool.cluster)
+            if violations:
+                raise ExecutorQuotaExceeded(violations)
+
+        kube.call_json(kube.core_v1(pool.cluster), 'create_namespaced_pod', pool.namespace, body)
+
+        return Executor(body['metadata']['name'])
+
+    def _wait_running(self, pool, executor):
+        # polled, starting an executor for a waiting command is the slow path
+        end = time.monotonic() + upstream_timeout(self.start_timeout)
+        delay = 0.1
+        while True:
+            pod = kube.call_json(kube.core_v1(pool.cluster), 'read_namespaced_pod', executor.name, pool.namespace)
+            phase = pod['status'].get('phase')
+            if phase == 'Running':
+                return
+            if phase in ('Succeeded', 'Failed'):
+                raise ExecutorStartError('executor {} is {}'.format(executor.name, phase))
+
+            left = end - time.monotonic()
+            if left <= 0:
+                raise ExecutorStartError('executor {} did not start in time'.format(executor.name))
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 1.0)
+
+    def acquire(self, pool, timeout):
+        """Returns (executor, warm) for a command of up to timeout seconds, the executor is the caller's until release"""
+        deadline = current_deadline()
+        with pool.cond:
+            pool.last_used = time.monotonic()
+            while True:
+                while pool.idle:
+                    executor = pool.idle.pop()
+                    if executor.age() + timeout < self.lifetime:
+                        pool.busy += 1
+                        pool.peak = max(pool.peak, pool.busy)
+                        return executor, True
+                    # kubernetes would end it before the command does
+                    pool.retiring.append((executor, 'age'))
+
+                if pool.size() < self.max_size:
+                    pool.busy += 1
+                    pool.peak = max(pool.peak, pool.busy)
+                    break
+
+                left = None if deadline is None else deadline.remaining()
+                if left is not None and left <= 0:
+                    raise ExecutorsBusy('every executor of the pool is busy')
+                pool.cond.wait(left)
+
+        executor = None
+        try:
+            executor = self._create(pool)
+            self._wait_running(pool, executor)
+        except BaseException:
+            with pool.cond:
+                pool.busy -= 1
+                if executor is not None:
+                    pool.retiring.append((executor, 'failed'))
+                pool.cond.notify()
+            raise
+
+        return executor, False
+
+    def release(self, pool, executor, reason=None):
+        """Gives the executor back after a command, a reason retires it instead"""
+        executor.uses += 1
+        if reason is None and executor.uses >= self.max_uses:
+            reason = 'uses'
+
+        with pool.cond:
+            pool.busy -= 1
+            pool.last_used = time.monotonic()
+            if reason is None:
+                pool.idle.append(executor)
+            else:
+                pool.retiring.append((executor, reason))
+            pool.cond.notify()
+
+    def run(self, pool, cmd, timeout, max_output=None):
+        """Runs cmd on an executor of pool, returns its exit code and output"""
+        start = time.perf_counter()
+        with tracing.span('pod.exec_acquire'):
+            executor, warm = self.acquire(pool, timeout)
+
+        try:
+            with tracing.span('kube.exec', warm=warm):
+                exit_code, stdout, stderr, truncated = kube.exec_command(
+                    executor.name,
+                    pool.namespace,
+                    pool.command(cmd),
+                    container=pool.container(),
+                    timeout=timeout,
+                    max_output=max_output,
+                    cluster=pool.cluster
+                )
+        except BaseException:
+            EXEC_COMMANDS.labels('error').inc()
+            self.release(pool, executor, 'error')
+            raise
+
+        if exit_code is None:
+            outcome = 'timeout'
+        else:
+            outcome = 'ok' if exit_code == 0 else 'failed'
+        # a command that timed out is still running in its executor
+        self.release(pool, executor, 'timeout' if exit_code is None else None)
+        EXEC_COMMANDS.labels(outcome).inc()
+        EXEC_SECONDS.labels('warm' if warm else 'cold').observe(time.perf_counter() - start)
+
+        return {
+            'pod': executor.name,
+            'exit_code': exit_code,
+            'stdout': stdout,
+            'stderr': stderr,
+            'timed_out': exit_code is None,
+            'truncated': truncated,
+            'warm': warm,
+        }
+
+    def scale(self, pool):
+        """Drops the executors that went away, retires the ones not needed and starts the missing ones"""
+        listed_at = time.monotonic()
+        pods = kube.call_json(
+            kube.core_v1(pool.cluster),
+            'list_namespaced_pod',
+            pool.namespace,
+            label_selector=managed_selector('{}={},{}={}'.format(
+                EXECUTOR_LABEL, pool.id, EXECUTOR_OWNER_LABEL, executor_owner()
+            ))
+        )['items']
+        phases = {
+            pod['metadata']['name']: pod['status'].get('phase')
+            for pod in pods if not pod['metadata'].get('deletionTimestamp')
+        }
+
+        with pool.cond:
+            idle = []
+            for executor in pool.idle:
+                # an executor started since the list is not in it
+                if phases.get(executor.name) != 'Running' and executor.created_at < listed_at:
+                    pool.retiring.append((executor, 'gone'))
+                elif executor.age() + self.max_timeout >= self.lifetime:
+                    pool.retiring.append((executor, 'age'))
+                else:
+                    idle.append(executor)
+            pool.idle = idle
+
+            for name, executor in list(pool.starting.items()):
+                phase = phases.get(name)
+                if phase == 'Running':
+                    del pool.starting[name]
+                    pool.idle.append(executor)
+                elif phase in (None, 'Succeeded', 'Failed') or executor.age() > self.start_timeout:
+                    del pool.starting[name]
+                    pool.retiring.append((executor, 'failed'))
+
+            if time.monotonic() - pool.last_used < self.idle_timeout:
+                target = min(self.max_size, max(pool.peak, pool.busy + self.min_idle))
+            else:
+                target = 0
+            pool.peak = pool.busy
+            # the least recently used go first
+            while pool.size() > target and pool.idle:
+                pool.retiring.append((pool.idle.pop(0), 'idle'))
+
+            missing = max(target - pool.size(), 0)
+            retiring, pool.retiring = pool.retiring, []
+            if pool.idle:
+                pool.cond.notify_all()
+
+        for executor, reason in retiring:
+            EXECUTORS_RETIRED.labels(reason).inc()
+            try:
+                kube.call_json(kube.core_v1(pool.cluster), 'delete_namespaced_pod', executor.name, pool.namespace)
+            except kube.ApiException as e:
+                if e.status != 404:
+                    raise
+
+        for i in range(missing):
+            try:
+                executor = self._create(pool)
+            except ExecutorQuotaExceeded:
+                break
+            with pool.cond:
+                pool.starting[executor.name] = executor
+
+    def run_once(self):
+        with self._lock:
+            pools = list(self._pools.items())
+
+        states = {'idle': 0, 'starting': 0, 'busy': 0}
+        for key, pool in pools:
+            if self._stop.is_set():
+                return
+
+            try:
+                self.scale(pool)
+            except Exception as e:
+                logger.warning('Executor Error: %s %s %s', pool.cluster or 'default', pool.namespace, e)
+
+            with self._lock, pool.cond:
+                if pool.size() == 0 and not pool.retiring and time.monotonic() - pool.last_used >= self.idle_timeout:
+                    del self._pools[key]
+                states['idle'] += len(pool.idle)
+                states['starting'] += len(pool.starting)
+                states['busy'] += pool.busy
+
+        for state, count in states.items():
+            EXECUTORS.labels(state).set(count)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        # threads do not survive a fork, every worker looks after the executors it started
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='pod-executors', daemon=True).start()
+
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+bp = Blueprint('pod-service', __name__)
+
+@bp.before_app_request
+def start_request_deadline():
+    g.deadline_token = start_deadline(
+        parse_deadline_header(request.headers.get(DEADLINE_HEADER), current_app.config['REQUEST_DEADLINE'])
+    )
+
+@bp.teardown_app_request
+def clear_request_deadline(exc):
+    clear_deadline(g.pop('deadline_token', None))
+
+@bp.app_errorhandler(CircuitOpenError)
+def upstream_unavailable(e):
+    logger.warning('Circuit Open: %s', e)
+    return Response(
+        json.dumps({'error': '{} is unavailable'.format(e.name)}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        headers={'Retry-After': str(int(math.ceil(e.retry_after)))},
+        status=503
+    )
+
+@bp.app_errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    logger.error('Deadline Error: %s', e)
+    return Response(
+        json.dumps({'error': 'Request deadline exceeded'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=504
+    )
+
+@bp.app_errorhandler(requests.exceptions.RequestException)
+def tenant_request_failed(e):
+    logger.error('Request Error: %s', e, exc_info=True)
+    return Response(
+        json.dumps({'error': 'tenant service request failed'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=502
+    )
 
 def create_body(f):
     @wraps(f)
@@ -74,56 +1360,32 @@ def create_body(f):
         vols = req_body['vols'] if 'vols' in req_body.keys() else []
 
         # read templates from tenant service
-        tenant_resp = requests.get('{}/{}'.format(TENANT_SERVICE_URL, req_body['tenant']))
+        tenant_resp = fetch_tenant(req_body['tenant'])
         if tenant_resp.status_code != 200:
-            logger.error('Request Error: {}\nStack: {}\n'.format(tenant_resp.json(), traceback.format_exc()))
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
+            # not a 200, an idempotent create would keep it
             return Response(
                 json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
                 mimetype='application/json',
+                status=404 if tenant_resp.status_code == 404 else 503
             )
 
         tenant = tenant_resp.json()
         templates = tenant['resources']['templates']
         namespace = tenant['namespace']
+        cluster = kube.cluster_for(tenant)
+        track_namespace(tenant, namespace, cluster)
 
         # create body
-        body = templates['pod']
-        body['metadata']['name'] = body['metadata']['name'].format(
-            tenant['id'],
-            uuid.uuid4()
-        )
-        body['spec']['containers'][0]['args'][2] = req_body['cmd']
-
-        # create volumeMounts and volumes from vols
-        vol_names = [str(uuid.uuid4()) for vol in vols]
-        volumes = []
-        volumeMounts = []
-        for i, vol in enumerate(vols):
-            volumes.append(
-                {
-                    'name': vol_names[i],
-                    'persistentVolumeClaim':
-                    {
-                        'claimName': vol['pvc']
-                    }
-                }
-            )
-
-            volumeMounts.append(
-                {
-                    'name': vol_names[i],
-                    'mountPath': vol['mount']
-                }
-            )
-
-        body['spec']['containers'][0]['volumeMounts'] = volumeMounts
-        body['spec']['volumes'] = volumes
+        with tracing.span('pod.render', vols=len(vols)):
+            body = render_pod(templates['pod'], tenant['id'], req_body['cmd'], vols, idempotency.current_key())
 
         return f(
             body,
             req_body,
             *args,
             namespace=namespace,
+            cluster=cluster,
             **kwargs
         )
 
@@ -140,16 +1402,17 @@ def get_params(f):
                 json.dumps({'error': 'no tenant parameter specified'}, indent=1, sort_keys=True),
                 mimetype='application/json',
             )
-        if 'name' not in req_body.keys():
+        # DELETE takes a label selector instead of a name, for bulk deletes
+        if 'name' not in req_body.keys() and not (request.method == 'DELETE' and req_body.get('selector')):
             return Response(
                 json.dumps({'error': 'no name parameter specified'}, indent=1, sort_keys=True),
                 mimetype='application/json',
             )
 
         # read templates from tenant service
-        tenant_resp = requests.get('{}/{}'.format(TENANT_SERVICE_URL, req_body['tenant']))
+        tenant_resp = fetch_tenant(req_body['tenant'])
         if tenant_resp.status_code != 200:
-            logger.error('Request Error: {}\nStack: {}\n'.format(tenant_resp.json(), traceback.format_exc()))
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
             return Response(
                 json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
                 mimetype='application/json',
@@ -162,20 +1425,53 @@ def get_params(f):
             req_body,
             *args,
             namespace=namespace,
+            cluster=kube.cluster_for(tenant),
             **kwargs
         )
 
     return decorated
 
 # POST /pods
-@app.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@bp.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@idempotency.idempotent
 @create_body
-def create_pod(body, req_body, namespace=''):
+def create_pod(body, req_body, namespace='', cluster=None):
     try:
-        pod = api_instance.create_namespaced_pod(
-            body=body,
-            namespace=namespace
-        ).to_dict()
+        # a pod the quota would refuse is refused here, without the round trip
+        quota_cache = current_app.extensions.get('pod_quota')
+        if quota_cache is not None:
+            with tracing.span('pod.quota_check'):
+                violations = quota_cache.check(body, namespace, cluster)
+            if violations:
+                for violation in violations:
+                    QUOTA_REJECTIONS.labels(violation['resource']).inc()
+                return Response(
+                    json.dumps(
+                        {'error': 'pod exceeds the quota of namespace {}'.format(namespace), 'violations': violations},
+                        indent=1,
+                        sort_keys=True
+                    ),
+                    mimetype='application/json',
+                    status=403
+                )
+
+        try:
+            pod = kube.call(
+                kube.core_v1(cluster),
+                'create_namespaced_pod',
+                body=body,
+                namespace=namespace
+            ).to_dict()
+        except kube.ApiException as e:
+            # created by an earlier attempt with the same idempotency key, eg. on another worker
+            if e.status != 409 or idempotency.current_key() is None:
+                raise
+            pod = kube.call(
+                kube.core_v1(cluster),
+                'read_namespaced_pod',
+                name=body['metadata']['name'],
+                namespace=namespace
+            ).to_dict()
 
         return Response(
             json.dumps(
@@ -186,16 +1482,19 @@ def create_pod(body, req_body, namespace=''):
             ),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -207,11 +1506,13 @@ def create_pod(body, req_body, namespace=''):
         )
 
 # GET /pods
-@app.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@bp.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
 @get_params
-def read_pod(req_body, namespace=''):
+def read_pod(req_body, namespace='', cluster=None):
     try:
-        pod = api_instance.read_namespaced_pod(
+        pod = kube.call(
+            kube.core_v1(cluster),
+            'read_namespaced_pod',
             name=req_body['name'],
             namespace=namespace
         ).to_dict()
@@ -225,16 +1526,19 @@ def read_pod(req_body, namespace=''):
             ),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -246,11 +1550,16 @@ def read_pod(req_body, namespace=''):
         )
 
 # DELETE /pods
-@app.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
+@bp.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
 @get_params
-def remove_pod(req_body, namespace=''):
+def remove_pod(req_body, namespace='', cluster=None):
     try:
-        pod = api_instance.delete_namespaced_pod(
+        if 'name' not in req_body.keys():
+            return remove_pods(req_body, namespace, cluster)
+
+        pod = kube.call(
+            kube.core_v1(cluster),
+            'delete_namespaced_pod',
             name=req_body['name'],
             namespace=namespace
         ).to_dict()
@@ -264,16 +1573,19 @@ def remove_pod(req_body, namespace=''):
             ),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -283,3 +1595,393 @@ def remove_pod(req_body, namespace=''):
             status=500,
             mimetype='application/json'
         )
+
+def remove_pods(req_body, namespace, cluster=None):
+    # only pods pod-service created, optionally only those in one phase
+    deleted = kube.call_json(
+        kube.core_v1(cluster),
+        'delete_collection_namespaced_pod',
+        namespace,
+        label_selector=managed_selector(req_body['selector']),
+        field_selector='status.phase={}'.format(req_body['phase']) if req_body.get('phase') else None
+    )
+
+    return Response(
+        json.dumps(
+            {'deleted': [pod['metadata']['name'] for pod in deleted.get('items', [])]},
+            indent=1,
+            sort_keys=True
+        ),
+        mimetype='application/json'
+    )
+
+# GET /pods/log
+@bp.route('/{}{}/log'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@get_params
+def read_pod_log(req_body, namespace='', cluster=None):
+    try:
+        params = {
+            argument: int(req_body[param])
+            for param, argument in LOG_INT_PARAMS.items()
+            if req_body.get(param)
+        }
+    except ValueError:
+        return Response(
+            json.dumps({'error': 'tail_lines, since_seconds and limit_bytes must be integers'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    if req_body.get('container'):
+        params['container'] = req_body['container']
+
+    try:
+        if req_body.get('follow') in ('1', 'true'):
+            # the byte limit is applied per follower, the stream is shared
+            limit_bytes = params.pop('limit_bytes', None)
+            stream = join_pod_log(
+                namespace,
+                req_body['name'],
+                params,
+                current_app.config['POD_LOG_BUFFER_BYTES'],
+                current_app.config['POD_LOG_IDLE_TIMEOUT'],
+                cluster=cluster
+            )
+            stream.opened.wait(current_app.config['KUBE_REQUEST_TIMEOUT'])
+            if stream.error is not None:
+                leave_pod_log(stream)
+                raise stream.error
+
+            # a follower joining a running stream gets its own tail of the buffer
+            offset = stream.tail(params.get('tail_lines'), params.get('since_seconds'))
+            body = follow_pod_log(stream, limit_bytes, offset)
+        else:
+            body = stream_pod_log(open_pod_log(namespace, req_body['name'], params, cluster=cluster))
+
+        return Response(
+            body,
+            mimetype='text/plain',
+            # proxies pass chunks on as they come
+            headers={'X-Accel-Buffering': 'no'},
+            direct_passthrough=True
+        )
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Pod service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+# GET /pods/headroom
+@bp.route('/{}{}/headroom'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+def read_headroom():
+    quota_cache = current_app.extensions.get('pod_quota')
+    if quota_cache is None:
+        return Response(
+            json.dumps({'error': 'quota check is not enabled'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=404
+        )
+
+    try:
+        req_body = request.args.to_dict()
+        if 'tenant' not in req_body.keys():
+            return Response(
+                json.dumps({'error': 'no tenant parameter specified'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+
+        tenant_resp = fetch_tenant(req_body['tenant'])
+        if tenant_resp.status_code != 200:
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
+            return Response(
+                json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=404 if tenant_resp.status_code == 404 else 503
+            )
+
+        tenant = tenant_resp.json()
+        namespace = tenant['namespace']
+        watch = quota_cache.get(kube.cluster_for(tenant))
+        if not watch.wait(current_app.config['KUBE_REQUEST_TIMEOUT']):
+            return Response(
+                json.dumps({'error': 'quotas of namespace {} are not known yet'.format(namespace)}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                headers={'Retry-After': '1'},
+                status=503
+            )
+
+        # what one more pod of the tenant's template takes
+        pod = render_pod(tenant['resources']['templates']['pod'], tenant['id'], '', [])
+        limit_ranges = watch.items('limitranges', namespace)
+        quotas = quota_headroom(watch.items('resourcequotas', namespace), limit_ranges, pod)
+        fits = [quota['pods'] for quota in quotas if quota['pods'] is not None]
+
+        return Response(
+            json.dumps(
+                {
+                    'namespace': namespace,
+                    'pods': min(fits) if fits else None,
+                    'pod': {
+                        resource: format_quantity(value)
+                        for resource, value in pod_usage(pod, limit_ranges).items()
+                    },
+                    'quotas': quotas,
+                },
+                indent=1,
+                sort_keys=True
+            ),
+            mimetype='application/json'
+        )
+    except (CircuitOpenError, DeadlineExceeded, requests.exceptions.RequestException):
+        # answered by the fast-fail and tenant request error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Pod service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+# POST /pods/exec
+@bp.route('/{}{}/exec'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@idempotency.idempotent
+def exec_pod():
+    pools = current_app.extensions.get('pod_executors')
+    if pools is None:
+        return Response(
+            json.dumps({'error': 'executors are not enabled'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=404
+        )
+
+    try:
+        req_body = request.get_json(silent=True)
+        if not isinstance(req_body, dict):
+            return Response(
+                json.dumps({'error': 'request body must be a json object'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+        if 'tenant' not in req_body.keys():
+            return Response(
+                json.dumps({'error': 'no tenant parameter specified'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+        if 'cmd' not in req_body.keys():
+            return Response(
+                json.dumps({'error': 'no cmd parameter specified'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=400
+            )
+        vols = req_body['vols'] if 'vols' in req_body.keys() else []
+        timeout = min(
+            float(req_body.get('timeout') or current_app.config['POD_EXEC_TIMEOUT']),
+            current_app.config['POD_EXEC_MAX_TIMEOUT']
+        )
+
+        tenant_resp = fetch_tenant(req_body['tenant'])
+        if tenant_resp.status_code != 200:
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
+            return Response(
+                json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=404 if tenant_resp.status_code == 404 else 503
+            )
+
+        tenant = tenant_resp.json()
+        namespace = tenant['namespace']
+        cluster = kube.cluster_for(tenant)
+        track_namespace(tenant, namespace, cluster)
+
+        result = pools.run(
+            pools.pool(tenant, namespace, cluster, vols),
+            req_body['cmd'],
+            timeout,
+            max_output=current_app.config['POD_EXEC_MAX_OUTPUT']
+        )
+
+        return Response(
+            json.dumps(result, indent=1, sort_keys=True),
+            mimetype='application/json'
+        )
+    except ExecutorsBusy:
+        return Response(
+            json.dumps({'error': 'every executor of the tenant is busy'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            headers={'Retry-After': '1'},
+            status=503
+        )
+    except ExecutorQuotaExceeded as e:
+        for violation in e.violations:
+            QUOTA_REJECTIONS.labels(violation['resource']).inc()
+        return Response(
+            json.dumps(
+                {'error': 'executor exceeds the quota of namespace {}'.format(namespace), 'violations': e.violations},
+                indent=1,
+                sort_keys=True
+            ),
+            mimetype='application/json',
+            status=403
+        )
+    except ExecutorStartError as e:
+        logger.error('Executor Error: %s', e)
+        return Response(
+            json.dumps({'error': str(e)}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            headers={'Retry-After': '1'},
+            status=503
+        )
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    except (CircuitOpenError, DeadlineExceeded, requests.exceptions.RequestException):
+        # answered by the fast-fail and tenant request error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Pod service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+# GET /kube-pool
+@bp.route('/{}/kube-pool'.format(API_VERSION), methods=['GET'])
+def read_kube_pool():
+    # ?cluster=<context> for the pool of another cluster
+    return Response(
+        json.dumps(kube.get_pool_stats(request.args.get('cluster') or None).snapshot(), indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+def create_app(settings=None):
+    """App factory, picked up by flask run and gunicorn 'pod-service:create_app()'"""
+    app = Flask(__name__)
+    app.config.update(load_settings())
+    if settings is not None:
+        app.config.update(settings)
+
+    setup_logger(app.config)
+
+    # kube config is loaded and the API client created on first use
+    kube.configure(
+        config_mode=app.config['KUBE_CONFIG_MODE'],
+        request_timeout=app.config['KUBE_REQUEST_TIMEOUT'],
+        connect_timeout=app.config['KUBE_CONNECT_TIMEOUT'],
+        pool_maxsize=app.config['KUBE_POOL_MAXSIZE'],
+        pool_timeout=app.config['KUBE_POOL_TIMEOUT'],
+        keepalive=app.config['KUBE_KEEPALIVE'],
+        scope=app.config['KUBE_CLIENT_SCOPE'],
+        tenant_clusters=app.config['KUBE_TENANT_CLUSTERS']
+    )
+    configure_breakers(
+        failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+        recovery_timeout=app.config['BREAKER_RECOVERY_TIMEOUT']
+    )
+    tracing.configure(
+        app.config['TRACE_EXPORTER'],
+        service='pod-service',
+        path=app.config['TRACE_FILE'],
+        logger=logger,
+        sample_ratio=app.config['TRACE_SAMPLE_RATIO']
+    )
+
+    if app.config['PRELOAD']:
+        # pay for the kubernetes import and kube config once in the master process
+        kube.preload()
+
+    instrument_app(app)
+    # off unless PROFILING_TOKEN is set
+    profiling.install(
+        app,
+        app.config['PROFILING_TOKEN'],
+        output_dir=app.config['PROFILING_DIR'],
+        max_seconds=app.config['PROFILING_MAX_SECONDS']
+    )
+    # off unless RECORD_DIR is set
+    recorder.install(
+        app,
+        app.config['RECORD_DIR'],
+        'pod-service',
+        sample_ratio=app.config['RECORD_SAMPLE_RATIO'],
+        salt=app.config['RECORD_SALT']
+    )
+    # off when IDEMPOTENCY_TTL is 0
+    idempotency.install(app, app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_MAX_KEYS'])
+    app.register_blueprint(bp)
+
+    if app.config['POD_REAPER_INTERVAL'] > 0:
+        # started again in each worker on its first pod
+        app.extensions['pod_reaper'] = PodReaper(
+            app.config['POD_REAPER_INTERVAL'],
+            app.config['POD_REAPER_TTL'],
+            app.config['POD_REAPER_BATCH'],
+            app.config['POD_REAPER_RATE'],
+            namespaces=app.config['POD_REAPER_NAMESPACES']
+        ).start()
+    if app.config['POD_QUOTA_CHECK']:
+        # a cluster is watched from its first pod on, in each worker
+        app.extensions['pod_quota'] = QuotaCache(
+            app.config['POD_QUOTA_WATCH_TIMEOUT'],
+            app.config['POD_QUOTA_SYNC_WAIT']
+        )
+    if app.config['POD_EXEC_POOL_SIZE'] > 0:
+        # pools are started in each worker by its first command
+        app.extensions['pod_executors'] = ExecutorPools(
+            app.config['POD_EXEC_POOL_SIZE'],
+            min_idle=app.config['POD_EXEC_MIN_IDLE'],
+            max_uses=app.config['POD_EXEC_MAX_USES'],
+            lifetime=app.config['POD_EXEC_LIFETIME'],
+            idle_timeout=app.config['POD_EXEC_IDLE_TIMEOUT'],
+            interval=app.config['POD_EXEC_INTERVAL'],
+            start_timeout=app.config['POD_EXEC_START_TIMEOUT'],
+            max_timeout=app.config['POD_EXEC_MAX_TIMEOUT'],
+            keeper=app.config['POD_EXEC_KEEPER'],
+            quota=app.extensions.get('pod_quota')
+        )
+
+    if app.config['TENANT_MIRROR']:
+        # each worker lists the tenants on its first lookup, then follows their changes
+        app.extensions['tenant_mirror'] = TenantMirror(
+            app.config['TENANT_SERVICE_URL'],
+            poll_timeout=app.config['TENANT_MIRROR_POLL_TIMEOUT'],
+            request_timeout=app.config['TENANT_REQUEST_TIMEOUT'],
+            stale_after=app.config['TENANT_MIRROR_STALE_AFTER'],
+            upstream_name=TENANT_UPSTREAM,
+            logger=logger
+        )
+
+    return app
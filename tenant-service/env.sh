@@ -0,0 +1,2 @@
+export LOG_LEVEL=10 # debug
+export TENANT_DATA_FILE=/var/lib/moop/tenants.json
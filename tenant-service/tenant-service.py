@@ -0,0 +1,545 @@
+from __future__ import print_function
+from collections import deque
+from functools import wraps
+import json
+import os
+import re
+import logging
+import logging.handlers
+import secrets
+import sys
+import threading
+import time
+
+from flask import Flask, Blueprint, request, Response, g, current_app
+
+# shared helpers live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from moop_common import metrics, profiling, recorder, tracing
+from moop_common.instrument import instrument_app
+from moop_common.logs import setup_logging
+from moop_common.resilience import (
+    DeadlineExceeded, DEADLINE_HEADER,
+    start_deadline, clear_deadline, current_deadline, parse_deadline_header
+)
+
+# consts
+SERVICE_PREFIX = '/tenants'
+API_VERSION = 'service/v1'
+
+# ids and namespaces are kubernetes names, changes is the feed's path
+TENANT_ID = re.compile(r'^[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?$')
+RESERVED_IDS = ('changes',)
+
+TENANTS = metrics.Gauge(
+    'tenant_store_tenants',
+    'Tenants in the store.'
+)
+FEED_VERSION = metrics.Gauge(
+    'tenant_feed_version',
+    'Version of the last change.'
+)
+FEED_WAITERS = metrics.Gauge(
+    'tenant_feed_waiters',
+    'Long polls and streams waiting for a change.'
+)
+FEED_EXPIRED = metrics.Counter(
+    'tenant_feed_expired_total',
+    'Feed reads that asked for changes no longer kept, the reader lists the tenants again.'
+)
+
+# logger
+LOG_NAME = 'Tenant-Service'
+LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(name)s:%(funcName)s - [%(levelname)s] %(message)s'
+
+logger = logging.getLogger(LOG_NAME)
+
+def setup_logger(config):
+    # records are written by a background thread, see moop_common.logs
+    return setup_logging(
+        logger,
+        config['LOG_LEVEL'],
+        LOG_FORMAT,
+        style=config['LOG_STYLE'],
+        queue_size=config['LOG_QUEUE_SIZE'],
+        rate=config['LOG_RATE_LIMIT'],
+        burst=config['LOG_RATE_BURST'],
+        sample_every=config['LOG_SAMPLE_EVERY']
+    )
+
+# envs, read by create_app
+def load_settings():
+    return {
+        'LOG_LEVEL': int(os.getenv('LOG_LEVEL', '')),
+        'LOG_STYLE': os.getenv('LOG_STYLE', 'json').strip(),
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        'LOG_RATE_LIMIT': float(os.getenv('LOG_RATE_LIMIT', '5')),
+        'LOG_RATE_BURST': int(os.getenv('LOG_RATE_BURST', '20')),
+        'LOG_SAMPLE_EVERY': int(os.getenv('LOG_SAMPLE_EVERY', '100')),
+        'REQUEST_DEADLINE': float(os.getenv('REQUEST_DEADLINE', '30')),
+        'TRACE_EXPORTER': os.getenv('TRACE_EXPORTER', 'none').strip(),
+        'TRACE_FILE': os.getenv('TRACE_FILE', '').strip(),
+        'TRACE_SAMPLE_RATIO': float(os.getenv('TRACE_SAMPLE_RATIO', '1')),
+        'PROFILING_TOKEN': os.getenv('PROFILING_TOKEN', '').strip(),
+        'PROFILING_DIR': os.getenv('PROFILING_DIR', '').strip(),
+        'PROFILING_MAX_SECONDS': float(os.getenv('PROFILING_MAX_SECONDS', '60')),
+        'RECORD_DIR': os.getenv('RECORD_DIR', '').strip(),
+        'RECORD_SAMPLE_RATIO': float(os.getenv('RECORD_SAMPLE_RATIO', '1')),
+        'RECORD_SALT': os.getenv('RECORD_SALT', '').strip(),
+        'TENANT_DATA_FILE': os.getenv('TENANT_DATA_FILE', '').strip(),
+        'TENANT_FEED_SIZE': int(os.getenv('TENANT_FEED_SIZE', '10000')),
+        'TENANT_FEED_POLL_TIMEOUT': float(os.getenv('TENANT_FEED_POLL_TIMEOUT', '20')),
+        'TENANT_FEED_STREAM_SECONDS': float(os.getenv('TENANT_FEED_STREAM_SECONDS', '300')),
+        'TENANT_FEED_HEARTBEAT': float(os.getenv('TENANT_FEED_HEARTBEAT', '15')),
+    }
+
+# store
+class FeedExpired(Exception):
+    pass
+
+class TenantConflict(Exception):
+    pass
+
+class TenantStore(object):
+    """Tenants by id, indexed by namespace and name, with a feed of their changes.
+
+    Every change gets the next version and is kept in the feed, the last
+    feed_size of them. A reader that fell behind the feed, or read the feed of
+    another epoch (the store was started again without its data file), lists
+    the tenants again. With a path, the tenants are loaded from it and written
+    back after every change.
+    """
+
+    def __init__(self, feed_size=10000, path=''):
+        self.path = path
+
+        self._cond = threading.Condition()
+        # id -> tenant
+        self._tenants = {}
+        # namespace -> id
+        self._by_namespace = {}
+        # name -> ids
+        self._by_name = {}
+        self._changes = deque(maxlen=feed_size)
+        self.epoch = secrets.token_hex(8)
+        self.version = 0
+
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.epoch = data['epoch']
+            self.version = data['version']
+            for tenant in data['tenants']:
+                self._index(tenant)
+
+        TENANTS.labels().set(len(self._tenants))
+        FEED_VERSION.labels().set(self.version)
+
+    def _index(self, tenant):
+        self._tenants[tenant['id']] = tenant
+        self._by_namespace[tenant['namespace']] = tenant['id']
+        if tenant.get('name'):
+            self._by_name.setdefault(tenant['name'], set()).add(tenant['id'])
+
+    def _unindex(self, tenant):
+        del self._tenants[tenant['id']]
+        self._by_namespace.pop(tenant['namespace'], None)
+        ids = self._by_name.get(tenant.get('name'))
+        if ids is not None:
+            ids.discard(tenant['id'])
+            if not ids:
+                del self._by_name[tenant['name']]
+
+    def _save(self):
+        # caller holds the lock, the file is replaced at once
+        if not self.path:
+            return
+
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(
+                {'epoch': self.epoch, 'version': self.version, 'tenants': list(self._tenants.values())},
+                f,
+                sort_keys=True
+            )
+        os.replace(tmp, self.path)
+
+    def _record(self, change_type, tenant_id, tenant):
+        # caller holds the lock
+        self.version += 1
+        self._changes.append({'version': self.version, 'type': change_type, 'id': tenant_id, 'tenant': tenant})
+        self._save()
+        self._cond.notify_all()
+
+        TENANTS.labels().set(len(self._tenants))
+        FEED_VERSION.labels().set(self.version)
+
+    def get(self, tenant_id):
+        with self._cond:
+            return self._tenants.get(tenant_id)
+
+    def snapshot(self, namespace=None, name=None):
+        """Returns (epoch, version, tenants), the tenants as of that version"""
+        with self._cond:
+            if namespace is not None:
+                tenant_id = self._by_namespace.get(namespace)
+                tenants = [self._tenants[tenant_id]] if tenant_id is not None else []
+            elif name is not None:
+                tenants = [self._tenants[tenant_id] for tenant_id in sorted(self._by_name.get(name, ()))]
+            else:
+                tenants = list(self._tenants.values())
+
+            if namespace is not None and name is not None:
+                tenants = [tenant for tenant in tenants if tenant.get('name') == name]
+
+            return self.epoch, self.version, tenants
+
+    def _put(self, tenant):
+        # caller holds the lock
+        owner = self._by_namespace.get(tenant['namespace'])
+        if owner is not None and owner != tenant['id']:
+            raise TenantConflict('namespace {} belongs to tenant {}'.format(tenant['namespace'], owner))
+
+        old = self._tenants.get(tenant['id'])
+        if old is not None:
+            self._unindex(old)
+        self._index(tenant)
+        self._record('put', tenant['id'], tenant)
+
+        return old is None, self.version
+
+    def create(self, tenant):
+        """Creates a tenant, returns the version, raises TenantConflict when its id or namespace is taken"""
+        with self._cond:
+            if tenant['id'] in self._tenants:
+                raise TenantConflict('tenant {} already exists'.format(tenant['id']))
+
+            return self._put(tenant)[1]
+
+    def put(self, tenant):
+        """Creates or replaces a tenant, returns (created, version)"""
+        with self._cond:
+            return self._put(tenant)
+
+    def delete(self, tenant_id):
+        """Returns the version of the delete, None if there was no such tenant"""
+        with self._cond:
+            tenant = self._tenants.get(tenant_id)
+            if tenant is None:
+                return None
+
+            self._unindex(tenant)
+            self._record('delete', tenant_id, None)
+
+            return self.version
+
+    def changes(self, since, epoch=None, timeout=0):
+        """Returns (version, changes after since), waiting up to timeout seconds for one.
+
+        Raises FeedExpired when the changes after since are no longer kept.
+        """
+        end = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if (epoch is not None and epoch != self.epoch) or since > self.version:
+                    raise FeedExpired('version {} is not of this feed'.format(since))
+                if since < self.version:
+                    if not self._changes or self._changes[0]['version'] > since + 1:
+                        raise FeedExpired('changes after version {} are no longer kept'.format(since))
+                    # the feed is in version order, the wanted ones are at its end
+                    return self.version, [change for change in self._changes if change['version'] > since]
+
+                left = end - time.monotonic()
+                if left <= 0:
+                    return self.version, []
+                FEED_WAITERS.labels().inc()
+                try:
+                    self._cond.wait(left)
+                finally:
+                    FEED_WAITERS.labels().dec()
+
+def validate_tenant(tenant, tenant_id=None):
+    """Returns the tenant ready to store, or an error message"""
+    if not isinstance(tenant, dict):
+        return None, 'tenant must be a json object'
+
+    tenant = dict(tenant)
+    if tenant_id is not None:
+        if tenant.get('id', tenant_id) != tenant_id:
+            return None, 'id {} does not match the path'.format(tenant['id'])
+        tenant['id'] = tenant_id
+    elif not tenant.get('id'):
+        # the shape of the ObjectIDs tenants had so far
+        tenant['id'] = secrets.token_hex(12)
+
+    if not isinstance(tenant['id'], str) or not TENANT_ID.match(tenant['id']) or tenant['id'] in RESERVED_IDS:
+        return None, 'invalid tenant id {}'.format(tenant['id'])
+
+    # the tenant's kubernetes namespace, its id unless told otherwise
+    tenant.setdefault('namespace', tenant['id'])
+    if not isinstance(tenant['namespace'], str) or not TENANT_ID.match(tenant['namespace']):
+        return None, 'invalid namespace {}'.format(tenant['namespace'])
+    if not isinstance(tenant.setdefault('resources', {}), dict):
+        return None, 'resources must be a json object'
+
+    return tenant, None
+
+def feed_events(store, since, epoch, stream_seconds, heartbeat):
+    # server-sent events as bytes, each change's version is its event id
+    end = time.monotonic() + stream_seconds
+    while True:
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+
+        try:
+            version, changes = store.changes(since, epoch, min(heartbeat, left))
+        except FeedExpired as e:
+            FEED_EXPIRED.labels().inc()
+            yield 'event: expired\ndata: {}\n\n'.format(json.dumps({'error': str(e), 'epoch': store.epoch})).encode()
+            return
+
+        if not changes:
+            yield b': keep-alive\n\n'
+            continue
+        for change in changes:
+            yield 'id: {}\nevent: change\ndata: {}\n\n'.format(
+                change['version'],
+                json.dumps(change, sort_keys=True)
+            ).encode()
+        since = version
+
+bp = Blueprint('tenant-service', __name__)
+
+@bp.before_app_request
+def start_request_deadline():
+    g.deadline_token = start_deadline(
+        parse_deadline_header(request.headers.get(DEADLINE_HEADER), current_app.config['REQUEST_DEADLINE'])
+    )
+
+@bp.teardown_app_request
+def clear_request_deadline(exc):
+    clear_deadline(g.pop('deadline_token', None))
+
+@bp.app_errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    logger.error('Deadline Error: %s', e)
+    return Response(
+        json.dumps({'error': 'Request deadline exceeded'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=504
+    )
+
+def get_store(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        try:
+            return f(current_app.extensions['tenant_store'], *args, **kwargs)
+        except DeadlineExceeded:
+            # answered by the fast-fail error handler
+            raise
+        except Exception as e:
+            # this might be a bug
+            logger.critical('Program Error: %s', e, exc_info=True)
+            return Response(
+                json.dumps(
+                    {'error': 'Tenant service failed.'},
+                    indent=1,
+                    sort_keys=True
+                ),
+                status=500,
+                mimetype='application/json'
+            )
+
+    return decorated
+
+def tenant_response(tenant, version=None):
+    return Response(
+        json.dumps(tenant, indent=1, sort_keys=True),
+        headers={'X-Tenant-Version': str(version)} if version is not None else None,
+        mimetype='application/json'
+    )
+
+def not_found(tenant_id):
+    return Response(
+        json.dumps({'error': 'tenant {} not found'.format(tenant_id)}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=404
+    )
+
+# GET /tenants
+@bp.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@get_store
+def list_tenants(store):
+    # ?namespace= and ?name= are answered from their indexes
+    epoch, version, tenants = store.snapshot(request.args.get('namespace'), request.args.get('name'))
+
+    return Response(
+        json.dumps({'epoch': epoch, 'version': version, 'tenants': tenants}, indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+# POST /tenants
+@bp.route('/{}{}'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@get_store
+def create_tenant(store):
+    tenant, error = validate_tenant(request.get_json(silent=True))
+    if error is not None:
+        return Response(
+            json.dumps({'error': error}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+
+    try:
+        version = store.create(tenant)
+    except TenantConflict as e:
+        return Response(
+            json.dumps({'error': str(e)}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=409
+        )
+
+    logger.info('Tenant created: %s', tenant['id'])
+    return tenant_response(tenant, version)
+
+# GET /tenants/changes
+@bp.route('/{}{}/changes'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@get_store
+def read_changes(store):
+    try:
+        since = int(request.args.get('since') or request.headers.get('Last-Event-ID') or store.version)
+        timeout = float(request.args.get('timeout', current_app.config['TENANT_FEED_POLL_TIMEOUT']))
+    except ValueError:
+        return Response(
+            json.dumps({'error': 'since and timeout must be numbers'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    epoch = request.args.get('epoch') or None
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(
+            feed_events(
+                store,
+                since,
+                epoch,
+                current_app.config['TENANT_FEED_STREAM_SECONDS'],
+                current_app.config['TENANT_FEED_HEARTBEAT']
+            ),
+            mimetype='text/event-stream',
+            # proxies pass events on as they come
+            headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'},
+            direct_passthrough=True
+        )
+
+    # a long poll answers before the caller's deadline, with no changes if need be
+    deadline = current_deadline()
+    if deadline is not None:
+        timeout = min(timeout, max(deadline.remaining() - 1, 0))
+
+    try:
+        version, changes = store.changes(since, epoch, timeout)
+    except FeedExpired as e:
+        FEED_EXPIRED.labels().inc()
+        return Response(
+            json.dumps({'error': str(e), 'epoch': store.epoch, 'version': store.version}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=410
+        )
+
+    return Response(
+        json.dumps({'epoch': store.epoch, 'version': version, 'changes': changes}, indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+# GET /tenants/<id>
+@bp.route('/{}{}/<tenant_id>'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@get_store
+def read_tenant(store, tenant_id):
+    tenant = store.get(tenant_id)
+    if tenant is None:
+        return not_found(tenant_id)
+
+    return tenant_response(tenant)
+
+# PUT /tenants/<id>
+@bp.route('/{}{}/<tenant_id>'.format(API_VERSION, SERVICE_PREFIX), methods=['PUT'])
+@get_store
+def replace_tenant(store, tenant_id):
+    tenant, error = validate_tenant(request.get_json(silent=True), tenant_id)
+    if error is not None:
+        return Response(
+            json.dumps({'error': error}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+
+    try:
+        created, version = store.put(tenant)
+    except TenantConflict as e:
+        return Response(
+            json.dumps({'error': str(e)}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=409
+        )
+
+    logger.info('Tenant %s: %s', 'created' if created else 'replaced', tenant_id)
+    return tenant_response(tenant, version)
+
+# DELETE /tenants/<id>
+@bp.route('/{}{}/<tenant_id>'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
+@get_store
+def remove_tenant(store, tenant_id):
+    version = store.delete(tenant_id)
+    if version is None:
+        return not_found(tenant_id)
+
+    logger.info('Tenant deleted: %s', tenant_id)
+    return Response(
+        json.dumps({'id': tenant_id, 'version': version}, indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+def create_app(settings=None):
+    """App factory, picked up by flask run and gunicorn 'tenant-service:create_app()'"""
+    app = Flask(__name__)
+    app.config.update(load_settings())
+    if settings is not None:
+        app.config.update(settings)
+
+    setup_logger(app.config)
+
+    tracing.configure(
+        app.config['TRACE_EXPORTER'],
+        service='tenant-service',
+        path=app.config['TRACE_FILE'],
+        logger=logger,
+        sample_ratio=app.config['TRACE_SAMPLE_RATIO']
+    )
+
+    instrument_app(app)
+    # off unless PROFILING_TOKEN is set
+    profiling.install(
+        app,
+        app.config['PROFILING_TOKEN'],
+        output_dir=app.config['PROFILING_DIR'],
+        max_seconds=app.config['PROFILING_MAX_SECONDS']
+    )
+    # off unless RECORD_DIR is set
+    recorder.install(
+        app,
+        app.config['RECORD_DIR'],
+        'tenant-service',
+        sample_ratio=app.config['RECORD_SAMPLE_RATIO'],
+        salt=app.config['RECORD_SALT']
+    )
+    app.register_blueprint(bp)
+
+    # the tenants live in this process, run a single worker
+    app.extensions['tenant_store'] = TenantStore(
+        app.config['TENANT_FEED_SIZE'],
+        app.config['TENANT_DATA_FILE']
+    )
+
+    return app
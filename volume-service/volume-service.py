@@ -1,60 +1,359 @@
 from __future__ import print_function
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-import traceback
 import time
 import json
+import math
 import os
 import logging
 import logging.handlers
 import sys
 import datetime
-
-from kubernetes import config
-import kubernetes.client
-from kubernetes.client.rest import ApiException
+import threading
+import uuid
 
 import requests
-from flask import Flask, redirect, request, Response
-
-# envs
-LOG_LEVEL = int(os.getenv('LOG_LEVEL', ''))
-TENANT_SERVICE_URL = os.environ.get('TENANT_SERVICE_URL', '/').strip()
-NFS_SERVER = os.environ.get('NFS_SERVER', '/').strip()
-NFS_PREFIX = os.environ.get('NFS_PREFIX', '/').strip()
+from flask import Flask, Blueprint, redirect, request, Response, g, current_app
+
+# shared helpers live in the repository root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from moop_common import kube, metrics, profiling, recorder, tracing
+from moop_common.tenants import TenantMirror
+from moop_common.instrument import instrument_app
+from moop_common.logs import setup_logging
+from moop_common.resilience import (
+    CircuitOpenError, DeadlineExceeded, DEADLINE_HEADER,
+    configure_breakers, start_deadline, clear_deadline, parse_deadline_header,
+    deadline_headers, upstream, is_request_failure
+)
 
 # consts
 SERVICE_PREFIX = '/volumes'
 API_VERSION = 'service/v1'
+TENANT_UPSTREAM = 'tenant-service'
+
+TEARDOWN_VOLUMES = metrics.Counter(
+    'volume_teardown_volumes_total',
+    'Volumes torn down by teardown jobs, by outcome.',
+    ['outcome']
+)
+TEARDOWN_SECONDS = metrics.Histogram(
+    'volume_teardown_seconds',
+    'Time to delete a pvc and its pv, finalizers included.',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
 
 # logger
 LOG_NAME = 'Volume-Service'
 LOG_FORMAT = '%(asctime)s - %(filename)s:%(lineno)s - %(name)s:%(funcName)s - [%(levelname)s] %(message)s'
 
-def setup_logger(level):
-    handler = logging.StreamHandler(stream=sys.stdout)
-    formatter = logging.Formatter(LOG_FORMAT)
-    handler.setFormatter(formatter)
-
-    logger = logging.getLogger(LOG_NAME)
-    logger.addHandler(handler)
-    logger.setLevel(level)
-
-    return logger
-
-logger = setup_logger(int(LOG_LEVEL))
+logger = logging.getLogger(LOG_NAME)
+
+def setup_logger(config):
+    # records are written by a background thread, see moop_common.logs
+    return setup_logging(
+        logger,
+        config['LOG_LEVEL'],
+        LOG_FORMAT,
+        style=config['LOG_STYLE'],
+        queue_size=config['LOG_QUEUE_SIZE'],
+        rate=config['LOG_RATE_LIMIT'],
+        burst=config['LOG_RATE_BURST'],
+        sample_every=config['LOG_SAMPLE_EVERY']
+    )
+
+# envs, read by create_app
+def load_settings():
+    return {
+        'LOG_LEVEL': int(os.getenv('LOG_LEVEL', '')),
+        'LOG_STYLE': os.getenv('LOG_STYLE', 'json').strip(),
+        'LOG_QUEUE_SIZE': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        'LOG_RATE_LIMIT': float(os.getenv('LOG_RATE_LIMIT', '5')),
+        'LOG_RATE_BURST': int(os.getenv('LOG_RATE_BURST', '20')),
+        'LOG_SAMPLE_EVERY': int(os.getenv('LOG_SAMPLE_EVERY', '100')),
+        'TENANT_SERVICE_URL': os.environ.get('TENANT_SERVICE_URL', '/').strip(),
+        'NFS_SERVER': os.environ.get('NFS_SERVER', '/').strip(),
+        'NFS_PREFIX': os.environ.get('NFS_PREFIX', '/').strip(),
+        'REQUEST_DEADLINE': float(os.getenv('REQUEST_DEADLINE', '30')),
+        'TENANT_REQUEST_TIMEOUT': float(os.getenv('TENANT_REQUEST_TIMEOUT', '5')),
+        'TENANT_MIRROR': os.getenv('TENANT_MIRROR', '0').strip() == '1',
+        'TENANT_MIRROR_POLL_TIMEOUT': float(os.getenv('TENANT_MIRROR_POLL_TIMEOUT', '20')),
+        'TENANT_MIRROR_STALE_AFTER': float(os.getenv('TENANT_MIRROR_STALE_AFTER', '60')),
+        'KUBE_CONFIG_MODE': os.getenv('KUBE_CONFIG_MODE', 'auto').strip(),
+        'KUBE_REQUEST_TIMEOUT': float(os.getenv('KUBE_REQUEST_TIMEOUT', '20')),
+        'KUBE_CONNECT_TIMEOUT': float(os.getenv('KUBE_CONNECT_TIMEOUT', '5')),
+        'KUBE_POOL_MAXSIZE': int(os.getenv('KUBE_POOL_MAXSIZE', '16')),
+        'KUBE_POOL_TIMEOUT': float(os.getenv('KUBE_POOL_TIMEOUT', '10')),
+        'KUBE_KEEPALIVE': os.getenv('KUBE_KEEPALIVE', '1').strip() == '1',
+        'KUBE_CLIENT_SCOPE': os.getenv('KUBE_CLIENT_SCOPE', 'process').strip(),
+        # tenant=context,tenant=context
+        'KUBE_TENANT_CLUSTERS': dict(
+            item.strip().split('=', 1) for item in os.getenv('KUBE_TENANT_CLUSTERS', '').split(',') if item.strip()
+        ),
+        'BREAKER_FAILURE_THRESHOLD': int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5')),
+        'BREAKER_RECOVERY_TIMEOUT': float(os.getenv('BREAKER_RECOVERY_TIMEOUT', '30')),
+        'TRACE_EXPORTER': os.getenv('TRACE_EXPORTER', 'none').strip(),
+        'TRACE_FILE': os.getenv('TRACE_FILE', '').strip(),
+        'TRACE_SAMPLE_RATIO': float(os.getenv('TRACE_SAMPLE_RATIO', '1')),
+        'PROFILING_TOKEN': os.getenv('PROFILING_TOKEN', '').strip(),
+        'PROFILING_DIR': os.getenv('PROFILING_DIR', '').strip(),
+        'PROFILING_MAX_SECONDS': float(os.getenv('PROFILING_MAX_SECONDS', '60')),
+        'RECORD_DIR': os.getenv('RECORD_DIR', '').strip(),
+        'RECORD_SAMPLE_RATIO': float(os.getenv('RECORD_SAMPLE_RATIO', '1')),
+        'RECORD_SALT': os.getenv('RECORD_SALT', '').strip(),
+        'TEARDOWN_CONCURRENCY': int(os.getenv('TEARDOWN_CONCURRENCY', '16')),
+        'TEARDOWN_POLL_INTERVAL': float(os.getenv('TEARDOWN_POLL_INTERVAL', '1')),
+        'TEARDOWN_TIMEOUT': float(os.getenv('TEARDOWN_TIMEOUT', '600')),
+        'TEARDOWN_JOBS_KEPT': int(os.getenv('TEARDOWN_JOBS_KEPT', '100')),
+        'PRELOAD': os.getenv('PRELOAD', '0').strip() == '1',
+    }
 
 # helper
 def datetime_convertor(o):
     if isinstance(o, datetime.datetime):
         return o.__str__()
 
-# load kube config from .kube
-config.load_kube_config()
-
-# create an instance of the API class
-api_instance = kubernetes.client.CoreV1Api()
-
-app = Flask(__name__)
+# the render functions fill the tenant's templates in place
+def render_pv(template, tenant_id, username, tag, namespace, nfs_server, nfs_prefix, path):
+    body = template
+
+    body['metadata']['name'] = body['metadata']['name'].format(tenant_id, username, tag)
+    body['metadata']['namespace'] = namespace
+    body['metadata']['labels']['pv'] = body['metadata']['labels']['pv'].format(tenant_id, username, tag)
+    body['spec']['nfs']['server'] = body['spec']['nfs']['server'].format(nfs_server)
+    body['spec']['nfs']['path'] = body['spec']['nfs']['path'].format(nfs_prefix, path)
+
+    return body
+
+def render_match_pvc(template, tenant_id, username, tag, namespace):
+    body = template
+
+    body['metadata']['name'] = body['metadata']['name'].format(tenant_id, username, tag)
+    body['metadata']['namespace'] = namespace
+    body['spec']['selector']['matchLabels']['pv'] = body['spec']['selector']['matchLabels']['pv'].format(tenant_id, username, tag)
+
+    return body
+
+def render_pvc(template, tenant_id, username, tag, namespace):
+    body = template
+
+    body['metadata']['name'] = body['metadata']['name'].format(tenant_id, username, tag)
+    body['metadata']['namespace'] = namespace
+
+    return body
+
+def fetch_tenant(tenant_id):
+    mirror = current_app.extensions.get('tenant_mirror')
+    if mirror is not None:
+        # None until the copy is synced, and for tenants it does not know yet
+        tenant_resp = mirror.lookup(tenant_id)
+        if tenant_resp is not None:
+            return tenant_resp
+
+    with upstream(
+        TENANT_UPSTREAM,
+        'get_tenant',
+        timeout=current_app.config['TENANT_REQUEST_TIMEOUT'],
+        is_failure=is_request_failure
+    ) as call:
+        tenant_resp = requests.get(
+            '{}/{}'.format(current_app.config['TENANT_SERVICE_URL'], tenant_id),
+            headers=deadline_headers(),
+            timeout=call.timeout
+        )
+        if tenant_resp.status_code >= 500:
+            call.fail()
+
+    return tenant_resp
+
+# teardown
+class TeardownJob(object):
+    def __init__(self, tenant, namespace, volumes, cluster=None):
+        self.id = uuid.uuid4().hex
+        self.tenant = tenant
+        self.namespace = namespace
+        self.cluster = cluster
+        self.created = time.time()
+        self.finished = None
+
+        self.volumes = [
+            {
+                'username': username,
+                'tag': tag,
+                'pvc': 'pvc-{}-{}-{}'.format(tenant, username, tag),
+                'pv': 'pv-{}-{}-{}'.format(tenant, username, tag),
+                'state': 'pending',
+            }
+            for username, tag in volumes
+        ]
+        self._lock = threading.Lock()
+        self._pending = len(self.volumes)
+
+    def set_state(self, volume, state, error=None):
+        with self._lock:
+            volume['state'] = state
+            if error is not None:
+                volume['error'] = error
+            if state in ('done', 'failed'):
+                self._pending -= 1
+                if self._pending == 0:
+                    self.finished = time.time()
+
+    def to_dict(self):
+        with self._lock:
+            states = {}
+            for volume in self.volumes:
+                states[volume['state']] = states.get(volume['state'], 0) + 1
+
+            return {
+                'id': self.id,
+                'tenant': self.tenant,
+                'state': 'running' if self._pending else 'finished',
+                'created': self.created,
+                'finished': self.finished,
+                'total': len(self.volumes),
+                'states': states,
+                'volumes': [dict(volume) for volume in self.volumes],
+            }
+
+class VolumeTeardown(object):
+    """Deletes pvcs and then their pvs on a bounded thread pool, jobs are kept in the worker process"""
+
+    def __init__(self, concurrency, poll_interval, timeout, jobs_kept):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.jobs_kept = jobs_kept
+
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._pool = None
+        self._pid = None
+
+    def _executor(self):
+        # threads do not survive a fork, every worker gets its own pool
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='volume-teardown')
+            return self._pool
+
+    def submit(self, tenant, namespace, volumes, cluster=None):
+        job = TeardownJob(tenant, namespace, volumes, cluster)
+        with self._lock:
+            self._jobs[job.id] = job
+            # forget the oldest finished jobs
+            for job_id in [job_id for job_id, kept in self._jobs.items() if kept.finished is not None]:
+                if len(self._jobs) <= self.jobs_kept:
+                    break
+                del self._jobs[job_id]
+
+        executor = self._executor()
+        for volume in job.volumes:
+            executor.submit(self._teardown, job, volume)
+
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _call(self, deadline, cluster, method, *args):
+        # waits out an open breaker instead of failing the volume
+        while True:
+            try:
+                return kube.call_json(kube.core_v1(cluster), method, *args)
+            except CircuitOpenError as e:
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                time.sleep(e.retry_after)
+
+    def _delete_and_wait(self, deadline, cluster, delete, read, *args):
+        """Deletes the object and polls until its finalizers let it go"""
+        try:
+            self._call(deadline, cluster, delete, *args)
+        except kube.ApiException as e:
+            if e.status == 404:
+                return
+            raise
+
+        while True:
+            try:
+                self._call(deadline, cluster, read, *args)
+            except kube.ApiException as e:
+                if e.status == 404:
+                    return
+                raise
+
+            if time.monotonic() + self.poll_interval > deadline:
+                raise TimeoutError('still there after {}s'.format(self.timeout))
+            time.sleep(self.poll_interval)
+
+    def _teardown(self, job, volume):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        try:
+            # the pv is only released once no claim is bound to it
+            job.set_state(volume, 'deleting_pvc')
+            self._delete_and_wait(
+                deadline,
+                job.cluster,
+                'delete_namespaced_persistent_volume_claim',
+                'read_namespaced_persistent_volume_claim',
+                volume['pvc'],
+                job.namespace
+            )
+            job.set_state(volume, 'deleting_pv')
+            self._delete_and_wait(deadline, job.cluster, 'delete_persistent_volume', 'read_persistent_volume', volume['pv'])
+        except Exception as e:
+            logger.error('Teardown Error: %s %s', volume['pvc'], e)
+            TEARDOWN_VOLUMES.labels('failed').inc()
+            job.set_state(volume, 'failed', '{}: {}'.format(type(e).__name__, e))
+        else:
+            TEARDOWN_VOLUMES.labels('done').inc()
+            TEARDOWN_SECONDS.labels().observe(time.monotonic() - start)
+            job.set_state(volume, 'done')
+
+bp = Blueprint('volume-service', __name__)
+
+@bp.before_app_request
+def start_request_deadline():
+    g.deadline_token = start_deadline(
+        parse_deadline_header(request.headers.get(DEADLINE_HEADER), current_app.config['REQUEST_DEADLINE'])
+    )
+
+@bp.teardown_app_request
+def clear_request_deadline(exc):
+    clear_deadline(g.pop('deadline_token', None))
+
+@bp.app_errorhandler(CircuitOpenError)
+def upstream_unavailable(e):
+    logger.warning('Circuit Open: %s', e)
+    return Response(
+        json.dumps({'error': '{} is unavailable'.format(e.name)}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        headers={'Retry-After': str(int(math.ceil(e.retry_after)))},
+        status=503
+    )
+
+@bp.app_errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    logger.error('Deadline Error: %s', e)
+    return Response(
+        json.dumps({'error': 'Request deadline exceeded'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=504
+    )
+
+@bp.app_errorhandler(requests.exceptions.RequestException)
+def tenant_request_failed(e):
+    logger.error('Request Error: %s', e, exc_info=True)
+    return Response(
+        json.dumps({'error': 'tenant service request failed'}, indent=1, sort_keys=True),
+        mimetype='application/json',
+        status=502
+    )
 
 def create_body(f):
     @wraps(f)
@@ -85,9 +384,9 @@ def create_body(f):
         match = req_body['match'] if 'match' in req_body.keys() else False
 
         # read templates from tenant service
-        tenant_resp = requests.get('{}/{}'.format(TENANT_SERVICE_URL, req_body['tenant']))
+        tenant_resp = fetch_tenant(req_body['tenant'])
         if tenant_resp.status_code != 200:
-            logger.error('Request Error: {}\nStack: {}\n'.format(tenant_resp.json(), traceback.format_exc()))
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
             return Response(
                 json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
                 mimetype='application/json',
@@ -98,30 +397,27 @@ def create_body(f):
         templates = tenant['resources']['templates']
 
         # create body
-        if resource_type == 'pvs':
-            body = templates['pv']
-
-            body['metadata']['name'] = body['metadata']['name'].format(req_body['tenant'], req_body['username'], tag)
-            body['metadata']['namespace'] = namespace
-            body['metadata']['labels']['pv'] = body['metadata']['labels']['pv'].format(req_body['tenant'], req_body['username'], tag)
-            body['spec']['nfs']['server'] = body['spec']['nfs']['server'].format(NFS_SERVER)
-            body['spec']['nfs']['path'] = body['spec']['nfs']['path'].format(NFS_PREFIX, req_body['path'])
-        else:
-            if match:
-                body = templates['match_pvc']
-
-                body['metadata']['name'] = body['metadata']['name'].format(req_body['tenant'], req_body['username'], tag)
-                body['metadata']['namespace'] = namespace
-                body['spec']['selector']['matchLabels']['pv'] = body['spec']['selector']['matchLabels']['pv'].format(req_body['tenant'], req_body['username'], tag)
+        with tracing.span('volume.render', resource=resource_type):
+            if resource_type == 'pvs':
+                body = render_pv(
+                    templates['pv'],
+                    req_body['tenant'],
+                    req_body['username'],
+                    tag,
+                    namespace,
+                    current_app.config['NFS_SERVER'],
+                    current_app.config['NFS_PREFIX'],
+                    req_body['path']
+                )
+            elif match:
+                body = render_match_pvc(templates['match_pvc'], req_body['tenant'], req_body['username'], tag, namespace)
             else:
-                body = templates['pvc']
-
-                body['metadata']['name'] = body['metadata']['name'].format(req_body['tenant'], req_body['username'], tag)
-                body['metadata']['namespace'] = namespace
+                body = render_pvc(templates['pvc'], req_body['tenant'], req_body['username'], tag, namespace)
 
         return f(
             body,
             *args,
+            cluster=kube.cluster_for(tenant),
             **kwargs
         )
 
@@ -145,36 +441,39 @@ def get_params(f):
         tag = params['tag'] if 'tag' in params.keys() else 'default'
 
         # read name from tenant service
-        tenant_resp = requests.get('{}/{}'.format(TENANT_SERVICE_URL, params['tenant']))
+        tenant_resp = fetch_tenant(params['tenant'])
         if tenant_resp.status_code != 200:
-            logger.error('Request Error: {}\nStack: {}\n'.format(tenant_resp, traceback.format_exc()))
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
             return Response(
                 json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
                 mimetype='application/json',
             )
 
+        tenant = tenant_resp.json()
+
         return f(
             params['tenant'],
             params['username'],
             tag,
             *args,
-            namespace=tenant_resp.json()['namespace'],
+            namespace=tenant['namespace'],
+            cluster=kube.cluster_for(tenant),
             **kwargs
         )
 
     return decorated
 
 # POST /pvs
-@app.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@bp.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
 @create_body
-def create_pv(body):
+def create_pv(body, cluster=None):
     try:
-        include_uninitialized = True
         pretty = 'true'
 
-        pv = api_instance.create_persistent_volume(
+        pv = kube.call(
+            kube.core_v1(cluster),
+            'create_persistent_volume',
             body,
-            include_uninitialized=include_uninitialized,
             pretty=pretty
         ).to_dict()
 
@@ -182,16 +481,19 @@ def create_pv(body):
             json.dumps(pv, default=datetime_convertor, indent=1, sort_keys=True),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -203,15 +505,17 @@ def create_pv(body):
         )
 
 # GET /pvs
-@app.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@bp.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
 @get_params
-def read_pv(tenant, username, tag, namespace=''):
+def read_pv(tenant, username, tag, namespace='', cluster=None):
     try:
         pv_name = 'pv-{}-{}-{}'.format(tenant, username, tag)
         pretty = 'true'
         exact = True
 
-        pv_status = api_instance.read_persistent_volume_status(
+        pv_status = kube.call(
+            kube.core_v1(cluster),
+            'read_persistent_volume_status',
             pv_name,
             pretty=pretty
         ).to_dict()
@@ -220,16 +524,19 @@ def read_pv(tenant, username, tag, namespace=''):
             json.dumps(pv_status, default=datetime_convertor, indent=1, sort_keys=True),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -241,25 +548,28 @@ def read_pv(tenant, username, tag, namespace=''):
         )
 
 # DELETE /pvs
-@app.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
+@bp.route('/{}{}/pvs'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
 @get_params
-def remove_pv(tenant, username, tag, namespace=''):
+def remove_pv(tenant, username, tag, namespace='', cluster=None):
     try:
         pv_name = 'pv-{}-{}-{}'.format(tenant, username, tag)
 
-        pv = api_instance.delete_persistent_volume(pv_name)
+        pv = kube.call(kube.core_v1(cluster), 'delete_persistent_volume', pv_name)
 
         return Response()
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -271,18 +581,18 @@ def remove_pv(tenant, username, tag, namespace=''):
         )
 
 # POST /pvcs
-@app.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+@bp.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
 @create_body
-def create_pvc(body):
+def create_pvc(body, cluster=None):
     try:
-        include_uninitialized = True
         pretty = 'true'
 
-        print(body)
-        pvc = api_instance.create_namespaced_persistent_volume_claim(
+        logger.debug('Creating pvc %s', body['metadata']['name'])
+        pvc = kube.call(
+            kube.core_v1(cluster),
+            'create_namespaced_persistent_volume_claim',
             body['metadata']['namespace'],
             body,
-            include_uninitialized=include_uninitialized,
             pretty=pretty
         ).to_dict()
 
@@ -290,16 +600,19 @@ def create_pvc(body):
             json.dumps(pvc, default=datetime_convertor, indent=1, sort_keys=True),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -311,15 +624,17 @@ def create_pvc(body):
         )
 
 # GET /pvcs
-@app.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+@bp.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
 @get_params
-def read_pvc(tenant, username, tag, namespace=''):
+def read_pvc(tenant, username, tag, namespace='', cluster=None):
     try:
         pvc_name = 'pvc-{}-{}-{}'.format(tenant, username, tag)
         pretty = 'true'
         exact = True
 
-        pvc_status = api_instance.read_namespaced_persistent_volume_claim_status(
+        pvc_status = kube.call(
+            kube.core_v1(cluster),
+            'read_namespaced_persistent_volume_claim_status',
             pvc_name,
             namespace,
             pretty=pretty
@@ -329,16 +644,19 @@ def read_pvc(tenant, username, tag, namespace=''):
             json.dumps(pvc_status, default=datetime_convertor, indent=1, sort_keys=True),
             mimetype='application/json'
         )
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -350,28 +668,114 @@ def read_pvc(tenant, username, tag, namespace=''):
         )
 
 # DELETE /pvcs
-@app.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
+@bp.route('/{}{}/pvcs'.format(API_VERSION, SERVICE_PREFIX), methods=['DELETE'])
 @get_params
-def remove_pvc(tenant, username, tag, namespace=''):
+def remove_pvc(tenant, username, tag, namespace='', cluster=None):
     try:
         pvc_name = 'pvc-{}-{}-{}'.format(tenant, username, tag)
 
-        pvc = api_instance.delete_namespaced_persistent_volume_claim(
+        pvc = kube.call(
+            kube.core_v1(cluster),
+            'delete_namespaced_persistent_volume_claim',
             pvc_name,
             namespace
         )
 
         return Response()
-    except ApiException as e:
-        logger.error('Request Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+    except kube.ApiException as e:
+        logger.error('Request Error: %s', e, exc_info=True)
         return Response(
             json.dumps({'error': 'Kubernetes API request failed'}, indent=1, sort_keys=True),
             mimetype='application/json',
             status=400
         )
+    except (CircuitOpenError, DeadlineExceeded):
+        # answered by the fast-fail error handlers
+        raise
+    except Exception as e:
+        # this might be a bug
+        logger.critical('Program Error: %s', e, exc_info=True)
+        return Response(
+            json.dumps(
+                {'error': 'Volume service failed.'},
+                indent=1,
+                sort_keys=True
+            ),
+            status=500,
+            mimetype='application/json'
+        )
+
+# POST /teardown
+@bp.route('/{}{}/teardown'.format(API_VERSION, SERVICE_PREFIX), methods=['POST'])
+def create_teardown():
+    req_body = request.get_json(silent=True)
+
+    if not isinstance(req_body, dict):
+        return Response(
+            json.dumps({'error': 'request body must be a json object'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    if not isinstance(req_body.get('tenant'), str) or not req_body['tenant']:
+        return Response(
+            json.dumps({'error': 'no tenant parameter specified'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    users = req_body.get('users')
+    if not isinstance(users, list) or not users or not all(isinstance(username, str) for username in users):
+        return Response(
+            json.dumps({'error': 'users must be a non-empty list of usernames'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+    tags = req_body.get('tags') or ['default']
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags):
+        return Response(
+            json.dumps({'error': 'tags must be a list of tags'}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=400
+        )
+
+    try:
+        # one tenant lookup for every volume
+        tenant_resp = fetch_tenant(req_body['tenant'])
+        if tenant_resp.status_code == 404:
+            return Response(
+                json.dumps({'error': 'no tenant {}'.format(req_body['tenant'])}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=404
+            )
+        if tenant_resp.status_code != 200:
+            logger.error('Request Error: %s %s', tenant_resp.status_code, tenant_resp.text)
+            return Response(
+                json.dumps({'error': 'tenant service returned failure'}, indent=1, sort_keys=True),
+                mimetype='application/json',
+                status=503
+            )
+
+        tenant = tenant_resp.json()
+        job = current_app.extensions['volume_teardown'].submit(
+            req_body['tenant'],
+            tenant['namespace'],
+            [(username, tag) for username in users for tag in tags],
+            cluster=kube.cluster_for(tenant)
+        )
+
+        data = job.to_dict()
+        del data['volumes']
+        return Response(
+            json.dumps(data, indent=1, sort_keys=True),
+            mimetype='application/json',
+            headers={'Location': '{}?id={}'.format(request.base_url, job.id)},
+            status=202
+        )
+    except (CircuitOpenError, DeadlineExceeded, requests.exceptions.RequestException):
+        # answered by the fast-fail and tenant request error handlers
+        raise
     except Exception as e:
         # this might be a bug
-        logger.critical('Program Error: {}\nStack: {}\n'.format(e, traceback.format_exc()))
+        logger.critical('Program Error: %s', e, exc_info=True)
         return Response(
             json.dumps(
                 {'error': 'Volume service failed.'},
@@ -381,3 +785,104 @@ def remove_pvc(tenant, username, tag, namespace=''):
             status=500,
             mimetype='application/json'
         )
+
+# GET /teardown
+@bp.route('/{}{}/teardown'.format(API_VERSION, SERVICE_PREFIX), methods=['GET'])
+def read_teardown():
+    job = current_app.extensions['volume_teardown'].get(request.args.get('id', ''))
+    if job is None:
+        # jobs live in the worker process that accepted them
+        return Response(
+            json.dumps({'error': 'no teardown job {} in this worker'.format(request.args.get('id', ''))}, indent=1, sort_keys=True),
+            mimetype='application/json',
+            status=404
+        )
+
+    return Response(
+        json.dumps(job.to_dict(), indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+# GET /kube-pool
+@bp.route('/{}/kube-pool'.format(API_VERSION), methods=['GET'])
+def read_kube_pool():
+    # ?cluster=<context> for the pool of another cluster
+    return Response(
+        json.dumps(kube.get_pool_stats(request.args.get('cluster') or None).snapshot(), indent=1, sort_keys=True),
+        mimetype='application/json'
+    )
+
+def create_app(settings=None):
+    """App factory, picked up by flask run and gunicorn 'volume-service:create_app()'"""
+    app = Flask(__name__)
+    app.config.update(load_settings())
+    if settings is not None:
+        app.config.update(settings)
+
+    setup_logger(app.config)
+
+    # kube config is loaded and the API client created on first use
+    kube.configure(
+        config_mode=app.config['KUBE_CONFIG_MODE'],
+        request_timeout=app.config['KUBE_REQUEST_TIMEOUT'],
+        connect_timeout=app.config['KUBE_CONNECT_TIMEOUT'],
+        pool_maxsize=app.config['KUBE_POOL_MAXSIZE'],
+        pool_timeout=app.config['KUBE_POOL_TIMEOUT'],
+        keepalive=app.config['KUBE_KEEPALIVE'],
+        scope=app.config['KUBE_CLIENT_SCOPE'],
+        tenant_clusters=app.config['KUBE_TENANT_CLUSTERS']
+    )
+    configure_breakers(
+        failure_threshold=app.config['BREAKER_FAILURE_THRESHOLD'],
+        recovery_timeout=app.config['BREAKER_RECOVERY_TIMEOUT']
+    )
+    tracing.configure(
+        app.config['TRACE_EXPORTER'],
+        service='volume-service',
+        path=app.config['TRACE_FILE'],
+        logger=logger,
+        sample_ratio=app.config['TRACE_SAMPLE_RATIO']
+    )
+
+    if app.config['PRELOAD']:
+        # pay for the kubernetes import and kube config once in the master process
+        kube.preload()
+
+    instrument_app(app)
+    # off unless PROFILING_TOKEN is set
+    profiling.install(
+        app,
+        app.config['PROFILING_TOKEN'],
+        output_dir=app.config['PROFILING_DIR'],
+        max_seconds=app.config['PROFILING_MAX_SECONDS']
+    )
+    # off unless RECORD_DIR is set
+    recorder.install(
+        app,
+        app.config['RECORD_DIR'],
+        'volume-service',
+        sample_ratio=app.config['RECORD_SAMPLE_RATIO'],
+        salt=app.config['RECORD_SALT']
+    )
+    app.register_blueprint(bp)
+
+    # the pool is started in each worker on its first job
+    app.extensions['volume_teardown'] = VolumeTeardown(
+        app.config['TEARDOWN_CONCURRENCY'],
+        app.config['TEARDOWN_POLL_INTERVAL'],
+        app.config['TEARDOWN_TIMEOUT'],
+        app.config['TEARDOWN_JOBS_KEPT']
+    )
+
+    if app.config['TENANT_MIRROR']:
+        # each worker lists the tenants on its first lookup, then follows their changes
+        app.extensions['tenant_mirror'] = TenantMirror(
+            app.config['TENANT_SERVICE_URL'],
+            poll_timeout=app.config['TENANT_MIRROR_POLL_TIMEOUT'],
+            request_timeout=app.config['TENANT_REQUEST_TIMEOUT'],
+            stale_after=app.config['TENANT_MIRROR_STALE_AFTER'],
+            upstream_name=TENANT_UPSTREAM,
+            logger=logger
+        )
+
+    return app